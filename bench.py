@@ -0,0 +1,1426 @@
+"""Offline benchmarks for the ezpubmed ingest pipeline.
+
+Everything runs against synthetic MEDLINE XML written to a temporary directory,
+so no network access or real PubMed data is needed.
+
+    python bench.py                 # run all benchmarks
+    python bench.py prepare         # run a single benchmark
+    python bench.py ingest --scale medium --json results.json
+    python bench.py ingest --compare results.json   # ratios against an earlier run
+
+--json writes the results with the git commit and machine details so runs of
+different commits can be compared.
+"""
+import os,sys,glob
+import time
+import random
+import shutil
+import tempfile
+import logging
+import datetime
+import resource
+import sqlite3
+import gzip
+import json
+import argparse
+import platform
+import subprocess
+import hashlib
+import re
+import threading
+import contextlib
+import multiprocessing as mp
+
+import config
+
+# point the package at a scratch directory before db is imported
+bench_path = tempfile.mkdtemp(prefix="ezpubmed_bench_")
+config.data_path = bench_path + "/"
+config.papers_db = config.data_path + "papers.db"
+config.parquet_path = config.data_path + "by_year/papers/"
+config.metrics_path = config.data_path + "metrics.jsonl"
+
+import numpy as np
+import pandas as pd
+
+import db
+import utils
+import ezpubmed
+import utils_pubs
+import utils_parquet
+import utils_ftp
+import metrics
+import utils_vectors
+
+words = ("cell protein gene expression tumor patient clinical trial receptor "
+         "signaling pathway mouse model treatment response analysis cohort "
+         "risk factor disease outcome mutation sequence binding kinase").split()
+journals = ["Nature", "Science", "Cell", "The Lancet", "PloS one", "Scientific reports"]
+mesh = [("D000818","Animals"),("D006801","Humans"),("D003920","Diabetes Mellitus"),
+        ("D009369","Neoplasms"),("D051379","Mice"),("D005260","Female"),("D008297","Male")]
+months = ["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
+
+seasons = ["Spring","Summer","Fall","Winter"]
+
+# relative weights of the PubDate layouts found in MEDLINE
+date_formats = {'ymd': 0.45,        # <Year><Month>Mar<Day>07
+                'ym': 0.30,         # <Year><Month>Mar
+                'y': 0.15,          # <Year>
+                'numeric': 0.04,    # <Year><Month>03<Day>07
+                'season': 0.03,     # <Year><Season>Spring
+                'medline': 0.03}    # <MedlineDate>1998 Dec-1999 Jan
+
+def _sentence(rng,n):
+    return " ".join(rng.choice(words) for _ in range(n)).capitalize() + "."
+
+def _pubdate(rng,formats):
+    year = rng.randint(1950,2021)
+    kind = rng.choices(list(formats),list(formats.values()))[0]
+    if kind == 'ymd':
+        return "<Year>%i</Year><Month>%s</Month><Day>%02i</Day>" % (year,rng.choice(months),rng.randint(1,28))
+    if kind == 'ym':
+        return "<Year>%i</Year><Month>%s</Month>" % (year,rng.choice(months))
+    if kind == 'numeric':
+        return "<Year>%i</Year><Month>%02i</Month><Day>%02i</Day>" % (year,rng.randint(1,12),rng.randint(1,28))
+    if kind == 'season':
+        return "<Year>%i</Year><Season>%s</Season>" % (year,rng.choice(seasons))
+    if kind == 'medline':
+        return "<MedlineDate>%i %s-%i %s</MedlineDate>" % (year,"Dec",year+1,"Jan")
+    return "<Year>%i</Year>" % year
+
+def _article(rng,pmid,abstract_sentences=(3,10),n_authors=(1,8),n_affiliations=(1,1),formats=date_formats):
+    authors = "".join(
+        "<Author><LastName>Author%i</LastName><ForeName>A</ForeName><Initials>A</Initials>%s</Author>"
+        % (i,"".join("<AffiliationInfo><Affiliation>Department %i, University %i.</Affiliation></AffiliationInfo>"
+                     % (rng.randint(1,50),rng.randint(1,500)) for _ in range(rng.randint(*n_affiliations))))
+        for i in range(rng.randint(*n_authors)))
+    headings = "".join(
+        '<MeshHeading><DescriptorName UI="%s">%s</DescriptorName></MeshHeading>' % m
+        for m in rng.sample(mesh,3))
+    abstract = " ".join(_sentence(rng,rng.randint(8,25)) for _ in range(rng.randint(*abstract_sentences)))
+    return ("<PubmedArticle><MedlineCitation Status=\"MEDLINE\"><PMID Version=\"1\">%i</PMID>"
+            "<Article><Journal><ISSN>0000-0000</ISSN><JournalIssue><PubDate>%s</PubDate></JournalIssue>"
+            "<Title>%s</Title></Journal><ArticleTitle>%s</ArticleTitle>"
+            "<Abstract><AbstractText>%s</AbstractText></Abstract>"
+            "<AuthorList>%s</AuthorList></Article>"
+            "<MedlineJournalInfo><Country>United States</Country><MedlineTA>%s</MedlineTA>"
+            "<NlmUniqueID>%i</NlmUniqueID><ISSNLinking>0000-0000</ISSNLinking></MedlineJournalInfo>"
+            "<MeshHeadingList>%s</MeshHeadingList></MedlineCitation>"
+            "<PubmedData><ArticleIdList><ArticleId IdType=\"pubmed\">%i</ArticleId>"
+            "<ArticleId IdType=\"doi\">10.1000/%i</ArticleId></ArticleIdList></PubmedData></PubmedArticle>\n"
+            % (pmid,_pubdate(rng,formats),rng.choice(journals),_sentence(rng,10),abstract,authors,
+               rng.choice(journals),rng.randint(1,10**6),headings,pmid,pmid))
+
+def write_synthetic_xml(fname,pmids,seed=0,**params):
+    """Write a MEDLINE-style XML file containing one article per PMID
+
+    params are passed to _article: abstract_sentences, n_authors and
+    n_affiliations are (min, max) ranges, formats weights the PubDate layouts.
+    Writes gzip when fname ends in .gz.
+    """
+    rng = random.Random(seed)
+    with (gzip.open(fname,"wt") if fname.endswith(".gz") else open(fname,"w")) as f:
+        f.write('<?xml version="1.0" ?>\n<PubmedArticleSet>\n')
+        for pmid in pmids:
+            f.write(_article(rng,pmid,**params))
+        f.write("</PubmedArticleSet>\n")
+    return fname
+
+def make_corpus(path,n_files,n_articles,revisions=0.0,seed=0,ext=".xml",**params):
+    """Write n_files synthetic XML files of n_articles each, return the sorted paths
+
+    After the first file, a fraction revisions of each file's articles revise
+    (re-issue with new content) PMIDs of earlier files, like PubMed update files.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    rng = random.Random(seed)
+    xml_files = []
+    next_pmid = 1
+    for i in range(n_files):
+        fname = os.path.join(path,"pubmed21n%04i%s" % (i+1,ext))
+        n_revised = int(revisions*n_articles) if next_pmid > 1 else 0
+        n_revised = min(n_revised,next_pmid-1)
+        pmids = sorted(rng.sample(range(1,next_pmid),n_revised)) + list(range(next_pmid,next_pmid+n_articles-n_revised))
+        next_pmid += n_articles-n_revised
+        xml_files.append(write_synthetic_xml(fname,pmids,seed=seed*1000+i,**params))
+    return xml_files
+
+def timed(fn,*args,**kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args,**kwargs)
+    return time.perf_counter()-t0,out
+
+def quiet():
+    """Silence the per-file progress output of the code under test"""
+    return contextlib.redirect_stdout(open(os.devnull,"w"))
+
+def peak_rss(fn,*args):
+    """Run fn in a forked child and return its peak RSS in MB"""
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    def target():
+        fn(*args)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put(maxrss/1024**2 if sys.platform == "darwin" else maxrss/1024)
+    proc = ctx.Process(target=target)
+    proc.start()
+    rss = queue.get()
+    proc.join()
+    return rss
+
+def make_dataset(datatype="baseline"):
+    """A Dataset backed by the scratch database with an empty completed list"""
+    with quiet():
+        dataset = ezpubmed.Dataset(config.data_path,datatype,db.create_db())
+    db.IngestChange.delete().execute()
+    db.IngestFile.delete().execute()
+    return dataset
+
+def _ingest(streaming):
+    with quiet():
+        db.reset_db()
+        make_dataset().update_db(n_workers=1,streaming=streaming)
+
+def bench_prepare(n_files=16,n_articles=2000,n_workers=(1,2,4,8)):
+    """Parse + prepare throughput of the worker pool for different worker counts"""
+    xml_files = make_corpus(os.path.join(bench_path,"prepare"),n_files,n_articles)
+    print("Corpus: %i files x %i articles" % (n_files,n_articles))
+    serial = None
+    for n in n_workers:
+        dt,_ = timed(lambda: [df.shape[0] for _,df,_ in ezpubmed.prepare_xml_files(xml_files,n_workers=n)])
+        serial = serial or dt
+        print("[ BENCH ]: prepare n_workers=%2i %8.2fs %10.0f papers/s  x%4.2f"
+              % (n,dt,n_files*n_articles/dt,serial/dt))
+
+def bench_memory(n_articles=30000):
+    """Peak RSS of a full single-file ingest, whole-file parsing vs. streaming"""
+    xml_path = make_dataset().xml_path
+    write_synthetic_xml(os.path.join(xml_path,"pubmed21n0001.xml"),range(1,n_articles+1))
+    size = os.path.getsize(os.path.join(xml_path,"pubmed21n0001.xml"))/1024**2
+    print("XML: %i articles (%.0f MB)" % (n_articles,size))
+    print("[ BENCH ]: baseline process        %8.0f MB" % peak_rss(lambda: None))
+    for streaming in (False,True):
+        label = "streaming" if streaming else "whole file"
+        dt,rss = timed(peak_rss,_ingest,streaming)
+        print("[ BENCH ]: ingest %-16s %8.0f MB peak  %8.2fs" % (label,rss,dt))
+    os.remove(os.path.join(xml_path,"pubmed21n0001.xml"))
+
+def legacy_append_dateinfo(papers):
+    """utils.append_dateinfo before dates were normalized in bulk"""
+    papers['pubdate'] = papers['pubdate'].apply(utils.parse_dates)
+    papers = papers.sort_values('pubdate')
+    papers['pubyear'] = papers['pubdate'].apply(lambda x: x.year)
+    papers['pubmonth'] = papers['pubdate'].apply(lambda x: x.month)
+    papers['pubday'] = papers['pubdate'].apply(lambda x: x.day)
+    return papers
+
+def synthetic_dates(n,seed=0):
+    """pubdate strings as produced by pubmed_parser, plus a few it should never produce"""
+    rng = np.random.default_rng(seed)
+    years = rng.integers(1900,2022,n).astype(str)
+    months = np.char.zfill(rng.integers(1,13,n).astype(str),2)
+    days = np.char.zfill(rng.integers(1,29,n).astype(str),2)
+    kind = rng.integers(0,3,n)
+    dates = np.where(kind == 0,years,np.char.add(np.char.add(years,"-"),months))
+    dates = np.where(kind == 2,np.char.add(np.char.add(dates,"-"),days),dates)
+    odd = ["","2015-02-30","2016-02","2015-3","Spring 2015","2015-00"]
+    return pd.Series(np.concatenate([dates,odd]),dtype=object)
+
+def bench_dates(n=30000):
+    """append_dateinfo on one file's worth of dates, checked against the per-row dateparser version"""
+    dates = synthetic_dates(n)
+    with quiet():
+        dt_old,old = timed(legacy_append_dateinfo,pd.DataFrame({'pubdate':dates}))
+        dt_new,new = timed(utils.append_dateinfo,pd.DataFrame({'pubdate':dates}))
+    old = utils.fix_dtypes(old.reindex(columns=list(new.columns)+['title','abstract','journal','authors','doi'],fill_value=''))
+    new = utils.fix_dtypes(new.reindex(columns=old.columns,fill_value=''))
+    pd.testing.assert_frame_equal(old,new,check_dtype=False)
+    print("[ BENCH ]: dates dateparser %8.2fs %10.0f rows/s" % (dt_old,len(dates)/dt_old))
+    print("[ BENCH ]: dates vectorized %8.2fs %10.0f rows/s  x%.0f (outputs identical)" % (dt_new,len(dates)/dt_new,dt_old/dt_new))
+
+def _placeholder_row(pmid,today=datetime.date.today()):
+    # spread papers over 1950-2021 and 5000 journals, with one in a thousand
+    # published within the last 30 days
+    if pmid % 1000 == 0:
+        date = today - datetime.timedelta(days=pmid//1000 % 30)
+    else:
+        date = datetime.date(1950 + pmid % 72,1 + pmid // 72 % 12,1 + pmid // 7 % 28)
+    row = dict(pmid=pmid,title="Title %i" % pmid,abstract="Abstract",journal="Journal %i" % (pmid % 5000),
+               pubdate=date.isoformat(),pubyear=date.year,pubmonth=date.month,pubday=date.day,
+               delete=0,pmc=0,nlm_unique_id=0)
+    return [row.get(f,"") for f in db.fields]
+
+def fill_papers(n_rows,start_pmid=1,batch_size=100000):
+    """Bulk load n_rows placeholder papers straight through sqlite3"""
+    conn = sqlite3.connect(config.papers_db)
+    sql = "INSERT INTO paperdb (%s) VALUES (%s)" % (",".join('"%s"' % f for f in db.fields),",".join("?"*len(db.fields)))
+    with conn:
+        for idx in range(start_pmid,start_pmid+n_rows,batch_size):
+            stop = min(idx+batch_size,start_pmid+n_rows)
+            conn.executemany(sql,(_placeholder_row(pmid) for pmid in range(idx,stop)))
+    conn.close()
+
+def _pmid_scan(lpmids):
+    # what update_db used to do before processing the first file
+    q = db.PaperDB.select(db.PaperDB.pmid)
+    current_pmids = list(pd.DataFrame(list(q.dicts()))['pmid'])
+    update_pmid = utils.intersection(lpmids,current_pmids)
+    new_pmid = np.setdiff1d(lpmids,current_pmids)
+    current_pmids.extend(lpmids)
+
+def _pmid_lookup(lpmids):
+    update_pmid = db.existing_pmids(lpmids)
+    new_pmid = np.setdiff1d(lpmids,update_pmid)
+
+def bench_pmids(n_rows=3000000,n_file=30000):
+    """Splitting one file into new/updated papers: full PMID scan vs. indexed lookup"""
+    with quiet():
+        db.reset_db()
+    dt,_ = timed(fill_papers,n_rows)
+    print("Database: %i rows (loaded in %.1fs)" % (n_rows,dt))
+    # a file where half the papers are revisions
+    lpmids = list(range(n_rows-n_file//2+1,n_rows+n_file//2+1))
+    for label,fn in (("full scan",_pmid_scan),("lookup",_pmid_lookup)):
+        dt,rss = timed(peak_rss,fn,lpmids)
+        print("[ BENCH ]: pmids %-10s %8.2fs %8.0f MB peak" % (label,dt,rss))
+
+def bench_upsert(n_articles=30000):
+    """Write one prepared file into an empty database, then again as revisions"""
+    with quiet():
+        db.reset_db()
+        dataset = make_dataset()
+        write_synthetic_xml(os.path.join(bench_path,"upsert.xml"),range(1,n_articles+1))
+        _,df,_ = ezpubmed.prepare_xml(os.path.join(bench_path,"upsert.xml"))
+    for label in ("insert","update"):
+        with quiet():
+            dt,_ = timed(dataset.write_papers,df)
+        print("[ BENCH ]: write %-7s %8.2fs %10.0f papers/s" % (label,dt,df.shape[0]/dt))
+
+def legacy_bulk_update(df):
+    """Dataset.write_papers' update path before db.update_papers"""
+    update_instances = [db.PaperDB(**u) for u in df.to_dict('records')]
+    with db.PaperDB._meta.database.atomic():
+        db.PaperDB.bulk_update(update_instances,fields=db.fields,batch_size=1000)
+
+def bench_update(n_articles=20000,frac_changed=0.1):
+    """Apply a file of revisions (frac_changed of them with a new title) to existing papers"""
+    with quiet():
+        db.reset_db()
+        write_synthetic_xml(os.path.join(bench_path,"update.xml"),range(1,n_articles+1))
+        _,df,_ = ezpubmed.prepare_xml(os.path.join(bench_path,"update.xml"))
+        db.upsert_papers(df.to_dict('records'))
+    revised = df.copy()
+    n_changed = int(n_articles*frac_changed)
+    revised.iloc[:n_changed,revised.columns.get_loc('title')] = "Revised title"
+    dt_old,_ = timed(legacy_bulk_update,revised)
+    dt_new,changed = timed(db.update_papers,revised)
+    assert changed == {'title':n_changed}, changed
+    print("[ BENCH ]: update bulk_update    %8.2fs %10.0f papers/s" % (dt_old,n_articles/dt_old))
+    print("[ BENCH ]: update update_papers  %8.2fs %10.0f papers/s  x%.0f" % (dt_new,n_articles/dt_new,dt_old/dt_new))
+
+class _QueryLog(logging.Handler):
+    """Collect the (sql, params) peewee logs for every query it runs"""
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.queries = []
+    def emit(self,record):
+        if isinstance(record.msg,tuple):
+            self.queries.append(record.msg)
+
+def explain(fn,*args):
+    """Run fn and return its run time and the query plan of the last query it made"""
+    log = _QueryLog()
+    logger = logging.getLogger('peewee')
+    logger.addHandler(log)
+    logger.setLevel(logging.DEBUG)
+    try:
+        dt,_ = timed(fn,*args)
+    finally:
+        logger.removeHandler(log)
+    sql,params = log.queries[-1]
+    plan = db.PaperDB._meta.database.execute_sql('EXPLAIN QUERY PLAN ' + sql,params).fetchall()
+    return dt," / ".join(row[-1] for row in plan)
+
+def bench_queries(n_rows=2000000):
+    """Query plans and timings of the utils_pubs loaders without and with the secondary indexes"""
+    with quiet():
+        db.reset_db()
+    db.drop_secondary_indexes()
+    dt,_ = timed(fill_papers,n_rows)
+    print("Database: %i rows (loaded in %.1fs)" % (n_rows,dt))
+    loaders = [('load_today',()),('load_this_week',()),('load_this_month',()),
+               ('load_year',(2015,)),('load_between_years',(2010,2012))]
+    for label in ("no index","indexed"):
+        if label == "indexed":
+            dt,_ = timed(db.create_indexes)
+            print("[ BENCH ]: create_indexes %8.2fs" % dt)
+        for name,args in loaders:
+            dt,plan = explain(getattr(utils_pubs,name),db,*args)
+            print("[ BENCH ]: %-8s %-18s %8.3fs  %s" % (label,name,dt,plan))
+
+def _load_dicts(y1,y2):
+    # what every utils_pubs loader used to do
+    q = db.PaperDB.select().where(db.PaperDB.pubyear.between(y1,y2))
+    return pd.DataFrame(list(q.dicts())).shape[0]
+
+def _load_frame(y1,y2,columns=None):
+    return utils_pubs.load_between_years(db,y1,y2,columns).shape[0]
+
+def _load_chunks(y1,y2,columns=None):
+    return sum(df.shape[0] for df in utils_pubs.iter_between_years(db,y1,y2,columns))
+
+def bench_loaders(n_rows=2000000,years=(1950,2021)):
+    """Peak RSS and rows/s of the utils_pubs loaders over the whole synthetic database"""
+    with quiet():
+        db.reset_db()
+    fill_papers(n_rows)
+    print("Database: %i rows" % n_rows)
+    no_text = [f for f in db.fields if f not in ('abstract','affiliations')]
+    runs = [("dicts (old)",_load_dicts,()),("frame",_load_frame,()),("chunks",_load_chunks,()),
+            ("frame, no text",_load_frame,(no_text,)),("chunks, no text",_load_chunks,(no_text,))]
+    for label,fn,args in runs:
+        dt,rss = timed(peak_rss,fn,*(years+args))
+        print("[ BENCH ]: load %-16s %8.2fs %10.0f rows/s %8.0f MB peak" % (label,dt,n_rows/dt,rss))
+
+def bench_parquet(n_rows=2000000,years=(2000,2009)):
+    """Export the synthetic database to the Parquet mirror and compare scans of a decade"""
+    with quiet():
+        db.reset_db()
+    fill_papers(n_rows)
+    print("Database: %i rows" % n_rows)
+    with quiet():
+        dt,_ = timed(utils_parquet.export_years,db)
+    print("[ BENCH ]: parquet export all years %8.2fs" % dt)
+    with quiet():
+        dt,_ = timed(utils_parquet.export_years,db,[2015])
+    print("[ BENCH ]: parquet export one year  %8.2fs" % dt)
+    assert utils_parquet.stale_years(db) == []
+
+    # papers of a year revised by a run that failed before its export: found stale from the generations alone
+    revised = utils_pubs.load_year(db,2016).head(100)
+    revised['title'] = revised['title'] + " (revised)"
+    revised['pubdate'] = revised['pubdate'].dt.strftime('%Y-%m-%d')
+    db.update_papers(revised[db.fields])
+    assert utils_parquet.stale_years(db) == [2016]
+    with quiet():
+        dt,exported = timed(utils_parquet.update_mirror,db)
+    assert exported == [2016] and utils_parquet.stale_years(db) == []
+    assert utils_parquet.load_year(2016)['title'].str.endswith("(revised)").sum() == 100
+    print("[ BENCH ]: parquet update_mirror    %8.2fs (1 stale year)" % dt)
+
+    columns = ['pmid','title','abstract']
+    runs = [("sqlite",lambda: utils_pubs.load_between_years(db,*years,columns=columns)),
+            ("parquet",lambda: utils_parquet.load_between_years(*years,columns=columns)),
+            ("sqlite, Feb",lambda: utils_pubs.load_papers(
+                utils_pubs.query_between_years(db,*years,columns=columns).where(db.PaperDB.pubmonth == 2))),
+            ("parquet, Feb",lambda: utils_parquet.load_between_years(*years,columns=columns,filters=[('pubmonth','==',2)]))]
+    for label,fn in runs:
+        dt,df = timed(fn)
+        print("[ BENCH ]: scan %i-%i %-14s %8.3fs %8i rows" % (years+(label,dt,df.shape[0])))
+
+def ftp_server(root,bytes_per_sec=None):
+    """Serve root over anonymous FTP on localhost from a background thread (needs pyftpdlib)"""
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    # write_limit throttles what the server sends, i.e. our downloads
+    dtp = type("DTPHandler",(ThrottledDTPHandler,),{'write_limit':bytes_per_sec or 0})
+    handler = type("Handler",(FTPHandler,),{'authorizer':authorizer,'dtp_handler':dtp,'use_sendfile':False})
+    # a handler on the logger stops pyftpdlib from installing its own stderr logging
+    logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    server = ThreadedFTPServer(("127.0.0.1",0),handler)
+    threading.Thread(target=server.serve_forever,kwargs={'handle_exit':False},daemon=True).start()
+    return server
+
+def bench_download(n_files=4,n_articles=8000,bytes_per_sec=512*1024,n_workers=(1,4)):
+    """Download gzipped files with md5 sidecars from a throttled local FTP server"""
+    remote = os.path.join(bench_path,"ftp","pubmed","updatefiles")
+    for xml in make_corpus(remote,n_files,n_articles):
+        with open(xml,"rb") as fin, gzip.open(xml + ".gz","wb") as fout:
+            shutil.copyfileobj(fin,fout)
+        os.remove(xml)
+        with open(xml + ".gz.md5","w") as f:
+            f.write("MD5(%s.gz)= %s\n" % (os.path.basename(xml),utils_ftp.file_md5(xml + ".gz")))
+    names = sorted(f for f in os.listdir(remote) if f.endswith(".xml.gz"))
+    size = sum(os.path.getsize(os.path.join(remote,f)) for f in names)/1024**2
+    print("Server: %i files, %.1f MB, throttled to %.1f MB/s per connection" % (n_files,size,bytes_per_sec/1024**2))
+    server = ftp_server(os.path.join(bench_path,"ftp"),bytes_per_sec)
+    host,port = server.address
+    try:
+        for n in n_workers:
+            local = os.path.join(bench_path,"download%i" % n)
+            downloader = utils_ftp.FTPDownloader(host,"/pubmed/updatefiles/",local,n_workers=n,port=port)
+            with quiet():
+                downloader.list_files()
+                dt,(done,failed) = timed(downloader.download_all,names)
+            assert len(done) == n_files and not failed
+            print("[ BENCH ]: download n_workers=%i %8.2fs %8.2f MB/s" % (n,dt,size/dt))
+
+        # resume a truncated transfer, and reject a file that doesn't match its sidecar
+        name = names[0]
+        with open(os.path.join(remote,name),"rb") as f:
+            data = f.read()
+        os.remove(os.path.join(local,name))
+        with open(os.path.join(local,name + ".part"),"wb") as f:
+            f.write(data[:len(data)//2])
+        with open(os.path.join(remote,names[1] + ".md5"),"w") as f:
+            f.write("MD5(%s)= %s\n" % (names[1],"0"*32))
+        os.remove(os.path.join(local,names[1]))
+        # a single attempt, so the resumed file can only pass the md5 check if REST worked
+        downloader = utils_ftp.FTPDownloader(host,"/pubmed/updatefiles/",local,retries=1,port=port)
+        with quiet():
+            downloader.list_files()
+            done,failed = downloader.download_all(names[:2])
+        assert utils_ftp.file_md5(os.path.join(local,name)) == hashlib.md5(data).hexdigest()
+        assert list(failed) == [names[1]] and not os.path.exists(os.path.join(local,names[1]))
+        print("[ BENCH ]: download resume and md5 checks ok")
+    finally:
+        server.close_all()
+
+def _gzip_copy(fname):
+    with open(fname,"rb") as src, gzip.open(fname + ".gz","wb") as dst:
+        shutil.copyfileobj(src,dst)
+    return fname + ".gz"
+
+def bench_gzip(n_files=4,n_articles=8000):
+    """Parse time of gunzip-to-disk then parse vs. parsing the .xml.gz directly"""
+    path = os.path.join(bench_path,"gzip")
+    gz_files = [_gzip_copy(f) for f in make_corpus(path,n_files,n_articles)]
+    for f in gz_files:
+        os.remove(f[:-len(".gz")])
+    xml_size = sum(os.path.getsize(f) for f in gz_files)/1024**2
+    print("Corpus: %i files x %i articles (%.0f MB gzipped)" % (n_files,n_articles,xml_size))
+    def unzip_then_parse():
+        for f in gz_files:
+            shutil.copy(f,f + ".bak")
+            utils.gunzip(f)
+            n = sum(len(b) for b in utils.iter_medline_xml(f[:-len(".gz")]))
+            os.replace(f + ".bak",f)
+            os.remove(f[:-len(".gz")])
+    def parse_gz():
+        for f in gz_files:
+            n = sum(len(b) for b in utils.iter_medline_xml(f))
+    for label,fn in (("gunzip + parse",unzip_then_parse),("parse .xml.gz",parse_gz)):
+        dt,_ = timed(fn)
+        print("[ BENCH ]: %-16s %8.2fs %10.0f papers/s" % (label,dt,n_files*n_articles/dt))
+    with quiet():
+        dt,dfs = timed(lambda: [df for _,df,_ in ezpubmed.prepare_xml_files(gz_files,n_workers=1)])
+    print("[ BENCH ]: prepare .xml.gz   %8.2fs %10i papers" % (dt,sum(df.shape[0] for df in dfs)))
+
+def legacy_track(xml_files,n_done):
+    """Dataset.update_db's completed-file bookkeeping before the ingest ledger"""
+    path = os.path.join(bench_path,"updates_so_far.csv")
+    current_xml_list = xml_files[:n_done]
+    pd.DataFrame(current_xml_list,columns=['Filename']).to_csv(path)
+    xml_done = pd.read_csv(path,index_col=0)
+    xml_update = [f for f in xml_files if f not in list(xml_done['Filename'])]
+    for xml in xml_update:
+        current_xml_list.append(xml)
+        pd.DataFrame(current_xml_list,columns=['Filename']).to_csv(path)
+
+def ledger_track(xml_files,n_done):
+    with quiet():
+        dataset = make_dataset()
+    with db.BaseModel._meta.database.atomic():
+        for xml in xml_files[:n_done]:
+            db.IngestFile.create(filename=xml,datatype="baseline")
+    dataset.get_completed_list()
+    xml_update = [f for f in xml_files if utils.xml_key(f) not in dataset.xml_done_keys]
+    for xml in xml_update:
+        with db.BaseModel._meta.database.atomic():
+            db.IngestFile.create(filename=xml,datatype="baseline",size=0,md5="")
+
+def bench_ledger(n_files=(1000,4000),n_new=1000):
+    """Completed-file bookkeeping: CSV rewrite + list scans vs. the ingest ledger"""
+    for n in n_files:
+        xml_files = ["pubmed21n%04i.xml" % (i+1) for i in range(n+n_new)]
+        dt_old,_ = timed(legacy_track,xml_files,n)
+        dt_new,_ = timed(ledger_track,xml_files,n)
+        print("[ BENCH ]: ledger %5i done + %i new  csv %8.2fs  ledger %6.2fs  x%.0f" % (n,n_new,dt_old,dt_new,dt_old/dt_new))
+
+def bench_metrics(n=200000,n_articles=20000):
+    """Overhead of a metrics stage when disabled/enabled, and of a full ingest with metrics on"""
+    for m in (metrics.NullMetrics(),metrics.Metrics()):
+        def loop():
+            for i in range(n):
+                with m.stage('noop',1):
+                    pass
+        dt,_ = timed(loop)
+        print("[ BENCH ]: metrics %-12s %8.2f us/stage" % (type(m).__name__,dt/n*1e6))
+    write_synthetic_xml(os.path.join(bench_path,"metrics.xml"),range(1,n_articles+1))
+    for enabled in (False,True):
+        def ingest():
+            with quiet():
+                db.reset_db()
+                dataset = make_dataset()
+                dataset.metrics = metrics.get_metrics(enabled,path=None)
+                shutil.copy(os.path.join(bench_path,"metrics.xml"),dataset.xml_path)
+                dataset.update_db(n_workers=1)
+            os.remove(os.path.join(dataset.xml_path,"metrics.xml"))
+        dt,_ = timed(ingest)
+        print("[ BENCH ]: ingest metrics=%-5s   %8.2fs" % (enabled,dt))
+
+def fill_text_papers(n_rows,start_pmid=1,seed=0,vocab_size=50000,batch_size=50000):
+    """fill_papers with Zipf-distributed words in the full-text columns"""
+    rng = np.random.default_rng(seed)
+    vocab = np.array(words + ["term%05i" % i for i in range(vocab_size)])
+    def text(n):
+        return " ".join(vocab[np.minimum(rng.zipf(1.3,n),len(vocab))-1])
+    conn = sqlite3.connect(config.papers_db)
+    sql = "INSERT INTO paperdb (%s) VALUES (%s)" % (",".join('"%s"' % f for f in db.fields),",".join("?"*len(db.fields)))
+    columns = {f: db.fields.index(f) for f in db.fts_fields + ['authors']}
+    def rows(pmids):
+        for pmid in pmids:
+            row = _placeholder_row(pmid)
+            row[columns['title']] = text(12)
+            row[columns['abstract']] = text(150)
+            # one common descriptor, one in ~1/300 and one in ~1/5000 of papers
+            row[columns['mesh_terms']] = "; ".join(["%s:%s" % mesh[pmid % len(mesh)]] +
+                                                   ["D9%05i:Term %i" % (k,k) for k in (pmid*31 % 300,300 + pmid % 5000)])
+            row[columns['keywords']] = text(4)
+            row[columns['authors']] = ";".join("Author%i|A|A|" % ((pmid*(i+3)) % 20000) for i in range(1+pmid % 8))
+            row[columns['affiliations']] = ";".join("Department %i, University %i." % ((pmid+i) % 50,(pmid*(i+1)) % 500)
+                                                    for i in range(1+pmid % 6))
+            yield row
+    with conn:
+        for idx in range(start_pmid,start_pmid+n_rows,batch_size):
+            conn.executemany(sql,rows(range(idx,min(idx+batch_size,start_pmid+n_rows))))
+    conn.close()
+
+def _latency(fn,*args,repeat=20):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter()-t0)
+    return np.median(times)*1000
+
+def bench_fts(n_rows=200000,n_new=20000):
+    """Build time, incremental (trigger) cost and query latency of the full-text index"""
+    db.reset_db()
+    dt,_ = timed(fill_text_papers,n_rows)
+    size = os.path.getsize(config.papers_db)/1024**2
+    print("Papers: %i (%.0f MB, filled in %.1fs)" % (n_rows,size,dt))
+    dt,_ = timed(db.create_fts)
+    db.BaseModel._meta.database.execute_sql("VACUUM")
+    fts_size = os.path.getsize(config.papers_db)/1024**2 - size
+    print("[ BENCH ]: fts build        %8.2fs %10.0f papers/s  +%.0f MB" % (dt,n_rows/dt,fts_size))
+    results = {'build': {'seconds': dt,'rows': n_rows,'rows_per_s': n_rows/dt,'size_mb': fts_size}}
+
+    new_rows = [dict(zip(db.fields,row)) for row in map(_placeholder_row,range(n_rows+1,n_rows+2*n_new+1))]
+    for f in db.fts_fields:
+        for i,row in enumerate(new_rows):
+            row[f] = " ".join(words[(i*7+j) % len(words)] for j in range(20))
+    db.drop_fts_triggers()
+    dt_off,_ = timed(db.upsert_papers,new_rows[:n_new])
+    db.create_fts_triggers()
+    dt_on,_ = timed(db.upsert_papers,new_rows[n_new:])
+    print("[ BENCH ]: fts insert %6i papers without triggers %6.2fs, with %6.2fs (+%.0f us/paper)"
+          % (n_new,dt_off,dt_on,(dt_on-dt_off)/n_new*1e6))
+    results['insert'] = {'seconds': dt_on,'rows': n_new,'rows_per_s': n_new/dt_on}
+
+    queries = [("rare term","term40000"),("common term","term00010"),("two terms","term00100 AND term00200"),
+               ("phrase",'"term00003 term00004"'),("column","title:term00050"),("mesh","mesh_terms:diabetes")]
+    for label,query in queries:
+        n = utils_pubs.search_count(db,query)
+        ms = _latency(utils_pubs.search,db,query)
+        ms_page = _latency(utils_pubs.search,db,query,['pmid','title','journal','pubdate'],20,1000)
+        print("[ BENCH ]: fts %-12s %8i hits %8.1f ms first page %8.1f ms offset 1000" % (label,n,ms,ms_page))
+        results[label] = {'hits': n,'ms': ms,'ms_offset_1000': ms_page}
+    hits = utils_pubs.search(db,"term00100 AND term00200",limit=3)
+    assert all(("term00100" in t or "term00200" in t) for t in hits['snippet'] + hits['title'])
+
+    def legacy(term):
+        papers = utils_pubs.load_all(db,['pmid','title','abstract'])
+        return papers[papers['title'].str.contains(term) | papers['abstract'].str.contains(term)]
+    dt,_ = timed(legacy,"term40000")
+    print("[ BENCH ]: load_all + str.contains   %8.1f ms" % (dt*1000))
+    results['legacy_contains'] = {'ms': dt*1000}
+    return results
+
+def bench_normalized(n_rows=200000,n_articles=20000):
+    """Normalized author/MeSH/affiliation tables: build time, ingest overhead and lookups vs. string scans"""
+    db.reset_db()
+    fill_text_papers(n_rows)
+    db.PaperDB._meta.database.create_tables(db.normalized_tables)
+    with quiet():
+        dt,_ = timed(db.build_normalized)
+    print("[ BENCH ]: normalized build   %8.2fs %10.0f papers/s" % (dt,n_rows/dt))
+    results = {'build': {'seconds': dt,'rows': n_rows,'rows_per_s': n_rows/dt}}
+
+    def legacy_mesh(ui,y1,y2):
+        papers = utils_pubs.load_between_years(db,y1,y2,['pmid','mesh_terms'])
+        return papers[papers['mesh_terms'].str.contains(ui)]
+    def legacy_affiliation(name):
+        papers = utils_pubs.load_all(db,['pmid','affiliations'])
+        return papers[papers['affiliations'].str.split(";").apply(utils_pubs.check_first_last_affiliation,args=(name,))]
+    lookups = [("mesh 1990-2020",legacy_mesh,("D900042",1990,2020),
+                lambda: utils_pubs.load_mesh(db,"D900042",1990,2020,['pmid','mesh_terms'])),
+               ("first/last aff",legacy_affiliation,("University 13.",),
+                lambda: utils_pubs.load_affiliation(db,"University 13.",columns=['pmid','affiliations']))]
+    for label,legacy,args,indexed in lookups:
+        dt_old,old = timed(legacy,*args)
+        dt_new,new = timed(indexed)
+        assert sorted(old['pmid']) == sorted(new['pmid'])
+        print("[ BENCH ]: %-16s %8i papers  scan %8.3fs  indexed %8.3fs  x%.0f" % (label,len(new),dt_old,dt_new,dt_old/dt_new))
+        results[label] = {'papers': len(new),'scan_s': dt_old,'indexed_s': dt_new}
+
+    write_synthetic_xml(os.path.join(bench_path,"normalized.xml"),range(10**7,10**7+n_articles),n_affiliations=(0,2))
+    _,df,_ = ezpubmed.prepare_xml(os.path.join(bench_path,"normalized.xml"))
+    for normalized in (False,True):
+        config.normalized = normalized
+        dataset = make_dataset()
+        db.PaperDB._meta.database.execute_sql("DELETE FROM paperdb WHERE pmid >= ?",(10**7,))
+        with quiet():
+            dt,_ = timed(dataset.write_papers,df)
+        print("[ BENCH ]: write %i papers normalized=%-5s %8.2fs" % (n_articles,normalized,dt))
+        results['write_normalized_%s' % normalized] = {'seconds': dt,'rows': n_articles}
+    config.normalized = False
+    return results
+
+def bench_vectors(n_papers=500000,dim=200,n_lookup=10000,n_revised=20000):
+    """EmbeddingStore: bulk load, PMID lookups, year slices and in-place revisions"""
+    rng = np.random.default_rng(0)
+    store = utils_vectors.EmbeddingStore(os.path.join(bench_path,"vectors"),dim=dim)
+    pmids = rng.permutation(np.arange(1,3*n_papers,3))[:n_papers]
+    years = 1950 + pmids % 72
+    def load():
+        for year in np.unique(years):
+            sel = years == year
+            store.put(pmids[sel],year,rng.standard_normal((sel.sum(),dim),dtype='float32'),reindex=False)
+        store.reindex()
+    dt,_ = timed(load)
+    size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(store.path,"*")))/1024**2
+    print("[ BENCH ]: vectors load %i x %i  %8.2fs %10.0f vectors/s  %6.0f MB" % (n_papers,dim,dt,n_papers/dt,size))
+    results = {'load': {'seconds': dt,'rows': n_papers,'rows_per_s': n_papers/dt}}
+
+    store = utils_vectors.EmbeddingStore(store.path)
+    query = rng.choice(pmids,n_lookup)
+    dt,(vectors,found) = timed(store.get,query)
+    assert found.all()
+    print("[ BENCH ]: vectors get %i random PMIDs %8.1f ms" % (n_lookup,dt*1000))
+    dt,_ = timed(store.lookup,query[:1])
+    print("[ BENCH ]: vectors lookup 1 PMID      %8.3f ms" % (dt*1000))
+    results['get'] = {'seconds': dt,'rows': n_lookup}
+
+    dt,(year_pmids,year_vectors) = timed(store.year,int(years[0]))
+    dt_sum,_ = timed(lambda: np.asarray(year_vectors).sum(axis=0))
+    print("[ BENCH ]: vectors year slice (%i)   %8.1f ms open %8.1f ms scan" % (len(year_pmids),dt*1000,dt_sum*1000))
+    results['year'] = {'seconds': dt,'scan_seconds': dt_sum,'rows': len(year_pmids)}
+
+    revised = rng.choice(pmids,n_revised,replace=False)
+    new_vectors = rng.standard_normal((n_revised,dim),dtype='float32')
+    dt,(added,overwritten) = timed(store.put,revised,1950 + revised % 72,new_vectors)
+    assert (added,overwritten) == (0,n_revised) and np.allclose(store.get(revised)[0],new_vectors)
+    print("[ BENCH ]: vectors overwrite %i    %8.2fs (incl. reindex)" % (n_revised,dt))
+    results['overwrite'] = {'seconds': dt,'rows': n_revised}
+
+    # a put interrupted after appending its vectors: the orphan rows must not shift the next append
+    year = int(years[0])
+    with open(os.path.join(store.path,"%i.vec" % year),"ab") as f:
+        f.write(np.full((3,dim),9,dtype='float32').tobytes())
+    new_vectors = rng.standard_normal((2,dim),dtype='float32')
+    store.put([3*n_papers,3*n_papers+1],year,new_vectors)
+    assert np.allclose(store.get([3*n_papers,3*n_papers+1])[0],new_vectors)
+    rss = peak_rss(lambda: np.asarray(utils_vectors.EmbeddingStore(store.path).get(query)[0]).sum())
+    print("[ BENCH ]: vectors open + get peak RSS %6.0f MB (process baseline %.0f MB, store %.0f MB)"
+          % (rss,peak_rss(lambda: None),size))
+    return results
+
+def bench_similarity(sizes=(1000000,10000000),dim=200,k=100,n_batch=100,dtype='float16',chunk=1000000):
+    """Top-k cosine search over a normalized EmbeddingStore: one centroid and a batch of queries
+
+    Pass sizes=(..., 35000000) for a full MEDLINE sized store (~14 GB of float16 on disk).
+    """
+    import utils_nlp
+    import utils_sim
+    rng = np.random.default_rng(0)
+    results = {}
+
+    # the old per-row pandas path, on a slice small enough to wait for
+    vectors = pd.DataFrame(rng.standard_normal((100000,dim),dtype='float32'))
+    query = rng.standard_normal(dim,dtype='float32')
+    dt_old,old = timed(lambda: vectors.dot(query)/(vectors.apply(np.linalg.norm,axis=1)*np.linalg.norm(query)))
+    dt_new,new = timed(utils_nlp.cosine_similarity,query,vectors)
+    assert np.allclose(old,new,atol=1e-5)
+    print("[ BENCH ]: cosine 1 x %i   apply %8.3fs  vectorized %8.3fs  x%.0f" % (len(vectors),dt_old,dt_new,dt_old/dt_new))
+    results['cosine'] = {'seconds': dt_new,'legacy_seconds': dt_old,'rows': len(vectors)}
+    del vectors
+
+    for n in sizes:
+        path = os.path.join(bench_path,"similarity")
+        shutil.rmtree(path,ignore_errors=True)
+        store = utils_vectors.EmbeddingStore(path,dim=dim,dtype=dtype,normalized=True)
+        def load():
+            for start in range(0,n,chunk):
+                pmids = np.arange(start,min(start+chunk,n))
+                store.put(pmids,1950 + pmids % 72,rng.standard_normal((len(pmids),dim),dtype='float32'),reindex=False)
+            store.reindex()
+        dt,_ = timed(load)
+        print("[ BENCH ]: similarity load %i x %i %s %8.1fs" % (n,dim,dtype,dt))
+        library = rng.standard_normal((50,dim),dtype='float32')
+        queries = rng.standard_normal((n_batch,dim),dtype='float32')
+        dt_one,top = timed(utils_sim.recommend,store,library,k)
+        dt_batch,top_batch = timed(utils_sim.search_store,store,queries,k)
+        assert len(top) == k and len(top_batch) == n_batch*k
+        if n <= chunk:
+            # exact ranking of the whole store for comparison
+            all_pmids = np.concatenate([store.year_pmids(y) for y in store.years()])
+            all_vectors = np.concatenate([np.asarray(store.year_vectors(y),dtype='float32') for y in store.years()])
+            exact = all_pmids[np.argsort(-(all_vectors @ utils_sim.centroid(library)[0]))[:k]]
+            assert (top['pmid'].values == exact).mean() > 0.99
+        print("[ BENCH ]: similarity %9i papers  centroid %8.3fs  %3i queries %8.2fs %8.1f queries/s"
+              % (n,dt_one,n_batch,dt_batch,n_batch/dt_batch))
+        results[n] = {'seconds': dt_batch,'centroid_seconds': dt_one,'load_seconds': dt,'rows': n,
+                      'queries_per_s': n_batch/dt_batch,'rss_mb': metrics.peak_rss()}
+        del store
+        shutil.rmtree(path,ignore_errors=True)
+    return results
+
+def clustered_vectors(rng,n,dim=200,n_topics=2000,spread=1.0):
+    """Unit vectors scattered around n_topics random directions, like embeddings of related papers"""
+    topics = rng.standard_normal((n_topics,dim),dtype='float32')
+    topics /= np.linalg.norm(topics,axis=1,keepdims=True)
+    vectors = topics[rng.integers(0,n_topics,n)] + spread/np.sqrt(dim)*rng.standard_normal((n,dim),dtype='float32')
+    return vectors/np.linalg.norm(vectors,axis=1,keepdims=True)
+
+def bench_ann(n_papers=1000000,dim=200,k=10,n_queries=200,nprobes=(1,4,16,64),n_new=20000,n_topics=2000,spread=1.0,
+              chunk=1000000):
+    """IVF index: build time, recall@k and latency against exact search for several nprobe
+
+    Raise n_topics/spread for less clustered (harder) vectors.
+    """
+    import utils_ann
+    import utils_sim
+    rng = np.random.default_rng(0)
+    path = os.path.join(bench_path,"ann_store")
+    shutil.rmtree(path,ignore_errors=True)
+    store = utils_vectors.EmbeddingStore(path,dim=dim,dtype='float16',normalized=True)
+    for start in range(0,n_papers,chunk):
+        pmids = np.arange(start,min(start+chunk,n_papers))
+        store.put(pmids,1950 + pmids % 72,clustered_vectors(rng,len(pmids),dim,n_topics,spread),reindex=False)
+    store.reindex()
+
+    index = utils_ann.IVFIndex(os.path.join(bench_path,"ann"))
+    with quiet():
+        dt,_ = timed(index.build,store)
+    print("[ BENCH ]: ann build %i x %i (%i lists) %8.1fs" % (n_papers,dim,index.meta['n_lists'],dt))
+    results = {'build': {'seconds': dt,'rows': n_papers,'rows_per_s': n_papers/dt}}
+
+    # queries near (but not equal to) stored papers
+    queries = store.get(rng.choice(n_papers,n_queries,replace=False))[0].astype('float32')
+    queries += 0.3/np.sqrt(dim)*rng.standard_normal(queries.shape,dtype='float32')
+    dt_one,_ = timed(utils_sim.search_store,store,queries[:1],k)
+    dt_exact,exact = timed(utils_sim.search_store,store,queries,k)
+    exact = exact['pmid'].values.reshape(n_queries,k)
+    print("[ BENCH ]: ann exact search         %8.1f ms/query (%.1f ms for a single query)"
+          % (dt_exact/n_queries*1000,dt_one*1000))
+    results['exact'] = {'seconds': dt_exact,'rows': n_queries,'ms_per_query': dt_exact/n_queries*1000,
+                        'single_query_ms': dt_one*1000}
+    def recall(found):
+        return np.mean([len(np.intersect1d(f,e))/k for f,e in zip(found,exact)])
+    for nprobe in nprobes:
+        dt,(scores,found) = timed(index.search,queries,k,nprobe)
+        r = recall(found)
+        print("[ BENCH ]: ann nprobe %3i  recall@%i %5.3f  %8.2f ms/query  x%.0f"
+              % (nprobe,k,r,dt/n_queries*1000,dt_exact/dt))
+        results['nprobe_%i' % nprobe] = {'seconds': dt,'rows': n_queries,'recall': r,'ms_per_query': dt/n_queries*1000}
+
+    # a nightly run: new papers go to the delta segment, then compaction
+    pmids = np.arange(n_papers,n_papers+n_new)
+    vectors = clustered_vectors(rng,n_new,dim,n_topics,spread)
+    dt,_ = timed(index.add,pmids,vectors)
+    scores,found = index.search(vectors[:20],1,config.ann_nprobe)
+    assert (found[:,0] == pmids[:20]).all()
+    dt_compact,_ = timed(index.compact)
+    assert len(index) == n_papers+n_new and (index.search(vectors[:20],1,config.ann_nprobe)[1][:,0] == pmids[:20]).all()
+    print("[ BENCH ]: ann add %i %8.2fs  compact %8.1fs" % (n_new,dt,dt_compact))
+    results['add'] = {'seconds': dt,'rows': n_new,'compact_seconds': dt_compact}
+    shutil.rmtree(path,ignore_errors=True)
+    shutil.rmtree(index.path,ignore_errors=True)
+    return results
+
+def toy_nlp(dim=200,seed=0):
+    """A blank spaCy pipeline with random vectors for the generator's vocabulary (no model download)"""
+    import spacy
+    from spacy.vectors import Vectors
+    nlp = spacy.blank("en")
+    vocab = words + [w.capitalize() for w in words]
+    data = np.random.default_rng(seed).standard_normal((len(vocab),dim)).astype('float32')
+    nlp.vocab.vectors = Vectors(data=data,keys=[nlp.vocab.strings.add(w) for w in vocab])
+    return nlp
+
+def bench_incremental(n_files=4,n_articles=5000,n_metadata=2000,n_text=200):
+    """Incremental embedding after an ingest run vs. re-embedding everything"""
+    import utils_nlp
+    db.reset_db()
+    dataset = make_dataset()
+    make_corpus(dataset.xml_path,n_files,n_articles)
+    with quiet():
+        dataset.update_db(n_workers=1)
+    nlp = toy_nlp()
+    store = utils_vectors.EmbeddingStore(os.path.join(bench_path,"vectors_incremental"))
+    with quiet():
+        dt_full,(n_full,_) = timed(utils_nlp.update_embeddings_incremental,nlp=nlp,store=store)
+    print("[ BENCH ]: incremental first run  %8.2fs %8i papers embedded" % (dt_full,n_full))
+    # the store keeps the model of its first update (config.embed_model by default) and refuses another one
+    assert store.meta['model'] == config.embed_model
+    try:
+        utils_nlp.update_embeddings_incremental(model="en_core_sci_sm",nlp=nlp,store=store)
+        raise AssertionError("vectors of another model were written to the store")
+    except ValueError as e:
+        print("[ BENCH ]: incremental with another model: %s" % e)
+
+    # a nightly run revising n_metadata papers without touching their text and n_text abstracts
+    database = db.BaseModel._meta.database
+    pmids = [p for p, in database.execute_sql("SELECT pmid FROM paperdb ORDER BY random() LIMIT ?",(n_metadata+n_text,))]
+    with database.atomic():
+        for pmid in pmids[:n_metadata]:
+            database.execute_sql("UPDATE paperdb SET journal = 'Revised' WHERE pmid = ?",(pmid,))
+        for pmid in pmids[n_metadata:]:
+            database.execute_sql("UPDATE paperdb SET abstract = abstract || ' Erratum.' WHERE pmid = ?",(pmid,))
+        ingest_file = db.IngestFile.create(filename="nightly.xml",datatype="updatefiles",run=db.start_run())
+        db.log_changes(ingest_file,pmids,'updated')
+    with quiet():
+        dt_inc,(n_inc,n_skipped) = timed(utils_nlp.update_embeddings_incremental,nlp=nlp,store=store)
+    assert (n_inc,n_skipped) == (n_text,n_metadata)
+    revised = utils_pubs.load_pmids(db,pmids[n_metadata:],['pmid','title','abstract'])
+    expected = utils_nlp.embed_corpus(utils_nlp.paper_text(revised).tolist(),nlp)
+    assert np.allclose(store.get(revised['pmid'])[0],expected)
+    papers = utils_pubs.load_all(db,['pmid','title','abstract'])
+    dt_all,_ = timed(utils_nlp.embed_corpus,utils_nlp.paper_text(papers).tolist(),nlp)
+    print("[ BENCH ]: incremental nightly    %8.2fs %8i re-embedded, %i unchanged skipped" % (dt_inc,n_inc,n_skipped))
+    print("[ BENCH ]: re-embed all papers    %8.2fs %8i papers  x%.0f" % (dt_all,len(papers),dt_all/dt_inc))
+
+    # a nightly run ingested with config.log_changes off: no change rows, found by comparing hashes
+    pmids = [p for p, in database.execute_sql("SELECT pmid FROM paperdb ORDER BY random() LIMIT ?",(n_text,))]
+    with database.atomic():
+        for pmid in pmids:
+            database.execute_sql("UPDATE paperdb SET abstract = abstract || ' Retracted.' WHERE pmid = ?",(pmid,))
+        db.IngestFile.create(filename="unlogged.xml",datatype="updatefiles",run=db.start_run(),num_updated=n_text)
+    with quiet():
+        dt_scan,(n_scan,_) = timed(utils_nlp.update_embeddings_incremental,nlp=nlp,store=store)
+    assert n_scan == n_text and store.meta['last_run'] == db.last_run_id()
+    print("[ BENCH ]: incremental unlogged   %8.2fs %8i re-embedded (hash scan)" % (dt_scan,n_scan))
+    return {'first_run': {'seconds': dt_full,'rows': n_full},
+            'nightly': {'seconds': dt_inc,'rows': n_inc,'skipped': n_skipped},
+            'unlogged': {'seconds': dt_scan,'rows': n_scan},
+            'full': {'seconds': dt_all,'rows': len(papers)}}
+
+def bench_embed(n_files=4,n_articles=5000,n_workers=(1,2),shard_size=5000):
+    """Sharded update_embeddings from papers.db in docs/s, against the old per-year loop
+
+    Uses toy_nlp() saved as a local model directory so worker processes can load it.
+    """
+    import utils_nlp
+    db.reset_db()
+    dataset = make_dataset()
+    make_corpus(dataset.xml_path,n_files,n_articles)
+    with quiet():
+        dataset.update_db(n_workers=1)
+    model = os.path.join(bench_path,"toy_model")
+    nlp = toy_nlp()
+    nlp.to_disk(model)
+    papers = utils_pubs.load_all(db,['pmid','title','abstract'])
+
+    def legacy():
+        # swifter.apply (plain apply on a single core; swifter itself fails on pandas 3)
+        corpus = papers['title'] + " " + papers['abstract']
+        corpus_clean = corpus.apply(lambda t: " ".join(re.compile(r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b').findall(t)))
+        vecs = np.zeros((corpus_clean.shape[0],200))
+        for count,doc in enumerate(nlp.pipe(list(corpus_clean),batch_size=2500)):
+            vecs[count,:] = pd.Series(doc.vector)
+        return vecs
+    dt,_ = timed(legacy)
+    print("[ BENCH ]: embed legacy loop       %8.2fs %8.0f docs/s" % (dt,len(papers)/dt))
+    results = {'legacy': {'seconds': dt,'rows': len(papers),'rows_per_s': len(papers)/dt}}
+
+    expected = None
+    for n in n_workers:
+        store = utils_vectors.EmbeddingStore(os.path.join(bench_path,"vectors_embed_%i" % n),normalized=True)
+        with quiet():
+            dt,num = timed(utils_nlp.update_embeddings,model=model,n_workers=n,shard_size=shard_size,store=store)
+        assert num == len(papers)
+        vectors = store.get(papers['pmid'])[0]
+        if expected is None:
+            expected = vectors
+        assert np.allclose(vectors,expected)
+        print("[ BENCH ]: embed %i worker(s)       %8.2fs %8.0f docs/s" % (n,dt,num/dt))
+        results['workers_%i' % n] = {'seconds': dt,'rows': num,'rows_per_s': num/dt}
+
+    # an interrupted run: resume from a checkpoint half-way through
+    last_pmid = int(papers['pmid'].sort_values().iloc[len(papers)//2])
+    store.meta['embed_checkpoint'] = {'years': [None,None],'last_pmid': last_pmid}
+    store.save_meta()
+    with quiet():
+        dt,num = timed(utils_nlp.update_embeddings,model=model,n_workers=1,shard_size=shard_size,store=store)
+    assert num == (papers['pmid'] > last_pmid).sum() and len(store) == len(papers)
+    assert np.allclose(store.get(papers['pmid'])[0],expected)
+    print("[ BENCH ]: embed resumed half      %8.2fs %8i papers" % (dt,num))
+
+    # a run killed inside store.put (vectors and hashes appended, PMID file not yet saved), then resumed
+    store = utils_vectors.EmbeddingStore(os.path.join(bench_path,"vectors_embed_killed"),
+                                         dim=utils_nlp.model_dim(model),normalized=True)
+    def killed_run(n_saves=100):
+        save = utils_vectors.EmbeddingStore._save
+        count = [0]
+        def dying_save(self,name,values):
+            if name.endswith(".pmid.npy"):
+                count[0] += 1
+                if count[0] == n_saves:
+                    os._exit(1)
+            save(self,name,values)
+        utils_vectors.EmbeddingStore._save = dying_save
+        with quiet():
+            utils_nlp.update_embeddings(model=model,n_workers=1,shard_size=shard_size,store=store)
+    child = mp.get_context("fork").Process(target=killed_run)
+    child.start()
+    child.join()
+    assert child.exitcode == 1
+    store = utils_vectors.EmbeddingStore(store.path)
+    checkpoint = store.meta['embed_checkpoint']['last_pmid']
+    with quiet():
+        dt,num = timed(utils_nlp.update_embeddings,model=model,n_workers=1,shard_size=shard_size,store=store)
+    assert num == (papers['pmid'] > checkpoint).sum() and len(store) == len(papers)
+    assert np.allclose(store.get(papers['pmid'])[0],expected)
+    print("[ BENCH ]: embed killed in put, resumed after pmid %i: %i papers, vectors identical" % (checkpoint,num))
+    return results
+
+def bench_zotero(n_items=10000,n_edited=200):
+    """Zotero library embedding: old per-row path vs. a cold, warm and partly edited cache"""
+    import utils_nlp
+    rng = random.Random(0)
+    library = pd.DataFrame({'title': [_sentence(rng,8) for _ in range(n_items)],
+                            'abstract': [" ".join(_sentence(rng,12) for _ in range(6)) for _ in range(n_items)]})
+    nlp = toy_nlp()
+
+    def legacy():
+        # generate_zotero_embeddings before the cache, with nlp already loaded
+        library_df = library.copy()
+        library_vectors = pd.DataFrame(np.zeros((n_items,200)),index=library_df.index)
+        library_df['title+abstract'] = library_df['title'] + " " + library_df['abstract']
+        library_df['title+abstract+cleaned'] = library_df['title+abstract'].apply(utils_nlp.normalize_fn,nlp=nlp)
+        for counter,doc in enumerate(nlp.pipe(library_df['title+abstract+cleaned'])):
+            library_vectors.iloc[counter] = doc.vector
+            print(" >> %5i abstracts vectorized..." % counter)
+        return library_vectors
+    with quiet():
+        dt,_ = timed(legacy)
+    print("[ BENCH ]: zotero %i items legacy       %8.2fs" % (n_items,dt))
+    results = {'legacy': {'seconds': dt,'rows': n_items,'rows_per_s': n_items/dt}}
+
+    path = os.path.join(bench_path,"zotero","embeddings.npz")
+    def embed():
+        return utils_nlp.generate_zotero_embeddings(library,nlp=nlp,cache=utils_vectors.VectorCache(path))
+    with quiet():
+        dt,cold = timed(embed)
+    assert np.allclose(cold.values,utils_nlp.embed_lemmas(utils_nlp.paper_text(library).tolist(),nlp))
+    print("[ BENCH ]: zotero %i items cold cache   %8.2fs" % (n_items,dt))
+    results['cold'] = {'seconds': dt,'rows': n_items,'rows_per_s': n_items/dt}
+    with quiet():
+        dt,warm = timed(embed)
+    assert np.array_equal(warm.values,cold.values)
+    print("[ BENCH ]: zotero %i items reload       %8.3fs" % (n_items,dt))
+    results['reload'] = {'seconds': dt,'rows': n_items}
+    edited = rng.sample(range(n_items),n_edited)
+    library.loc[edited,'abstract'] += " Revised."
+    with quiet():
+        dt,_ = timed(embed)
+    print("[ BENCH ]: zotero %i items edited       %8.3fs" % (n_edited,dt))
+    results['edited'] = {'seconds': dt,'rows': n_edited}
+    return results
+
+def bench_lasso(n_points=1000000,n_repeat=9,target_ms=200):
+    """utils_mpl.Highlighter: selection-to-redraw latency of a lasso on a headless (Agg) UMAP map
+
+    The best latency of n_repeat selections, map and panels redrawn, must stay under target_ms
+    (best of, as cold_import: the median is printed too but swings by tens of ms between runs on a shared host).
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.path import Path
+    import utils_mpl
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10,10,(200,2))
+    xy = centers[rng.integers(0,200,n_points)] + rng.standard_normal((n_points,2))
+    terms = np.array(["%s:%s" % m for m in mesh] + ["D9%05i:Term %i" % (i,i) for i in range(5000)])
+    n_terms = rng.integers(3,15,n_points)
+    codes = rng.integers(0,len(terms),n_terms.sum())
+    ends = np.cumsum(n_terms)
+    papers = pd.DataFrame({'umap-x': xy[:,0],'umap-y': xy[:,1],
+                           'pubdate': rng.integers(1950,2022,n_points),
+                           'mesh_terms': [";".join(terms[codes[e-n:e]]) for n,e in zip(n_terms,ends)],
+                           'title': "Title",'abstract': "Abstract"})
+
+    fig_umap,ax_umap = plt.subplots(figsize=(8,8))
+    ax_umap.scatter(papers['umap-x'],papers['umap-y'],s=1,lw=0)
+    fig_panels,(ax_year,ax_mesh) = plt.subplots(2,1,figsize=(6,8))
+    dt_init,highlighter = timed(utils_mpl.Highlighter,ax_umap,ax_year,ax_mesh,papers,add_text=True,
+                                csv_path=os.path.join(bench_path,"selected.csv"))
+    print("[ BENCH ]: lasso index %i points %8.2fs" % (n_points,dt_init))
+    dt_draw,_ = timed(fig_umap.canvas.draw)
+    print("[ BENCH ]: lasso full map draw   %8.3fs" % dt_draw)
+    results = {'init': {'seconds': dt_init,'rows': n_points},'draw': {'seconds': dt_draw}}
+
+    # the grid shortcut must agree with Path.contains_points on concave and self-intersecting lassos,
+    # including a notch thinner than a grid cell running between cell corners
+    polygons = [np.column_stack([r*np.cos(t),r*np.sin(t)]) for r,t in
+                ((rng.uniform(1,8,40),np.sort(rng.uniform(0,2*np.pi,40))) for _ in range(10))]
+    polygons += [rng.uniform(-10,10,(n,2)) for n in (5,12,50,200)]
+    notch = highlighter.dx/10
+    polygons.append(np.array([[-8,-8],[8,-8],[8,8],[0.3+notch,8],[0.3+notch,-7],[0.3,-7],[0.3,8],[-8,8]]))
+    for verts in polygons:
+        assert np.array_equal(highlighter.select(verts),Path(verts).contains_points(xy))
+    print("[ BENCH ]: lasso grid selection matches Path.contains_points on %i concave/self-intersecting lassos"
+          % len(polygons))
+
+    theta = np.linspace(0,2*np.pi,60)
+    for label,radius in (("small",1.5),("large",6.0)):
+        verts = np.column_stack([radius*np.cos(theta),radius*0.7*np.sin(theta)])
+        dts,dt_bg = [],0
+        for _ in range(n_repeat):
+            with quiet():
+                dts.append(timed(highlighter._onselect_lasso,verts)[0])
+            # the CSV export of one selection is not timed against the next
+            dt_bg += timed(highlighter.worker.join)[0]
+        dt,dt_median = min(dts),np.median(dts)
+        dt_bg /= n_repeat
+        def map_only():
+            highlighter.mask = highlighter.select(verts)
+            highlighter._draw_points()
+        dt_map,_ = timed(map_only)
+        dt_panels,_ = timed(fig_panels.canvas.draw)
+        expected = Path(verts).contains_points(xy)
+        assert np.array_equal(highlighter.mask,expected)
+        dt_old,_ = timed(Path(verts).contains_points,xy)
+        sel = papers[expected]
+        old_rows = min(len(sel),2000)
+        def legacy_rows():
+            # the per-row loop of the old _onselect_lasso (loc lookups and a print per title)
+            with quiet():
+                for idx in sel.index[:old_rows]:
+                    yp,mt,t = sel.loc[idx]['pubdate'],sel.loc[idx]['mesh_terms'],sel.loc[idx]['title']
+                    sorted([mti.split(":")[-1] for mti in mt.split(";")])
+                    print("(%s) %s" % (yp,t))
+                    sel.loc[idx]['title'] + sel.loc[idx]['abstract']
+        dt_rows,_ = timed(legacy_rows)
+        dt_rows *= len(sel)/max(old_rows,1)
+        print("[ BENCH ]: lasso %-5s %7i selected  %6.0f ms best, %4.0f ms median (map %4.0f ms, panels %4.0f ms) + csv %5.0f ms in background"
+              % (label,expected.sum(),dt*1000,dt_median*1000,dt_map*1000,dt_panels*1000,dt_bg*1000))
+        assert dt*1000 < target_ms, "lasso %s: %.0f ms, target %i ms" % (label,dt*1000,target_ms)
+        print("[ BENCH ]:   old: contains_points %5.0f ms + row loop ~%6.1f s" % (dt_old*1000,dt_rows))
+        results[label] = {'seconds': dt,'median_seconds': dt_median,'rows': int(expected.sum()),'background_seconds': dt_bg,
+                          'map_seconds': dt_map,'panels_seconds': dt_panels,
+                          'legacy_contains_seconds': dt_old,'legacy_loop_seconds': dt_rows}
+    print("[ BENCH ]: lasso selection-to-redraw under the %i ms target at %i points" % (target_ms,n_points))
+    plt.close(fig_umap)
+    plt.close(fig_panels)
+    return results
+
+def bench_umap(n_papers=50000,sample_size=10000,dim=200,n_new=5000,batch_size=20000,refit=True):
+    """Persisted UMAP map: fit on a sample, batched transform of the rest, nightly placement, full refit"""
+    import umap
+    import utils_umap
+    rng = np.random.default_rng(0)
+    path = os.path.join(bench_path,"umap")
+    shutil.rmtree(path,ignore_errors=True)
+    store = utils_vectors.EmbeddingStore(os.path.join(path,"vectors"),dim=dim,normalized=True)
+    pmids = np.arange(n_papers)
+    vectors = clustered_vectors(rng,n_papers,dim,n_topics=200)
+    store.put(pmids,1950 + pmids % 72,vectors,rng.integers(1,2**63,n_papers,dtype='uint64'))
+    try:
+        utils_umap.update(store,path=path)
+        raise AssertionError("update() without a fitted model")
+    except RuntimeError:
+        pass
+
+    with quiet():
+        dt_fit,model = timed(utils_umap.fit,store,sample_size,path=path)
+    print("[ BENCH ]: umap fit on %i sample       %8.1fs (incl. numba compilation)" % (sample_size,dt_fit))
+    with quiet():
+        dt_load,model = timed(utils_umap.load_model,path)
+        dt,placed = timed(utils_umap.update,store,model,path,batch_size)
+    assert placed == n_papers-len(model.embedding_) and len(utils_umap.coordinates(path)) == n_papers
+    print("[ BENCH ]: umap load model               %8.2fs" % dt_load)
+    print("[ BENCH ]: umap transform %i          %8.1fs %8.0f papers/s" % (placed,dt,placed/dt))
+    results = {'fit': {'seconds': dt_fit,'rows': sample_size},
+               'transform': {'seconds': dt,'rows': placed,'rows_per_s': placed/dt}}
+
+    # a nightly update: new papers and revised vectors
+    new = np.arange(n_papers,n_papers+n_new)
+    revised = rng.choice(n_papers,min(n_new,n_papers),replace=False)
+    changed = np.concatenate([new,revised])
+    store.put(changed,1950 + changed % 72,clustered_vectors(rng,len(changed),dim,n_topics=200),
+              rng.integers(1,2**63,len(changed),dtype='uint64'))
+    with quiet():
+        dt,placed = timed(utils_umap.update,store,model,path,batch_size)
+    assert placed == len(changed)
+    print("[ BENCH ]: umap nightly %i placed       %8.1fs" % (placed,dt))
+    results['nightly'] = {'seconds': dt,'rows': placed}
+
+    papers = pd.DataFrame({'pmid': rng.choice(n_papers,min(20000,n_papers),replace=False)})
+    dt,papers = timed(utils_umap.add_coordinates,papers,path)
+    assert papers['umap-x'].notna().all()
+    print("[ BENCH ]: umap coordinates of %i papers %6.1f ms" % (len(papers),dt*1000))
+    results['coordinates'] = {'seconds': dt,'rows': len(papers)}
+
+    if refit:
+        # refitting drops the coordinates of the previous projection
+        with quiet():
+            model = utils_umap.fit(store,sample_size//5,seed=1,path=path)
+        assert len(utils_umap.coordinates(path)) == len(model.embedding_)
+        all_vectors = store.get(np.arange(n_papers+n_new))[0]
+        with quiet():
+            dt,_ = timed(umap.UMAP(random_state=0).fit_transform,all_vectors)
+        print("[ BENCH ]: umap full refit %i         %8.1fs" % (len(all_vectors),dt))
+        results['refit'] = {'seconds': dt,'rows': len(all_vectors)}
+    shutil.rmtree(path,ignore_errors=True)
+    return results
+
+# what each entry point imports; heavy is what the query-only path must not load
+import_paths = [('query',"import db, utils_pubs"),
+                ('ezpubmed',"import ezpubmed"),
+                ('nlp',"import utils_nlp"),
+                ('ann',"import utils_ann, utils_vectors")]
+heavy_modules = ['spacy','umap','numba','pubmed_parser','dateparser','lxml.etree','matplotlib']
+
+def cold_import(statement,repeats=3):
+    """Best wall time (s) of statement in a fresh interpreter, its stdout and the heavy modules it loaded"""
+    code = ("import sys,time; t0 = time.perf_counter(); %s; dt = time.perf_counter()-t0; "
+            "print(repr((dt,[m for m in %r if m in sys.modules])))" % (statement,heavy_modules))
+    best = None
+    for i in range(repeats):
+        out = subprocess.run([sys.executable,"-c",code],capture_output=True,text=True,check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip().splitlines()
+        dt,loaded = eval(out[-1])
+        best = dt if best is None else min(best,dt)
+    return best,out[:-1],loaded
+
+def bench_imports(repeats=3):
+    """Cold-start import time of each entry point, and the cost of the heavy modules they defer"""
+    results = {}
+    for name,statement in import_paths:
+        dt,printed,loaded = cold_import(statement,repeats)
+        print("[ BENCH ]: import %-9s %8.3fs  heavy: %s" % (name,dt,", ".join(loaded) or "-"))
+        results[name] = {'seconds': dt,'heavy': loaded}
+        if name == 'query':
+            # nothing may be opened or printed before the first query
+            assert not loaded and not printed,(loaded,printed)
+    for module in heavy_modules:
+        try:
+            dt,_,_ = cold_import("import " + module,repeats)
+        except subprocess.CalledProcessError:
+            continue
+        print("[ BENCH ]: import %-13s %8.3fs (deferred)" % (module,dt))
+        results[module] = {'seconds': dt}
+    return results
+
+def bench_query_cache(n_rows=2000000,years=(2010,2014),n_revised=1000):
+    """utils_pubs loaders through the Feather query cache: cold, warm, after an ingest touching one year, LRU eviction"""
+    import utils_cache
+    with quiet():
+        db.reset_db()
+    fill_papers(n_rows)
+    # some journals have text NLM IDs, leaving the column with mixed int/text values
+    conn = sqlite3.connect(config.papers_db)
+    with conn:
+        conn.execute("UPDATE paperdb SET nlm_unique_id = '2985213R' WHERE pmid % 997 = 0")
+    conn.close()
+    print("Database: %i rows" % n_rows)
+    path = os.path.join(bench_path,"query_cache")
+    shutil.rmtree(path,ignore_errors=True)
+    config.query_cache,config.query_cache_path = True,path
+    cache = utils_pubs.query_cache()
+    loads = [("year %i" % years[0],lambda: utils_pubs.load_year(db,years[0])),
+             ("years %i-%i" % years,lambda: utils_pubs.load_between_years(db,*years)),
+             ("this month",lambda: utils_pubs.load_this_month(db)),
+             ("year, 2 columns",lambda: utils_pubs.load_year(db,years[0],columns=['pmid','title']))]
+    results = {}
+    for label,fn in loads:
+        config.query_cache = False
+        dt_sql,df = timed(fn)
+        config.query_cache = True
+        dt_cold,_ = timed(fn)
+        dt_warm,cached = timed(fn)
+        assert cached.equals(df) and cache.stats()['hits'] > 0,label
+        if 'nlm_unique_id' in df:
+            assert (df['nlm_unique_id'] == '2985213R').any(),label
+        print("[ BENCH ]: query cache %-16s %8i rows  sqlite %7.3fs  cold %7.3fs  warm %7.3fs  x%.0f"
+              % (label,len(df),dt_sql,dt_cold,dt_warm,dt_sql/dt_warm))
+        results[label] = {'rows': len(df),'sqlite': dt_sql,'cold': dt_cold,'warm': dt_warm}
+
+    # an ingest revising papers of the last year only
+    revised = utils_pubs.load_year(db,years[1]).head(n_revised).copy()
+    revised['title'] = revised['title'] + " (revised)"
+    revised['pubdate'] = revised['pubdate'].dt.strftime('%Y-%m-%d')
+    db.update_papers(revised[db.fields])
+    before = cache.stats()
+    dt_year,_ = timed(utils_pubs.load_year,db,years[0])
+    dt_range,df = timed(utils_pubs.load_between_years,db,*years)
+    after = cache.stats()
+    assert after['hits']-before['hits'] == 1 and after['stale']-before['stale'] == 1
+    assert df['title'].str.endswith("(revised)").sum() == n_revised
+    print("[ BENCH ]: query cache after ingest of %i: untouched year %7.3fs (hit), range %7.3fs (stale, reloaded)"
+          % (years[1],dt_year,dt_range))
+
+    # a budget of about two year-sized entries
+    size = os.path.getsize(os.path.join(path,cache.key('year',db.db_path(),(years[0],),
+                                                       tuple(db.PaperDB._meta.sorted_field_names)) + ".feather"))
+    cache.max_bytes = 2.5*size
+    for year in range(years[0],years[0]+5):
+        utils_pubs.load_year(db,year)
+    stats = cache.stats()
+    assert stats['mb'] <= stats['max_mb'] and stats['evictions'] > 0
+    print("[ BENCH ]: query cache stats %s" % ", ".join("%s=%s" % (k,round(v,2) if isinstance(v,float) else v)
+                                                       for k,v in stats.items()))
+    results['stats'] = stats
+    config.query_cache = False
+    shutil.rmtree(path,ignore_errors=True)
+    return results
+
+# corpus sizes of bench_ingest
+scales = {'small': {'n_files': 4,'n_articles': 2000},
+          'medium': {'n_files': 8,'n_articles': 10000},
+          'large': {'n_files': 16,'n_articles': 30000}}
+
+def bench_ingest(scale='small',revisions=0.1,seed=0,**params):
+    """Parse, prepare, insert, update and load stages of a full ingest
+
+    Files after the first revise a fraction revisions of earlier PMIDs; params
+    go to the synthetic generator. Returns {stage: {seconds, rows, rows_per_s, rss_mb}}.
+    """
+    path = os.path.join(bench_path,"ingest")
+    shutil.rmtree(path,ignore_errors=True)
+    xml_files = make_corpus(path,revisions=revisions,seed=seed,**scales[scale],**params)
+    n_articles = scales[scale]['n_files']*scales[scale]['n_articles']
+    print("Corpus: %(n_files)i files x %(n_articles)i articles" % scales[scale],"(%.0f%% revisions)" % (revisions*100))
+    results = {}
+    def add(stage,seconds,rows):
+        results[stage] = {'seconds': seconds,'rows': rows,'rows_per_s': rows/seconds if seconds > 0 else None,
+                          'rss_mb': metrics.peak_rss()}
+        print("[ BENCH ]: ingest %-8s %8.2fs %10i rows %10.0f rows/s" % (stage,seconds,rows,rows/seconds))
+
+    import pubmed_parser
+    dt,documents = timed(lambda: [pubmed_parser.parse_medline_xml(f,year_info_only=False,reference_list=True)
+                                  for f in xml_files])
+    add('parse',dt,n_articles)
+    with quiet():
+        dt,dfs = timed(lambda: [ezpubmed.prepare_documents(d) for d in documents])
+    add('prepare',dt,n_articles)
+    del documents
+
+    db.reset_db()
+    dataset = make_dataset()
+    dataset.metrics = metrics.Metrics()
+    with quiet():
+        for df in dfs:
+            dataset.write_papers(df)
+    summary = dataset.metrics.summary()
+    for stage in ('insert','update'):
+        if stage in summary.index:
+            add(stage,summary.loc[stage,'wall'],int(summary.loc[stage,'rows']))
+    del dfs
+
+    dt,papers = timed(utils_pubs.load_all,db)
+    add('load',dt,papers.shape[0])
+    del papers
+    dt,rows = timed(lambda: sum(df.shape[0] for df in utils_pubs.iter_all(db,['pmid','title','abstract'])))
+    add('iter',dt,rows)
+    return results
+
+def git_commit():
+    """(commit, dirty) of the working tree, (None, None) outside a git checkout"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git","rev-parse","HEAD"],cwd=cwd,stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(["git","status","--porcelain","-uno"],cwd=cwd).decode()
+    except (OSError,subprocess.CalledProcessError):
+        return None,None
+    return commit,len(status) > 0
+
+def machine_info():
+    return {'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+def compare(base,results):
+    """Print each stage's throughput (or total time) relative to an earlier run"""
+    print("Compared with %s:" % (base.get('commit') or "baseline")[:10])
+    for name,result in results['benchmarks'].items():
+        old = base['benchmarks'].get(name)
+        if old is None:
+            continue
+        if isinstance(result['results'],dict) and isinstance(old['results'],dict):
+            for stage,r in result['results'].items():
+                o = old['results'].get(stage)
+                if o and o.get('rows_per_s') and r.get('rows_per_s'):
+                    print("  %-10s %-8s %10.0f -> %10.0f rows/s  x%.2f" % (name,stage,o['rows_per_s'],r['rows_per_s'],
+                                                                          r['rows_per_s']/o['rows_per_s']))
+        print("  %-10s total    %10.2f -> %10.2f s       x%.2f" % (name,old['seconds'],result['seconds'],
+                                                                  old['seconds']/result['seconds']))
+
+benchmarks = {
+    'pmids': bench_pmids,
+    'upsert': bench_upsert,
+    'update': bench_update,
+    'queries': bench_queries,
+    'loaders': bench_loaders,
+    'parquet': bench_parquet,
+    'download': bench_download,
+    'dates': bench_dates,
+    'prepare': bench_prepare,
+    'memory': bench_memory,
+    'gzip': bench_gzip,
+    'ledger': bench_ledger,
+    'metrics': bench_metrics,
+    'ingest': bench_ingest,
+    'fts': bench_fts,
+    'normalized': bench_normalized,
+    'vectors': bench_vectors,
+    'incremental': bench_incremental,
+    'similarity': bench_similarity,
+    'ann': bench_ann,
+    'embed': bench_embed,
+    'zotero': bench_zotero,
+    'lasso': bench_lasso,
+    'umap': bench_umap,
+    'imports': bench_imports,
+    'query_cache': bench_query_cache,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline ezpubmed benchmarks")
+    parser.add_argument("names",nargs="*",help="benchmarks to run (default: all): " + ", ".join(benchmarks))
+    parser.add_argument("--scale",default="small",choices=list(scales),help="corpus size of the ingest benchmark")
+    parser.add_argument("--json",help="write machine-readable results to this file")
+    parser.add_argument("--compare",help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error("unknown benchmark %s" % name)
+
+    commit,dirty = git_commit()
+    results = {'commit': commit,'dirty': dirty,'time': datetime.datetime.now().isoformat(),
+               'scale': args.scale,'machine': machine_info(),'benchmarks': {}}
+    try:
+        for name in args.names or list(benchmarks):
+            fn = benchmarks[name]
+            kwargs = {'scale': args.scale} if name == 'ingest' else {}
+            dt,out = timed(fn,**kwargs)
+            results['benchmarks'][name] = {'seconds': dt,'results': out}
+    finally:
+        shutil.rmtree(bench_path,ignore_errors=True)
+    if args.json:
+        with open(args.json,"w") as f:
+            json.dump(results,f,indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f),results)
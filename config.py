@@ -1,3 +1,79 @@
 
 data_path = r'/path/to/data/directory/'
 papers_db = data_path + 'papers.db'
+parquet_path = data_path + 'by_year/papers/'
+# Zotero JSON exports and their cached embeddings
+library_path = data_path + 'zotero/'
+
+# number of worker processes used to parse/prepare XML files during update_db
+n_workers = 1
+
+# parse each XML file incrementally and write it in batches of batch_size papers,
+# keeping memory flat regardless of file size (n_workers is ignored when streaming)
+streaming = False
+batch_size = 5000
+
+# SQLite pragmas (see db.profiles), individual pragmas can be overridden in db_pragmas
+db_profile = 'fast'
+db_pragmas = {}
+# drop the secondary indexes during update_db and rebuild them at the end,
+# worthwhile for the initial baseline load but not for daily update files
+defer_indexes = False
+
+# keep a year-partitioned Parquet copy of papers.db in parquet_path, rewriting
+# the years touched by each update_db
+parquet_mirror = False
+
+# concurrent FTP transfers (one connection each) and attempts per file in download_latest
+n_downloads = 4
+download_retries = 5
+
+# XML files are ingested straight from the downloaded .xml.gz; set decompress_xml
+# to gunzip them on disk first. delete_ingested removes each file once it is
+# recorded as done (it will not be downloaded again).
+decompress_xml = False
+delete_ingested = False
+
+# log every inserted/revised pmid in the ingest ledger (db.run_changes); costs
+# about 30 bytes per paper, ~1GB for a full baseline load
+log_changes = True
+
+# time every stage of update_db (metrics.py), appending JSON lines to metrics_path
+# (None to only keep them in memory) and printing a summary table at the end
+metrics = False
+metrics_path = data_path + 'metrics.jsonl'
+
+# maintain an FTS5 full-text index over title/abstract/mesh_terms/keywords/affiliations
+# for utils_pubs.search (adds roughly a quarter to the size of papers.db)
+fts = False
+
+# maintain normalized author/MeSH/affiliation tables (db.Author, db.PaperMesh, ...)
+# for the indexed lookups in utils_pubs (query_mesh, query_affiliation, query_author)
+normalized = False
+
+# paper vectors (utils_vectors.EmbeddingStore), one memory-mapped shard per year
+vectors_path = data_path + 'vectors/'
+
+# approximate nearest neighbour index of the paper vectors (utils_ann.IVFIndex) and
+# the number of clusters scanned per query (higher: better recall, slower)
+ann_path = data_path + 'ann/'
+ann_nprobe = 16
+
+# utils_nlp.update_embeddings: spaCy model, worker processes (each loads the
+# model, ~1GB for en_core_sci_lg), nlp.pipe batch size and papers per checkpointed shard
+embed_model = 'en_core_sci_lg'
+embed_workers = 1
+embed_batch_size = 2500
+embed_shard_size = 100000
+
+# persisted UMAP paper map (utils_umap): fitted once on a stratified sample of
+# umap_sample_size papers, new/revised papers are then placed with transform
+umap_path = data_path + 'umap/'
+umap_sample_size = 200000
+
+# cache the results of the utils_pubs year/date loaders as Feather files in
+# query_cache_path (least recently used entries evicted beyond query_cache_mb);
+# an ingest that writes papers of a year invalidates the entries covering it
+query_cache = False
+query_cache_path = data_path + 'query_cache/'
+query_cache_mb = 4000
@@ -2,10 +2,12 @@ import config
 import peewee as pw
 import datetime
 import os
-import pubmed_parser
-import config
+import sqlite3
+import contextlib
 import pandas as pd
 
+import utils
+
 fields = ['pmid',
           'title', 
           'abstract', 
@@ -29,37 +31,99 @@ fields = ['pmid',
           'pubmonth',
           'pubday']
 
-def get_db():
-    #db = pw.SqliteDatabase(':memory:')
-    print("Using...",config.papers_db)
-    db = pw.SqliteDatabase(config.papers_db)
-    return db
+# SQLite pragmas applied to every connection, selected with config.db_profile.
+# cache_size is in KiB when negative; mmap_size is capped by SQLite's compile-time limit.
+profiles = {
+    'default': {},
+    'fast': {'journal_mode': 'wal',
+             'synchronous': 'normal',
+             'cache_size': -1024*1024,
+             'mmap_size': 2**33,
+             'temp_store': 'memory'},
+    # used by ingest_mode() for the duration of a bulk load; a crash of the
+    # process is still safe, a power loss mid-load may need the load redone
+    'ingest': {'journal_mode': 'wal',
+               'synchronous': 'off',
+               'cache_size': -4*1024*1024,
+               'mmap_size': 2**33,
+               'temp_store': 'memory'},
+}
+
+def get_pragmas(profile=None):
+    pragmas = dict(profiles[profile or config.db_profile])
+    pragmas.update(config.db_pragmas)
+    return pragmas
+
+class LazyDatabase(pw.DatabaseProxy):
+    """DatabaseProxy that opens config.papers_db on first use unless init_db() was called"""
+    def __getattr__(self,attr):
+        if self.obj is None and not attr.startswith('_'):
+            init_db()
+        return super().__getattr__(attr)
+
+    def __enter__(self):
+        if self.obj is None:
+            init_db()
+        return self.obj.__enter__()
+
+    def __exit__(self,*exc):
+        return self.obj.__exit__(*exc)
+
+# every model is bound to this proxy, nothing is opened at import time
+database = LazyDatabase()
+
+def init_db(path=None,profile=None,**pragmas):
+    """Bind the models to the SQLite file at path (config.papers_db by default)
+
+    Happens implicitly on first use; call it first to use another file or
+    pragma profile, or again to switch databases at runtime. pragmas override
+    those of the profile.
+    """
+    path = path or config.papers_db
+    settings = get_pragmas(profile)
+    settings.update(pragmas)
+    if database.obj is not None:
+        database.obj.close()
+    print("Using...",path)
+    database.initialize(pw.SqliteDatabase(path,pragmas=settings))
+    return database
+
+def db_path():
+    """File of the bound database"""
+    return database.database
 
 def reset_db():
-    db = get_db()
-    db.drop_tables([PaperDB])
-    db.create_tables([PaperDB])
+    db = BaseModel._meta.database
+    drop_fts()
+    db.drop_tables(tables + normalized_tables)
+    db.create_tables(tables)
     return db
 
 def create_db():
-    db = get_db()
-    db.create_tables([PaperDB])
+    db = BaseModel._meta.database
+    db.create_tables(tables)
+    return db
+
+def create_ledger():
+    """Create the ingest ledger tables in an existing database"""
+    db = BaseModel._meta.database
+    db.create_tables(ledger_tables)
     return db
 
 class BaseModel(pw.Model):
     """A base model that will use our MySQL database"""
 
     class Meta:
-       database = get_db() 
+       database = database
     pass
 
 class PaperDB(BaseModel):
     pmid = pw.IntegerField(unique=True)
     title = pw.CharField()
     abstract = pw.TextField()
-    journal = pw.CharField()
+    journal = pw.CharField(index=True)
     authors = pw.CharField()
-    pubdate = pw.DateField()
+    pubdate = pw.DateField(index=True)
     mesh_terms = pw.CharField()
     publication_types = pw.CharField()
     chemical_list = pw.CharField()
@@ -73,9 +137,417 @@ class PaperDB(BaseModel):
     nlm_unique_id = pw.IntegerField()
     issn_linking = pw.CharField()
     country = pw.CharField()
-    pubyear = pw.IntegerField()
+    pubyear = pw.IntegerField(index=True)
     pubmonth = pw.IntegerField()
     pubday = pw.IntegerField()
 
+class IngestRun(BaseModel):
+    """One call of update_db"""
+    started = pw.DateTimeField(default=datetime.datetime.now)
+    finished = pw.DateTimeField(null=True)
+
+class IngestFile(BaseModel):
+    """One XML file, written in the same transaction as its papers"""
+    filename = pw.CharField()
+    datatype = pw.CharField()
+    run = pw.ForeignKeyField(IngestRun,null=True,backref='files')
+    size = pw.IntegerField(null=True)
+    md5 = pw.CharField(null=True)
+    num_papers = pw.IntegerField(default=0)
+    num_new = pw.IntegerField(default=0)
+    num_updated = pw.IntegerField(default=0)
+    parse_time = pw.FloatField(null=True)
+    prepare_time = pw.FloatField(null=True)
+    write_time = pw.FloatField(null=True)
+    timestamp = pw.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = ((('datatype','filename'),True),)
+
+class IngestChange(BaseModel):
+    """A paper inserted ('new') or revised ('updated') by an ingested file"""
+    file = pw.ForeignKeyField(IngestFile,backref='changes',on_delete='CASCADE')
+    pmid = pw.IntegerField()
+    kind = pw.CharField()
+
+    class Meta:
+        primary_key = False
+
+class YearGeneration(BaseModel):
+    """Bumped whenever papers of a pubyear are written, so cached query results of that year go stale"""
+    year = pw.IntegerField(primary_key=True)
+    generation = pw.IntegerField(default=0)
+
+class Author(BaseModel):
+    lastname = pw.CharField()
+    forename = pw.CharField()
+    initials = pw.CharField()
+    identifier = pw.CharField()
+
+    class Meta:
+        indexes = ((('lastname','forename','initials','identifier'),True),)
+
+class Mesh(BaseModel):
+    """A MeSH descriptor, e.g. ui='D003920', term='Diabetes Mellitus'"""
+    ui = pw.CharField(unique=True)
+    term = pw.CharField()
+
+class Affiliation(BaseModel):
+    name = pw.CharField(unique=True)
+
+# join tables keyed on PaperDB.pmid, position is the order within the paper
+class PaperAuthor(BaseModel):
+    pmid = pw.IntegerField()
+    author = pw.ForeignKeyField(Author)
+    position = pw.IntegerField()
+
+    class Meta:
+        primary_key = pw.CompositeKey('pmid','position')
+        indexes = ((('author','pmid'),False),)
+
+class PaperMesh(BaseModel):
+    pmid = pw.IntegerField()
+    mesh = pw.ForeignKeyField(Mesh)
+    position = pw.IntegerField()
+
+    class Meta:
+        primary_key = pw.CompositeKey('pmid','position')
+        indexes = ((('mesh','pmid'),False),)
+
+class PaperAffiliation(BaseModel):
+    """Position within the paper's affiliations (authors without one are skipped), last marks the final one"""
+    pmid = pw.IntegerField()
+    affiliation = pw.ForeignKeyField(Affiliation)
+    position = pw.IntegerField()
+    last = pw.BooleanField()
+
+    class Meta:
+        primary_key = pw.CompositeKey('pmid','position')
+        indexes = ((('affiliation','pmid'),False),)
+
+ledger_tables = [IngestRun,IngestFile,IngestChange,YearGeneration]
+normalized_tables = [Author,Mesh,Affiliation,PaperAuthor,PaperMesh,PaperAffiliation]
+tables = [PaperDB] + ledger_tables
+
+def completed_files(datatype):
+    """Names (without .gz) of the files of datatype already in the database"""
+    q = IngestFile.select(IngestFile.filename).where(IngestFile.datatype == datatype)
+    return set(f for f, in q.tuples())
+
+def import_csv_ledger(path,datatype):
+    """Move the completed files of an updates_so_far CSV into the ledger"""
+    done = completed_files(datatype)
+    names = [os.path.basename(f) for f in pd.read_csv(path,index_col=0)['Filename']]
+    names = sorted(set(n[:-len(".gz")] if n.endswith(".gz") else n for n in names) - done)
+    with BaseModel._meta.database.atomic():
+        IngestFile.insert_many([{'filename': n,'datatype': datatype} for n in names]).execute()
+    os.replace(path,path + ".imported")
+    return len(names)
+
+def start_run():
+    return IngestRun.create()
+
+def finish_run(run):
+    run.finished = datetime.datetime.now()
+    run.save()
+
+def log_changes(ingest_file,pmids,kind):
+    rows = [(ingest_file.id,int(p),kind) for p in pmids]
+    BaseModel._meta.database.cursor().executemany(
+        'INSERT INTO ingestchange (file_id, pmid, kind) VALUES (?,?,?)',rows)
+
+def ingest_log(datatype=None):
+    """The ledger as a DataFrame, one row per ingested file"""
+    q = IngestFile.select().order_by(IngestFile.id)
+    if datatype is not None:
+        q = q.where(IngestFile.datatype == datatype)
+    return pd.DataFrame(list(q.dicts()))
+
+def run_changes(run=None):
+    """pmid, kind and filename of every paper changed by a run (the latest by default)"""
+    if run is None:
+        run = IngestRun.select().order_by(IngestRun.id.desc()).get()
+    q = (IngestChange.select(IngestChange.pmid,IngestChange.kind,IngestFile.filename)
+                     .join(IngestFile)
+                     .where(IngestFile.run == run)
+                     .order_by(IngestFile.id))
+    return pd.DataFrame(list(q.tuples()),columns=['pmid','kind','filename'])
+
+def last_run_id():
+    """Id of the latest ingest run (0 if none)"""
+    return IngestRun.select(pw.fn.MAX(IngestRun.id)).scalar() or 0
+
+def changed_since(run_id=0):
+    """Distinct pmids changed by the runs after run_id, with the id of the last run included"""
+    last = last_run_id()
+    q = (IngestChange.select(IngestChange.pmid)
+                     .join(IngestFile)
+                     .where((IngestFile.run > run_id) & (IngestFile.run <= last))
+                     .distinct())
+    return [pmid for pmid, in q.tuples()],last
+
+def bump_generations(years):
+    """Mark the papers of years as changed (invalidates the utils_cache entries covering them)"""
+    years = sorted(set(int(y) for y in years if pd.notna(y)))
+    if len(years) == 0:
+        return
+    (YearGeneration.insert_many([{'year': y,'generation': 1} for y in years])
+                   .on_conflict(conflict_target=[YearGeneration.year],
+                                update={YearGeneration.generation: YearGeneration.generation + 1})
+                   .execute())
+
+def year_generations(years=None):
+    """{year: generation} of years (all of them by default), 0 for years never written
+
+    None when the database predates the table, so changes cannot be tracked.
+    """
+    if not YearGeneration.table_exists():
+        return None
+    q = YearGeneration.select(YearGeneration.year,YearGeneration.generation)
+    if years is None:
+        return dict(q.tuples())
+    years = sorted(set(int(y) for y in years))
+    found = dict(q.where(YearGeneration.year.in_(years)).tuples())
+    return {y: found.get(y,0) for y in years}
+
+def unlogged_files(run_id=0,last=None):
+    """Files of the runs after run_id (up to last) that changed papers without logging them (config.log_changes off)"""
+    last = last_run_id() if last is None else last
+    logged = IngestChange.select().where(IngestChange.file == IngestFile.id)
+    q = (IngestFile.select(IngestFile.filename)
+                   .where((IngestFile.run > run_id) & (IngestFile.run <= last) &
+                          (IngestFile.num_new + IngestFile.num_updated > 0) & ~pw.fn.EXISTS(logged)))
+    return [f for f, in q.tuples()]
+
+def create_indexes():
+    """Create any missing PaperDB indexes (also the migration path for older databases)"""
+    PaperDB._schema.create_indexes(safe=True)
+
+def drop_secondary_indexes():
+    """Drop every PaperDB index except the unique pmid index needed for upserts"""
+    for index in PaperDB._meta.fields_to_index():
+        if not index._unique:
+            PaperDB._meta.database.execute_sql('DROP INDEX IF EXISTS "%s"' % index._name)
+
+@contextlib.contextmanager
+def ingest_mode(defer_indexes=False):
+    """Switch the connection to the 'ingest' pragmas for a bulk load
+
+    With defer_indexes the secondary indexes are dropped up front and rebuilt
+    once at the end, which is much faster than maintaining them row by row
+    during a full baseline load (but slower for a handful of update files).
+    The same goes for the full-text index, if there is one.
+    """
+    database = PaperDB._meta.database
+    previous = {}
+    for key,value in get_pragmas('ingest').items():
+        previous[key] = database.pragma(key)
+        database.pragma(key,value)
+    fts = has_fts()
+    if defer_indexes:
+        drop_secondary_indexes()
+        if fts:
+            drop_fts_triggers()
+    try:
+        yield database
+    finally:
+        print("Creating indexes...")
+        create_indexes()
+        if fts and defer_indexes:
+            print("Rebuilding full-text index...")
+            rebuild_fts()
+            create_fts_triggers()
+        for key,value in previous.items():
+            database.pragma(key,value)
+
+def has_normalized():
+    return 'papermesh' in PaperDB._meta.database.get_tables()
+
+def create_normalized():
+    """Create the author/MeSH/affiliation tables and fill them from the existing papers"""
+    if has_normalized():
+        return
+    PaperDB._meta.database.create_tables(normalized_tables)
+    build_normalized()
+
+def _stage(name,columns,rows):
+    """Load rows (or the columns of a DataFrame) into temp table name"""
+    database = PaperDB._meta.database
+    if isinstance(rows,pd.DataFrame):
+        rows = zip(*[rows[c].tolist() for c in columns])
+    database.execute_sql('DROP TABLE IF EXISTS temp.%s' % name)
+    database.execute_sql('CREATE TEMP TABLE %s (%s)' % (name,",".join(columns)))
+    database.cursor().executemany('INSERT INTO temp.%s VALUES (%s)' % (name,",".join("?"*len(columns))),rows)
+
+def update_normalized(df):
+    """Replace the author/MeSH/affiliation rows of the papers in df
+
+    Entities are added with INSERT OR IGNORE and the join rows are rewritten
+    with set-based statements against staged temp tables.
+    """
+    database = PaperDB._meta.database
+    authors = utils.split_authors(df)
+    mesh = utils.split_mesh(df)
+    affiliations = utils.split_field(df,'affiliations')
+    affiliations['last'] = ~affiliations['pmid'].duplicated(keep='last')
+    with database.atomic():
+        _stage('staged_pmid',['pmid'],((int(p),) for p in df['pmid'].unique()))
+        for table in ('paperauthor','papermesh','paperaffiliation'):
+            database.execute_sql('DELETE FROM %s WHERE pmid IN (SELECT pmid FROM temp.staged_pmid)' % table)
+
+        name = ['lastname','forename','initials','identifier']
+        _stage('staged_author',['pmid','position'] + name,authors)
+        database.execute_sql('INSERT OR IGNORE INTO author (%s) SELECT DISTINCT %s FROM temp.staged_author' % ((",".join(name),)*2))
+        database.execute_sql('INSERT INTO paperauthor (pmid,author_id,position) SELECT s.pmid,a.id,s.position '
+                             'FROM temp.staged_author s JOIN author a ON %s'
+                             % " AND ".join("a.%s = s.%s" % (c,c) for c in name))
+
+        _stage('staged_mesh',['pmid','position','ui','term'],mesh)
+        database.execute_sql('INSERT OR IGNORE INTO mesh (ui,term) SELECT ui,min(term) FROM temp.staged_mesh GROUP BY ui')
+        database.execute_sql('INSERT INTO papermesh (pmid,mesh_id,position) SELECT s.pmid,m.id,s.position '
+                             'FROM temp.staged_mesh s JOIN mesh m ON m.ui = s.ui')
+
+        _stage('staged_affiliation',['pmid','position','name','last'],affiliations.rename(columns={'value': 'name'}))
+        database.execute_sql('INSERT OR IGNORE INTO affiliation (name) SELECT DISTINCT name FROM temp.staged_affiliation')
+        database.execute_sql('INSERT INTO paperaffiliation (pmid,affiliation_id,position,last) '
+                             'SELECT s.pmid,a.id,s.position,s.last FROM temp.staged_affiliation s JOIN affiliation a ON a.name = s.name')
+        for name in ('staged_pmid','staged_author','staged_mesh','staged_affiliation'):
+            database.execute_sql('DROP TABLE temp.%s' % name)
+
+def build_normalized(chunksize=100000):
+    """Fill the normalized tables from every paper in papers.db"""
+    # keyset pagination, update_normalized can't drop its temp tables under an open cursor
+    database = PaperDB._meta.database
+    last_pmid,num_papers = -1,0
+    while True:
+        rows = database.execute_sql('SELECT pmid,authors,mesh_terms,affiliations FROM paperdb '
+                                    'WHERE pmid > ? ORDER BY pmid LIMIT ?',(last_pmid,chunksize)).fetchall()
+        if not rows:
+            break
+        update_normalized(pd.DataFrame.from_records(rows,columns=['pmid','authors','mesh_terms','affiliations']))
+        last_pmid = rows[-1][0]
+        num_papers += len(rows)
+        print("  > Normalized %i papers" % num_papers)
+
+# Full-text index over these PaperDB columns (see create_fts). It is an FTS5
+# external-content table, so the text itself is only stored once, in paperdb.
+fts_fields = ['title','abstract','mesh_terms','keywords','affiliations']
+# bm25 column weights for utils_pubs.search, in fts_fields order
+fts_weights = [10.0,1.0,5.0,5.0,1.0]
+
+def has_fts():
+    return 'paperdb_fts' in PaperDB._meta.database.get_tables()
+
+def create_fts_triggers():
+    """Keep paperdb_fts in step with every insert/update/delete of paperdb"""
+    database = PaperDB._meta.database
+    columns = ",".join(fts_fields)
+    new = ",".join("new.%s" % f for f in fts_fields)
+    old = ",".join("old.%s" % f for f in fts_fields)
+    database.execute_sql('CREATE TRIGGER IF NOT EXISTS paperdb_fts_ai AFTER INSERT ON paperdb BEGIN '
+                         'INSERT INTO paperdb_fts (rowid,%s) VALUES (new.id,%s); END' % (columns,new))
+    database.execute_sql('CREATE TRIGGER IF NOT EXISTS paperdb_fts_ad AFTER DELETE ON paperdb BEGIN '
+                         "INSERT INTO paperdb_fts (paperdb_fts,rowid,%s) VALUES ('delete',old.id,%s); END" % (columns,old))
+    database.execute_sql('CREATE TRIGGER IF NOT EXISTS paperdb_fts_au AFTER UPDATE OF %s ON paperdb BEGIN '
+                         "INSERT INTO paperdb_fts (paperdb_fts,rowid,%s) VALUES ('delete',old.id,%s); "
+                         'INSERT INTO paperdb_fts (rowid,%s) VALUES (new.id,%s); END' % (columns,columns,old,columns,new))
+
+def drop_fts_triggers():
+    for name in ('paperdb_fts_ai','paperdb_fts_ad','paperdb_fts_au'):
+        PaperDB._meta.database.execute_sql('DROP TRIGGER IF EXISTS %s' % name)
+
+def rebuild_fts():
+    """Rebuild the whole full-text index from paperdb"""
+    database = PaperDB._meta.database
+    with database.atomic():
+        database.execute_sql("INSERT INTO paperdb_fts (paperdb_fts) VALUES ('rebuild')")
+
+def optimize_fts():
+    """Merge the index b-trees, worth doing after a large load"""
+    PaperDB._meta.database.execute_sql("INSERT INTO paperdb_fts (paperdb_fts) VALUES ('optimize')")
+
+def create_fts():
+    """Create the full-text index and its triggers, indexing the existing papers"""
+    if has_fts():
+        create_fts_triggers()
+        return
+    PaperDB._meta.database.execute_sql(
+        "CREATE VIRTUAL TABLE paperdb_fts USING fts5(%s, content='paperdb', content_rowid='id', "
+        "tokenize='porter unicode61')" % ", ".join(fts_fields))
+    rebuild_fts()
+    create_fts_triggers()
+
+def drop_fts():
+    drop_fts_triggers()
+    PaperDB._meta.database.execute_sql('DROP TABLE IF EXISTS paperdb_fts')
+
+# SQLite caps the number of bound parameters per statement (999 before 3.32)
+max_variables = 32766 if sqlite3.sqlite_version_info >= (3,32,0) else 999
+
+def existing_pmids(pmids):
+    """Return the subset of pmids that are already in the database"""
+    found = []
+    for idx in range(0, len(pmids), max_variables):
+        q = PaperDB.select(PaperDB.pmid).where(PaperDB.pmid.in_(pmids[idx:idx+max_variables]))
+        found.extend(pmid for pmid, in q.tuples())
+    return found
+
+def existing_years(pmids):
+    """Return the set of pubyears currently stored for pmids"""
+    years = set()
+    for idx in range(0, len(pmids), max_variables):
+        q = PaperDB.select(PaperDB.pubyear).where(PaperDB.pmid.in_(pmids[idx:idx+max_variables])).distinct()
+        years.update(year for year, in q.tuples())
+    return years
+
+def upsert_papers(records):
+    """Insert papers, overwriting any existing rows with the same pmid"""
+    preserve = [getattr(PaperDB,f) for f in fields if f != 'pmid']
+    n_batch = max_variables // len(fields)
+    # overwritten papers may move out of their old year
+    years = set(r['pubyear'] for r in records) | existing_years([r['pmid'] for r in records])
+    with PaperDB._meta.database.atomic():
+        for idx in range(0, len(records), n_batch):
+            (PaperDB.insert_many(records[idx:idx+n_batch])
+                    .on_conflict(conflict_target=[PaperDB.pmid],preserve=preserve)
+                    .execute())
+        bump_generations(years)
+
+def update_papers(df,ingest_file=None):
+    """Update existing papers, only rewriting the columns whose values changed
+
+    Rows are staged in a temporary table and each column is updated with a single
+    set-based statement. Returns a dict of column -> number of papers changed.
+    With ingest_file, the papers that differ are logged as 'updated' changes.
+    """
+    database = PaperDB._meta.database
+    columns = ",".join('"%s"' % f for f in fields)
+    values = [[PaperDB._meta.fields[f].db_value(v) for v in df[f].tolist()] for f in fields]
+    changed = {}
+    with database.atomic():
+        database.execute_sql('DROP TABLE IF EXISTS temp.paperdb_staged')
+        database.execute_sql('CREATE TEMP TABLE paperdb_staged AS SELECT %s FROM paperdb WHERE 0' % columns)
+        database.execute_sql('CREATE UNIQUE INDEX temp.paperdb_staged_pmid ON paperdb_staged (pmid)')
+        database.cursor().executemany('INSERT OR REPLACE INTO paperdb_staged (%s) VALUES (%s)'
+                                      % (columns,",".join("?"*len(fields))),zip(*values))
+        differs = " OR ".join('s."{0}" IS NOT p."{0}"'.format(f) for f in fields[1:])
+        # old and new years of the papers that actually change
+        cursor = database.execute_sql('SELECT DISTINCT p.pubyear, s.pubyear FROM paperdb_staged s '
+                                      'JOIN paperdb p ON p.pmid = s.pmid WHERE %s' % differs)
+        bump_generations(year for row in cursor.fetchall() for year in row)
+        if ingest_file is not None:
+            database.execute_sql(
+                "INSERT INTO ingestchange (file_id, pmid, kind) SELECT ?, s.pmid, 'updated' "
+                "FROM paperdb_staged s JOIN paperdb p ON p.pmid = s.pmid WHERE %s" % differs,(ingest_file.id,))
+        for f in fields[1:]:
+            cursor = database.execute_sql(
+                'UPDATE paperdb SET "{0}" = (SELECT s."{0}" FROM paperdb_staged s WHERE s.pmid = paperdb.pmid) '
+                'WHERE pmid IN (SELECT s.pmid FROM paperdb_staged s JOIN paperdb p ON p.pmid = s.pmid '
+                'WHERE s."{0}" IS NOT p."{0}")'.format(f))
+            if cursor.rowcount > 0:
+                changed[f] = cursor.rowcount
+        database.execute_sql('DROP TABLE temp.paperdb_staged')
+    return changed
+
 if __name__ == '__main__':
     p = PaperDB()
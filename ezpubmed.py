@@ -1,19 +1,17 @@
 
-#import multiprocessing as mp
-#from joblib import Parallel, delayed
+import multiprocessing as mp
+import collections
 
 import pandas as pd
-import pylab as plt
 import numpy as np
-import subprocess as sub
 import sys,os,glob
 import re
 import time
 
-import pubmed_parser
 import utils
 import utils_pubs as utilsp
-import ftplib
+import utils_ftp
+import metrics
 import config
 import db
 
@@ -30,6 +28,74 @@ def tac(method):
     rstr  = '[ TIMER ]: %30s - %2ihour:%2imin:%3.2fsec' % (method,t_hour,t_min,t_sec)
     print(rstr)
 
+def prepare_documents(documents,cols=db.fields,timings=None):
+    """Turn parsed documents into a PaperDB frame, adding prepare/dates timings to timings"""
+    if timings is None:
+        timings = {}
+    start = metrics.clock()
+    df = pd.DataFrame(documents)
+    df = utils.prepare_papers(df)
+    metrics.add_timing(timings,'prepare',start)
+    start = metrics.clock()
+    df = utils.append_dateinfo(df)[cols]
+    metrics.add_timing(timings,'dates',start)
+    start = metrics.clock()
+    df = utils.fix_dtypes(df)
+    df.dropna(subset=['pmid','abstract','pubdate'],inplace=True)
+    metrics.add_timing(timings,'prepare',start)
+    return df
+
+def prepare_xml(xml,cols=db.fields):
+    """Parse and prepare a single XML file (runs inside the worker pool)
+
+    Returns (xml, df, timings) where timings holds the wall/cpu seconds of the
+    parse, prepare and dates steps and the peak RSS (MB) of the process.
+    """
+    import pubmed_parser
+    timings = {}
+    start = metrics.clock()
+    documents = pubmed_parser.parse_medline_xml(xml,year_info_only=False,reference_list=True)
+    metrics.add_timing(timings,'parse',start)
+    df = prepare_documents(documents,cols,timings)
+    timings['rss'] = metrics.peak_rss()
+    return xml,df,timings
+
+def prepare_xml_batches(xml,cols=db.fields,batch_size=5000,timings=None):
+    """Stream a single XML file as prepared frames of at most batch_size papers
+
+    Timings are accumulated into timings as in prepare_xml.
+    """
+    if timings is None:
+        timings = {}
+    batches = utils.iter_medline_xml(xml,batch_size)
+    while True:
+        start = metrics.clock()
+        documents = next(batches,None)
+        metrics.add_timing(timings,'parse',start)
+        if documents is None:
+            return
+        df = prepare_documents(documents,cols,timings)
+        timings['rss'] = metrics.peak_rss()
+        yield df
+
+def prepare_xml_files(xml_files,cols=db.fields,n_workers=1):
+    """Yield (xml, df, timings) in file order, preparing up to n_workers files concurrently"""
+    if n_workers <= 1:
+        for xml in xml_files:
+            yield prepare_xml(xml,cols)
+        return
+
+    # keep a bounded window of files in flight so prepared frames don't pile
+    # up in memory when the writer is the bottleneck
+    with mp.Pool(n_workers) as pool:
+        pending = collections.deque()
+        for xml in xml_files:
+            pending.append(pool.apply_async(prepare_xml,(xml,cols)))
+            if len(pending) >= 2*n_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
 class Dataset:
     def __init__(self,work_path,datatype,dbase):
 
@@ -39,6 +105,7 @@ class Dataset:
         self.datatype = datatype
         self.xml_path = work_path + "pubmed_data/%s/xml/"%datatype
 
+        # completed files used to be tracked here, now in the ingest ledger of papers.db
         self.dbtracking_path = config.data_path+"updates_so_far_%s.csv" % datatype
         self.pubmed_ftp = r'ftp.ncbi.nlm.nih.gov'
         self.pubmed_ext = "/pubmed/%s/"%datatype
@@ -47,23 +114,27 @@ class Dataset:
         print("Working on:",datatype)
         print("FTP:",self.pubmed_directory)
 
-        self.xml_files = sorted(pubmed_parser.list_xml_path(self.xml_path))
-        self.has_internet = utils.has_internet()
+        self.xml_files = utils.get_list_of_xml_files(self.xml_path)
+        self.metrics = metrics.NullMetrics()
 
         if not os.path.isdir(self.xml_path):
             os.makedirs(self.xml_path)
     
     def get_completed_list(self):
         if os.path.exists(self.dbtracking_path):
-            self.xml_done = pd.read_csv(self.dbtracking_path,index_col=0)
-        else:
-            self.xml_done = pd.DataFrame(columns=['Filename'])
+            print("Importing",self.dbtracking_path,"into the ingest ledger...")
+            db.import_csv_ledger(self.dbtracking_path,self.datatype)
+        self.xml_done_keys = db.completed_files(self.datatype)
 
-    def update_db(self,current_pmids):
+    def update_db(self,n_workers=None,streaming=None,run=None):
+        if n_workers is None:
+            n_workers = config.n_workers
+        if streaming is None:
+            streaming = config.streaming
 
         self.get_completed_list()
-        self.xml_files = sorted(pubmed_parser.list_xml_path(self.xml_path))
-        self.xml_update = [f for f in self.xml_files if f not in list(self.xml_done['Filename'])]
+        self.xml_files = utils.get_list_of_xml_files(self.xml_path)
+        self.xml_update = [f for f in self.xml_files if utils.xml_key(f) not in self.xml_done_keys]
 
         if len(self.xml_update) == 0:
             return
@@ -72,114 +143,194 @@ class Dataset:
         for f in self.xml_update:
             print(f)
 
+        # a run started here is also finished here, even if a file fails
+        own_run = run is None
+        if own_run:
+            run = db.start_run()
+        try:
+            self.ingest_files(run,n_workers,streaming)
+        finally:
+            if own_run:
+                db.finish_run(run)
+
+        print("UPDATE COMPLETE!")
+
+    def ingest_files(self,run,n_workers,streaming):
+        """Parse and write the files of xml_update, each committed with its ledger entry"""
         num_to_be_processed = len(self.xml_update)
-        current_xml_list = list(self.xml_done['Filename'])
-        for paperi,xml in enumerate(self.xml_update):
+        if streaming:
+            def stream(xml):
+                timings = {}
+                return xml,prepare_xml_batches(xml,self.cols,config.batch_size,timings),timings
+            prepared = (stream(xml) for xml in self.xml_update)
+        else:
+            prepared = ((xml,[df],timings) for xml,df,timings in prepare_xml_files(self.xml_update,self.cols,n_workers))
+        for paperi,(xml,batches,timings) in enumerate(prepared):
             print()
             print("Processing: %s (%3.2f complete)" % (os.path.basename(xml),paperi*100/num_to_be_processed))
-            documents = pubmed_parser.parse_medline_xml(xml,year_info_only=False,reference_list=True)
-            df = pd.DataFrame(documents)
-            df = utils.prepare_papers(df)
-            df = utils.append_dateinfo(df)[self.cols]
-            df = utils.fix_dtypes(df)
-            df.dropna(subset=['pmid','abstract','pubdate'],inplace=True)
-            lpmids = list(df['pmid'])
-
-            # split into papers that are new vs. to-be-updated
-            self.update_pmid = utils.intersection(lpmids,current_pmids)
-            self.new_pmid = np.setdiff1d(lpmids,current_pmids)
-            self.dfi = df.set_index("pmid")
-            self.new_l = self.dfi.loc[self.new_pmid].reset_index().to_dict('records')
-            self.update_l = self.dfi.loc[self.update_pmid].reset_index().to_dict('records')
-
-            num_papers_update = len(self.update_l)
-            num_papers_new = len(self.new_l)
-            num_papers = df.shape[0]
-
-            print(" > # Papers:",num_papers)
-
+            # the file's papers and its ledger entry are committed together
+            key = utils.xml_key(xml)
+            with self.dbase.atomic():
+                with self.metrics.stage('hash',file=key,datatype=self.datatype):
+                    self.ingest_file = db.IngestFile.create(filename=key,datatype=self.datatype,run=run,
+                                                            size=os.path.getsize(xml),md5=utils_ftp.file_md5(xml))
+                write_time = 0
+                for df in batches:
+                    t0 = time.perf_counter()
+                    num_new,num_updated = self.write_papers(df,self.ingest_file)
+                    write_time += time.perf_counter()-t0
+                    self.ingest_file.num_papers += df.shape[0]
+                    self.ingest_file.num_new += num_new
+                    self.ingest_file.num_updated += num_updated
+                self.ingest_file.parse_time = timings.get('parse')
+                self.ingest_file.prepare_time = timings.get('prepare',0) + timings.get('dates',0)
+                self.ingest_file.write_time = write_time
+                self.ingest_file.save()
+            self.xml_done_keys.add(key)
+            # parsing ran in a worker (or interleaved with the writes when streaming)
+            for stage in ('parse','prepare','dates'):
+                if stage in timings:
+                    self.metrics.record(stage,timings[stage],timings[stage+'_cpu'],self.ingest_file.num_papers,
+                                        timings.get('rss'),file=key,datatype=self.datatype)
+
+            if config.delete_ingested:
+                print("Removing",xml)
+                os.remove(xml)
+
+    def write_papers(self,df,ingest_file=None):
+        """Insert new and update existing papers, returns (# new, # updated)
+
+        With ingest_file (and config.log_changes) each changed pmid is logged in the ledger.
+        """
+        lpmids = df['pmid'].tolist()
+
+        info = {'file': ingest_file.filename,'datatype': self.datatype} if ingest_file is not None else {}
+
+        # split into papers that are new vs. to-be-updated
+        with self.metrics.stage('lookup',len(lpmids),**info):
+            self.update_pmid = db.existing_pmids(lpmids)
+            self.new_pmid = np.setdiff1d(lpmids,self.update_pmid)
+
+        num_papers_update = len(self.update_pmid)
+        num_papers_new = len(self.new_pmid)
+        num_papers = df.shape[0]
+        if not config.log_changes:
+            ingest_file = None
+
+        print(" > # Papers:",num_papers)
+
+        with self.dbase.atomic():
             if num_papers_new != 0:
                 n_batch = 5000
                 print("    >> Inserting %5i (%3.2f of XML) papers into database." % (num_papers_new,num_papers_new*100/num_papers))
-                with self.dbase.atomic():
+                with self.metrics.stage('insert',num_papers_new,**info):
+                    dfn = df[df['pmid'].isin(self.new_pmid)]
                     for idx in range(0, num_papers_new, n_batch):
-                        print("       >>> Inserted batch of %5i papers" % (idx+n_batch))
-                        db.PaperDB.insert_many(self.new_l[idx:idx+n_batch]).execute()
+                        db.upsert_papers(dfn.iloc[idx:idx+n_batch].to_dict('records'))
+                    if ingest_file is not None:
+                        db.log_changes(ingest_file,self.new_pmid,'new')
 
+            self.changed_columns = {}
             if num_papers_update != 0:
                 print("    >> Updating %5i (%3.2f) papers into database." % (num_papers_update,num_papers_update*100/num_papers))
-                self.update_instances = []
-                for u in self.update_l:
-                    e = db.PaperDB(**u)
-                    self.update_instances.append(e)
-
-                with self.dbase.atomic():
-                    db.PaperDB.bulk_update(self.update_instances,fields=self.cols, batch_size=1000)
+                with self.metrics.stage('update',num_papers_update,**info):
+                    self.changed_columns = db.update_papers(df[df['pmid'].isin(self.update_pmid)],ingest_file)
+                for col,n in self.changed_columns.items():
+                    print("       >>> %-18s changed in %5i papers" % (col,n))
 
-            current_pmids.extend(lpmids)
-
-            print("Adding filename to completed list...")
-            current_xml_list.append(xml)
-            self.dbtracking_df = pd.DataFrame(current_xml_list,columns=['Filename'])
-            self.dbtracking_df.to_csv(self.dbtracking_path)
-        
-        print("UPDATE COMPLETE!")
+            if config.normalized:
+                with self.metrics.stage('normalize',num_papers,**info):
+                    db.update_normalized(df)
+        return num_papers_new,num_papers_update
 
     def download_latest(self):
-        if self.has_internet:
-            self.ftp=ftplib.FTP(self.pubmed_ftp)
-            self.ftp.login("","")
-            self.ftp.cwd(self.pubmed_ext)
-            pubmedfilelist = self.ftp.nlst()
+        self.get_completed_list()
+        # checked here rather than in __init__ so offline loading never waits on DNS
+        if utils.has_internet():
+            downloader = utils_ftp.FTPDownloader(self.pubmed_ftp,self.pubmed_ext,self.xml_path,
+                                                 n_workers=config.n_downloads,retries=config.download_retries)
+            pubmedfilelist = downloader.list_files()
             fdownload = []
-            for filei in pubmedfilelist:
-                bname = os.path.basename(filei)
-                checking = bname.strip(".gz")
-                if filei.endswith("xml.gz") and not os.path.exists(self.xml_path+checking) and not os.path.exists(self.xml_path+bname):
-                    if ".md5" not in filei:
-                        fdownload.append(filei)
-            for filename in fdownload:
-                cmdin = ["wget","-P",self.xml_path,self.pubmed_directory+filename]
-                print(cmdin)
-                sub.call(cmdin)
+            for bname in pubmedfilelist:
+                checking = bname[:-len(".gz")]
+                if bname.endswith("xml.gz") and not os.path.exists(self.xml_path+checking) and not os.path.exists(self.xml_path+bname):
+                    # already ingested files may have been removed (config.delete_ingested)
+                    if checking not in self.xml_done_keys:
+                        fdownload.append(bname)
+            with self.metrics.stage('download',len(fdownload),datatype=self.datatype):
+                _,failed = downloader.download_all(fdownload)
+            if failed:
+                # later update files revise earlier ones, so don't ingest past a gap
+                raise RuntimeError("Failed to download %i files: %s" % (len(failed),", ".join(sorted(failed))))
     
-        # unzip all recently downloaded files
-        for filei in glob.glob(self.xml_path+"*.xml.gz"):
-            print("Unzipping",filei)
-            sub.call(["gunzip " + filei],shell=True)
+        # files are parsed straight from the .gz unless asked to decompress them
+        if config.decompress_xml:
+            for filei in glob.glob(self.xml_path+"*.xml.gz"):
+                print("Unzipping",filei)
+                with self.metrics.stage('gunzip',file=utils.xml_key(filei),datatype=self.datatype):
+                    utils.gunzip(filei)
         self.xml_files = utils.get_list_of_xml_files(self.xml_path)
 
 class EzPubMed():
     def __init__(self):
 
-        if ~os.path.exists(config.papers_db):
+        if not os.path.exists(db.db_path()):
             self.dbase = db.create_db()
         else:
-            self.dbase = db.get_db()
+            self.dbase = db.create_ledger()
 
         self.baseline = Dataset(config.data_path,"baseline",self.dbase)
         self.updates = Dataset(config.data_path,"updatefiles",self.dbase)
 
-    def update_db(self):
+    def update_db(self,n_workers=None,defer_indexes=None,metrics_callback=None):
+        """Download and ingest the latest files
+
+        With config.metrics (or a metrics_callback) every stage is timed, see metrics.py,
+        and a summary table is printed at the end.
+        """
+        if defer_indexes is None:
+            defer_indexes = config.defer_indexes
         tic()
-        print("Getting current pmids...")        
-        q = db.PaperDB.select(db.PaperDB.pmid) 
-        dfq = pd.DataFrame(list(q.dicts()))
-        self.current_pmids = []
-        if dfq.shape[0] != 0:
-            self.current_pmids = list(dfq['pmid'])
-
-        print("Downloading latest data (if needed)...")
-        self.baseline.download_latest()
-        self.updates.download_latest()
-
-        print("Updating database...")
-        self.baseline.update_db(self.current_pmids)
-        self.updates.update_db(self.current_pmids)
+        self.run = db.start_run()
+        try:
+            self.metrics = metrics.get_metrics(config.metrics or metrics_callback is not None,
+                                               callback=metrics_callback,run=self.run.id)
+            self.baseline.metrics = self.metrics
+            self.updates.metrics = self.metrics
+            print("Downloading latest data (if needed)...")
+            self.baseline.download_latest()
+            self.updates.download_latest()
+
+            print("Updating database...")
+            if config.normalized and not db.has_normalized():
+                print("Building author/MeSH/affiliation tables...")
+                db.create_normalized()
+            if config.fts and not db.has_fts():
+                print("Building full-text index...")
+                db.create_fts()
+            with db.ingest_mode(defer_indexes):
+                self.baseline.update_db(n_workers,run=self.run)
+                self.updates.update_db(n_workers,run=self.run)
+        finally:
+            db.finish_run(self.run)
+
+        if config.parquet_mirror:
+            import utils_parquet
+            print("Updating Parquet mirror...")
+            with self.metrics.stage('parquet'):
+                utils_parquet.update_mirror(db)
+        if self.metrics.enabled:
+            self.metrics.print_summary()
         tac("UPDATE COMPLETE")
 
-    def load_year(self,year):
-        self.papers = utilsp.load_year(year,self.dbase)
+    def search(self,query,columns=['pmid','title','journal','pubdate'],limit=20,offset=0):
+        return utilsp.search(db,query,columns,limit,offset)
+
+    def load_year(self,year,columns=None):
+        self.papers = utilsp.load_year(db,year,columns)
+
+    def load_all(self,columns=None):
+        self.papers = utilsp.load_all(db,columns)
 
-    def load_all(self):
-        self.papers = utilsp.load_all(self.dbase)
\ No newline at end of file
+    def iter_all(self,columns=None,chunksize=100000):
+        return utilsp.iter_all(db,columns,chunksize)
\ No newline at end of file
@@ -7,5 +7,5 @@ if __name__ == '__main__':
 
     # load zotero papers
     dfz = utils_nlp.initialize_zotero_library("Specific.json")
-    dfv = utils_nlp.generate_zotero_embeddings(df)
+    dfv = utils_nlp.generate_zotero_embeddings(dfz)
     embedding = utils_nlp.calculate_embedding(dfv)
\ No newline at end of file
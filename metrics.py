@@ -0,0 +1,110 @@
+import sys
+import json
+import time
+import resource
+import datetime
+import contextlib
+
+import pandas as pd
+
+import config
+
+def clock():
+    return time.perf_counter(),time.process_time()
+
+def add_timing(timings,name,start):
+    """Accumulate the wall/cpu seconds since start=clock() into timings[name(_cpu)]"""
+    wall,cpu = clock()
+    timings[name] = timings.get(name,0) + wall-start[0]
+    timings[name+'_cpu'] = timings.get(name+'_cpu',0) + cpu-start[1]
+
+def peak_rss():
+    """Peak resident memory of this process so far in MB"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/1024**2 if sys.platform == "darwin" else maxrss/1024
+
+class Metrics:
+    """Per-stage wall time, CPU time, rows/s and peak RSS of the update pipeline
+
+    Every record is appended to the JSON lines file at path and/or passed to
+    callback(record), and kept for summary().
+    """
+    enabled = True
+
+    def __init__(self,path=None,callback=None,**info):
+        self.path = path
+        self.callback = callback
+        self.info = info
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self,name,rows=None,**info):
+        """Time the body, the yielded dict can be updated (e.g. rows) before it ends"""
+        record = dict(info,rows=rows)
+        start = clock()
+        yield record
+        wall,cpu = clock()
+        self.record(name,wall-start[0],cpu-start[1],**record)
+
+    def record(self,name,wall,cpu=None,rows=None,rss=None,**info):
+        """Add a stage timed elsewhere, e.g. in a worker process"""
+        record = dict(self.info)
+        record.update(info)
+        record.update({'stage': name,
+                       'wall': wall,
+                       'cpu': cpu,
+                       'rows': rows,
+                       'rows_per_s': rows/wall if rows and wall > 0 else None,
+                       'rss_mb': rss if rss is not None else peak_rss(),
+                       'time': datetime.datetime.now().isoformat()})
+        self.records.append(record)
+        if self.path is not None:
+            with open(self.path,"a") as f:
+                f.write(json.dumps(record) + "\n")
+        if self.callback is not None:
+            self.callback(record)
+        return record
+
+    def summary(self):
+        """One row per stage: # records, summed wall/cpu/rows, rows/s and peak RSS"""
+        df = pd.DataFrame(self.records,columns=['stage','wall','cpu','rows','rss_mb'])
+        df = df.groupby('stage',sort=False).agg(n=('wall','size'),wall=('wall','sum'),cpu=('cpu','sum'),
+                                               rows=('rows','sum'),rss_mb=('rss_mb','max'))
+        df['rows_per_s'] = df['rows']/df['wall']
+        return df
+
+    def print_summary(self):
+        print("%-10s %6s %10s %10s %12s %12s %9s" % ("stage","n","wall (s)","cpu (s)","rows","rows/s","rss (MB)"))
+        for stage,row in self.summary().iterrows():
+            print("%-10s %6i %10.2f %10.2f %12i %12.0f %9.0f" % (stage,row['n'],row['wall'],row['cpu'],
+                                                                 row['rows'],row['rows_per_s'],row['rss_mb']))
+
+class _NullStage:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self,*exc):
+        return False
+
+class NullMetrics:
+    """Drop-in Metrics that records nothing (the default)"""
+    enabled = False
+    records = []
+    _stage = _NullStage()
+
+    def stage(self,name,rows=None,**info):
+        return self._stage
+
+    def record(self,name,wall,cpu=None,rows=None,rss=None,**info):
+        pass
+
+    def print_summary(self):
+        pass
+
+def get_metrics(enabled=None,path=None,callback=None,**info):
+    """Metrics per config.metrics/config.metrics_path unless given, NullMetrics when off"""
+    if enabled is None:
+        enabled = config.metrics
+    if not enabled:
+        return NullMetrics()
+    return Metrics(path if path is not None else config.metrics_path,callback,**info)
@@ -1,12 +1,11 @@
 import socket
 import smtplib
-import dateparser
 import config
 import os,sys
-import pubmed_parser
 import pandas as pd
-import spacy
 import glob
+import gzip
+import shutil
 import numpy as np
 import datetime
 import json
@@ -23,8 +22,53 @@ def difference(li1, li2):
 def nonoverlap(a,b):
     return list(set(a) ^ set(b))
 
+def xml_key(path):
+    """File name without directory or .gz, so x.xml and x.xml.gz are the same file"""
+    name = os.path.basename(path)
+    return name[:-len(".gz")] if name.endswith(".gz") else name
+
 def get_list_of_xml_files(xml_path):
-    return sorted(pubmed_parser.list_xml_path(xml_path))
+    """Sorted *.xml and *.xml.gz files in xml_path, preferring x.xml when both exist"""
+    files = {}
+    for f in sorted(glob.glob(os.path.join(xml_path,"*.xml.gz"))) + sorted(glob.glob(os.path.join(xml_path,"*.xml"))):
+        files[xml_key(f)] = f
+    return [files[k] for k in sorted(files)]
+
+def open_xml(path):
+    """Open an XML file for reading, decompressing *.gz on the fly"""
+    if path.endswith(".gz"):
+        return gzip.open(path,"rb")
+    return open(path,"rb")
+
+def iter_medline_xml(xml_path,batch_size=5000,year_info_only=False,reference_list=True):
+    """Incrementally parse a MEDLINE XML file, yielding lists of at most batch_size articles
+
+    Each PubmedArticle element is released once parsed so memory stays flat
+    regardless of file size.
+    """
+    from lxml import etree
+    import pubmed_parser
+    batch = []
+    with open_xml(xml_path) as f:
+        for _,element in etree.iterparse(f,events=('end',),tag='PubmedArticle'):
+            batch.append(pubmed_parser.medline_parser.parse_article_info(element,year_info_only,False,False,reference_list))
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def gunzip(path):
+    """Decompress path (*.gz) next to itself and remove the archive, like gunzip"""
+    out = path[:-len(".gz")]
+    with gzip.open(path,"rb") as fin, open(out + ".tmp","wb") as fout:
+        shutil.copyfileobj(fin,fout,2**20)
+    os.replace(out + ".tmp",out)
+    os.remove(path)
+    return out
 
 def has_internet(website="www.gmail.com"):
 
@@ -61,8 +105,31 @@ def send_email(to_address,to_subject,to_content):
         server.quit()
 
 def parse_dates(datei):
+    import dateparser
     return dateparser.parse(datei,date_formats=['%Y-%m-%d','%Y-%m','%Y'])
 
+# the '%Y-%m-%d', '%Y-%m' and '%Y' dates produced by pubmed_parser
+medline_date_pattern = r'^(\d{4})(?:-(1[0-2]|0?[1-9])(?:-(3[01]|[12]\d|0?[1-9]))?)?$'
+
+def normalize_dates(dates):
+    """Vectorized equivalent of dates.apply(parse_dates)
+
+    Dates matching the MEDLINE formats are converted in bulk. As with dateparser,
+    a missing month/day is filled with the current month/day (clamped to the end
+    of the month). Anything else falls back to parse_dates row by row.
+    """
+    now = datetime.date.today()
+    parts = dates.astype(str).str.extract(medline_date_pattern).astype(float)
+    ymd = pd.DataFrame({'year':parts[0],'month':parts[1].fillna(now.month),'day':1},index=dates.index)
+    month_end = (pd.to_datetime(ymd,errors='coerce') + pd.offsets.MonthEnd(0)).dt.day
+    ymd['day'] = parts[2].fillna(np.minimum(now.day,month_end))
+    out = pd.to_datetime(ymd,errors='coerce')
+
+    failed = out.isna()
+    if failed.any():
+        out[failed] = pd.to_datetime(dates[failed].apply(parse_dates),errors='coerce')
+    return out
+
 def prepare_papers(papers):
     print('  > Preparing papers...')
     papers['pmid'] = papers['pmid'].astype("int32")
@@ -72,14 +139,39 @@ def prepare_papers(papers):
     #papers.papers['title'].str.contains("Errata")
     return papers
 
+def split_field(df,col,sep=';'):
+    """Long frame of (pmid, position, value) from a sep-joined column, empty values dropped"""
+    values = df[col].fillna('').astype(str).str.split(sep)
+    out = pd.DataFrame({'pmid': df['pmid'].values,'value': values.values}).explode('value')
+    out['value'] = out['value'].str.strip()
+    out = out[out['value'].fillna('') != '']
+    out['position'] = out.groupby('pmid').cumcount()
+    return out.reset_index(drop=True)
+
+def split_mesh(df):
+    """(pmid, position, ui, term) from mesh_terms 'D003920:Diabetes Mellitus; D006801:Humans'"""
+    out = split_field(df,'mesh_terms')
+    parts = out['value'].str.split(':',n=1,expand=True).reindex(columns=[0,1])
+    out['ui'] = parts[0].str.strip()
+    out['term'] = parts[1].fillna('').str.strip()
+    return out
+
+def split_authors(df):
+    """(pmid, position, lastname, forename, initials, identifier) from 'Last|Fore|Initials|Id;...'"""
+    out = split_field(df,'authors')
+    parts = out['value'].str.split('|',n=3,expand=True).reindex(columns=[0,1,2,3])
+    for i,name in enumerate(['lastname','forename','initials','identifier']):
+        out[name] = parts[i].fillna('').str.strip()
+    return out
+
 def append_dateinfo(papers):
     print('  > Parsing dates...')
-    papers['pubdate'] = papers['pubdate'].apply(parse_dates)
+    papers['pubdate'] = normalize_dates(papers['pubdate'])
     papers = papers.sort_values('pubdate')
     print("  > Creating year-month-day entries...")
-    papers['pubyear'] = papers['pubdate'].apply(lambda x: x.year)
-    papers['pubmonth'] = papers['pubdate'].apply(lambda x: x.month)
-    papers['pubday'] = papers['pubdate'].apply(lambda x: x.day)
+    papers['pubyear'] = papers['pubdate'].dt.year
+    papers['pubmonth'] = papers['pubdate'].dt.month
+    papers['pubday'] = papers['pubdate'].dt.day
     return papers
 
 def fix_dtypes(df):
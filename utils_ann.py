@@ -0,0 +1,239 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+import config
+import utils_sim
+
+def kmeans(vectors,n_lists,n_iter=10,seed=0,chunk_size=utils_sim.chunk_size):
+    """Spherical k-means: n_lists unit-length centroids of the (normalized) vectors"""
+    rng = np.random.default_rng(seed)
+    vectors = utils_sim.normalize(vectors)
+    centroids = vectors[rng.choice(len(vectors),n_lists,replace=False)]
+    for i in range(n_iter):
+        labels = assign(vectors,centroids,chunk_size)
+        order = np.argsort(labels,kind='stable')
+        counts = np.bincount(labels,minlength=n_lists)
+        sums = np.add.reduceat(vectors[order],np.concatenate([[0],np.cumsum(counts)[:-1]]),axis=0)
+        # reduceat repeats the next row for empty lists, restart those from random points
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors),empty.sum(),replace=False)]
+        centroids = utils_sim.normalize(sums)
+    return centroids
+
+def assign(vectors,centroids,chunk_size=utils_sim.chunk_size):
+    """Nearest centroid (highest dot product) of each vector"""
+    labels = np.zeros(len(vectors),dtype='int32')
+    for start in range(0,len(vectors),chunk_size):
+        chunk = np.asarray(vectors[start:start+chunk_size],dtype='float32')
+        labels[start:start+chunk_size] = np.argmax(chunk @ centroids.T,axis=1)
+    return labels
+
+class IVFIndex:
+    """Inverted-file approximate nearest neighbour index of normalized paper vectors
+
+    k-means splits the vectors into n_lists clusters; a query is only scored
+    against the nprobe clusters with the closest centroids, so raising nprobe
+    trades latency for recall. The clustered vectors are one memory-mapped
+    matrix sorted by cluster (main.vec, offsets.npy give each cluster's rows)
+    with the PMID of every row (main.pmid.npy, -1 once replaced or removed).
+    add() appends to a small unsorted delta segment (delta.*) that every
+    search scans for the probed clusters; compact() merges it into main.
+    """
+    def __init__(self,path=None):
+        self.path = path if path is not None else config.ann_path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        meta_path = self._file("meta.json")
+        self.meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            self._load()
+
+    def _file(self,name):
+        return os.path.join(self.path,name)
+
+    def save_meta(self):
+        with open(self._file("meta.json"),"w") as f:
+            json.dump(self.meta,f)
+
+    def _load(self):
+        self.dim = self.meta['dim']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.centroids = np.load(self._file("centroids.npy"))
+        self.offsets = np.load(self._file("offsets.npy"))
+        self.main_pmids = np.load(self._file("main.pmid.npy"))
+        n = len(self.main_pmids)
+        self.main = (np.memmap(self._file("main.vec"),dtype=self.dtype,mode='r',shape=(n,self.dim))
+                     if n else np.zeros((0,self.dim),dtype=self.dtype))
+        if os.path.exists(self._file("delta.pmid.npy")):
+            self.delta_pmids = np.load(self._file("delta.pmid.npy"))
+            self.delta_lists = np.load(self._file("delta.list.npy"))
+            self.delta = np.fromfile(self._file("delta.vec"),dtype=self.dtype).reshape(-1,self.dim)
+        else:
+            self.delta_pmids = np.zeros(0,dtype='int64')
+            self.delta_lists = np.zeros(0,dtype='int32')
+            self.delta = np.zeros((0,self.dim),dtype=self.dtype)
+
+    def _check_built(self):
+        if not self.meta:
+            raise RuntimeError("No IVF index in %s, run build() first" % self.path)
+
+    def __len__(self):
+        if not self.meta:
+            return 0
+        return int((self.main_pmids >= 0).sum() + (self.delta_pmids >= 0).sum())
+
+    def _write_main(self,chunks,n):
+        """Write the (pmids, vectors, lists) chunks as the cluster-sorted main segment
+
+        chunks is called twice: once to count the rows per cluster, once to
+        place each row at its cluster's next free position.
+        """
+        counts = np.zeros(len(self.centroids),dtype='int64')
+        for pmids,vectors,lists in chunks():
+            counts += np.bincount(lists,minlength=len(counts))
+        offsets = np.concatenate([[0],np.cumsum(counts)])
+        self.main = None
+        main = np.memmap(self._file("main.vec.tmp"),dtype=self.dtype,mode='w+',shape=(max(n,1),self.dim))
+        main_pmids = np.full(n,-1,dtype='int64')
+        cursor = offsets[:-1].copy()
+        for pmids,vectors,lists in chunks():
+            order = np.argsort(lists,kind='stable')
+            lists = lists[order]
+            chunk_counts = np.bincount(lists,minlength=len(counts))
+            group_start = np.concatenate([[0],np.cumsum(chunk_counts)[:-1]])
+            pos = cursor[lists] + np.arange(len(lists)) - group_start[lists]
+            main[pos] = np.asarray(vectors,dtype=self.dtype)[order]
+            main_pmids[pos] = pmids[order]
+            cursor += chunk_counts
+        main.flush()
+        del main
+        os.replace(self._file("main.vec.tmp"),self._file("main.vec"))
+        np.save(self._file("offsets.npy"),offsets)
+        np.save(self._file("main.pmid.npy"),main_pmids)
+        for name in ("delta.vec","delta.pmid.npy","delta.list.npy"):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+        self._load()
+
+    def build(self,store,n_lists=None,sample_size=None,n_iter=10,seed=0,chunk_size=utils_sim.chunk_size):
+        """Train the clusters on a random sample of an EmbeddingStore and index all of it
+
+        n_lists defaults to 4*sqrt(# papers), sample_size to 50 vectors per cluster.
+        """
+        n = len(store)
+        if n_lists is None:
+            n_lists = max(1,int(4*np.sqrt(n)))
+        if sample_size is None:
+            sample_size = 50*n_lists
+        sample_size = min(n,max(sample_size,n_lists))
+        rng = np.random.default_rng(seed)
+        sample = store.get(np.asarray(store.index_pmid)[np.sort(rng.choice(n,sample_size,replace=False))])[0]
+        print("Training %i clusters on %i vectors..." % (n_lists,sample_size))
+        self.centroids = kmeans(sample,n_lists,n_iter,seed,chunk_size)
+        self.meta = {'dim': store.dim,'dtype': store.dtype.name,'n_lists': n_lists}
+        self.dim,self.dtype = store.dim,store.dtype
+        np.save(self._file("centroids.npy"),self.centroids)
+
+        print("Assigning %i vectors..." % n)
+        lists = {}
+        for year in store.years():
+            pmids,vectors = store.year(year)
+            lists[year] = assign(vectors,self.centroids,chunk_size)
+        def chunks():
+            for year in store.years():
+                pmids,vectors = store.year(year)
+                valid = pmids >= 0
+                for start in range(0,len(pmids),chunk_size):
+                    sel = valid[start:start+chunk_size]
+                    chunk = vectors[start:start+chunk_size][sel]
+                    if not store.meta.get('normalized'):
+                        chunk = utils_sim.normalize(chunk)
+                    yield pmids[start:start+chunk_size][sel],chunk,lists[year][start:start+chunk_size][sel]
+        self._write_main(chunks,n)
+        self.save_meta()
+
+    def remove(self,pmids):
+        """Drop pmids from the index"""
+        self._check_built()
+        pmids = np.asarray(pmids,dtype='int64')
+        drop = np.isin(self.main_pmids,pmids)
+        if drop.any():
+            self.main_pmids[drop] = -1
+            np.save(self._file("main.pmid.npy"),self.main_pmids)
+        drop = np.isin(self.delta_pmids,pmids)
+        if drop.any():
+            self.delta_pmids[drop] = -1
+            np.save(self._file("delta.pmid.npy"),self.delta_pmids)
+
+    def add(self,pmids,vectors):
+        """Insert new or replace revised papers, without retraining the clusters"""
+        self._check_built()
+        pmids = np.asarray(pmids,dtype='int64')
+        vectors = utils_sim.normalize(vectors).astype(self.dtype)
+        self.remove(pmids)
+        lists = assign(vectors,self.centroids)
+        with open(self._file("delta.vec"),"ab") as f:
+            f.write(np.ascontiguousarray(vectors).tobytes())
+        self.delta_pmids = np.concatenate([self.delta_pmids,pmids])
+        self.delta_lists = np.concatenate([self.delta_lists,lists])
+        self.delta = np.concatenate([self.delta,vectors])
+        np.save(self._file("delta.pmid.npy"),self.delta_pmids)
+        np.save(self._file("delta.list.npy"),self.delta_lists)
+
+    def compact(self,chunk_size=utils_sim.chunk_size):
+        """Merge the delta segment into main and drop removed rows"""
+        self._check_built()
+        keep_main = np.flatnonzero(self.main_pmids >= 0)
+        keep_delta = np.flatnonzero(self.delta_pmids >= 0)
+        main,main_pmids = self.main,self.main_pmids
+        main_lists = np.repeat(np.arange(len(self.centroids),dtype='int32'),np.diff(self.offsets))
+        def chunks():
+            for start in range(0,len(keep_main),chunk_size):
+                rows = keep_main[start:start+chunk_size]
+                yield main_pmids[rows],main[rows],main_lists[rows]
+            yield self.delta_pmids[keep_delta],self.delta[keep_delta],self.delta_lists[keep_delta]
+        self._write_main(chunks,len(keep_main)+len(keep_delta))
+
+    def search(self,queries,k=10,nprobe=None,exclude=None):
+        """(scores, pmids) of the approximate top k of each query, sorted by decreasing similarity
+
+        exclude is a list of pmids never returned. Missing results (fewer than
+        k papers in the probed clusters) have pmid -1.
+        """
+        self._check_built()
+        if nprobe is None:
+            nprobe = config.ann_nprobe
+        queries = utils_sim.normalize(queries)
+        exclude = np.unique(np.asarray(exclude if exclude is not None else [],dtype='int64'))
+        nprobe = min(nprobe,len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T),nprobe-1,axis=1)[:,:nprobe]
+        out_scores = np.full((len(queries),k),-np.inf,dtype='float32')
+        out_pmids = np.full((len(queries),k),-1,dtype='int64')
+        for i,query in enumerate(queries):
+            # each cluster is a contiguous block of main
+            blocks = [(self.offsets[p],self.offsets[p+1]) for p in np.sort(probes[i])]
+            delta_rows = np.flatnonzero(np.isin(self.delta_lists,probes[i]))
+            pmids = np.concatenate([self.main_pmids[a:b] for a,b in blocks] + [self.delta_pmids[delta_rows]])
+            vectors = np.concatenate([self.main[a:b] for a,b in blocks] + [self.delta[delta_rows]]).astype('float32')
+            valid = (pmids >= 0) & ~np.isin(pmids,exclude)
+            scores = np.where(valid,vectors @ query,-np.inf).astype('float32')
+            scores,idx = utils_sim._merge_top_k(out_scores[i:i+1,:0],np.zeros((1,0),dtype='int64'),scores[None,:],0,k)
+            order = np.argsort(-scores[0])
+            n = len(order)
+            out_scores[i,:n] = scores[0][order]
+            out_pmids[i,:n] = np.where(np.isfinite(out_scores[i,:n]),pmids[idx[0][order]],-1)
+        return out_scores,out_pmids
+
+    def search_df(self,queries,k=10,nprobe=None,exclude=None):
+        """search() as a DataFrame of query, rank, pmid and score"""
+        scores,pmids = self.search(queries,k,nprobe,exclude)
+        n_queries,n = scores.shape
+        df = pd.DataFrame({'query': np.repeat(np.arange(n_queries),n),
+                           'rank': np.tile(np.arange(n),n_queries),
+                           'pmid': pmids.ravel(),
+                           'score': scores.ravel()})
+        return df[df['pmid'] >= 0].reset_index(drop=True)
@@ -0,0 +1,115 @@
+import os,glob
+import json
+import time
+import hashlib
+import pandas as pd
+
+import config
+
+class QueryCache:
+    """On-disk cache of query results as Feather files, keyed by the query and its columns
+
+    Each entry is <key>.feather (the DataFrame) next to <key>.json holding the
+    query and the generation of every pubyear it covers (db.year_generations)
+    when it was stored. An ingest that writes papers of a year bumps that
+    year's generation, so get() drops any entry whose generations no longer
+    match. The Feather file's mtime is its last use: once the files exceed
+    max_mb the least recently used entries are evicted.
+    """
+    def __init__(self,path=None,max_mb=None):
+        self.path = path if path is not None else config.query_cache_path
+        self.max_bytes = (max_mb if max_mb is not None else config.query_cache_mb)*1024**2
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.hits = self.misses = self.stale = self.evictions = 0
+
+    def _file(self,key,ext):
+        return os.path.join(self.path,key + ext)
+
+    def key(self,*query):
+        """Key of a query, e.g. ('year', db path, 2015, columns)"""
+        return hashlib.blake2b(repr(query).encode(),digest_size=16).hexdigest()
+
+    def get(self,key,generations):
+        """The cached DataFrame of key, None if missing or stored under other generations"""
+        try:
+            with open(self._file(key,".json")) as f:
+                meta = json.load(f)
+        except (OSError,ValueError):
+            self.misses += 1
+            return None
+        if meta['generations'] != {str(y): g for y,g in generations.items()}:
+            self.remove(key)
+            self.stale += 1
+            self.misses += 1
+            return None
+        try:
+            df = pd.read_feather(self._file(key,".feather"))
+        except OSError:
+            self.misses += 1
+            return None
+        os.utime(self._file(key,".feather"))
+        self.hits += 1
+        return df
+
+    def put(self,key,df,generations,query=None):
+        """Store df under key with the generations of the years it covers, then evict down to max_mb"""
+        tmp = self._file(key,".feather.tmp")
+        try:
+            df.to_feather(tmp)
+        except (TypeError,ValueError) as e:
+            # a column Arrow cannot store (ArrowTypeError/ArrowInvalid): the result is simply not cached
+            print("Not caching %r: %s" % (query,e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        if os.path.getsize(tmp) > self.max_bytes:
+            # would evict everything else and then itself
+            os.remove(tmp)
+            return
+        os.replace(tmp,self._file(key,".feather"))
+        meta = {'query': repr(query),'rows': len(df),'created': time.time(),
+                'generations': {str(y): g for y,g in generations.items()}}
+        with open(self._file(key,".json.tmp"),"w") as f:
+            json.dump(meta,f)
+        os.replace(self._file(key,".json.tmp"),self._file(key,".json"))
+        self.evict()
+
+    def remove(self,key):
+        for ext in (".json",".feather"):
+            if os.path.exists(self._file(key,ext)):
+                os.remove(self._file(key,ext))
+
+    def entries(self):
+        """(mtime, bytes, key) of every entry, least recently used first"""
+        out = []
+        for fname in glob.glob(self._file("*",".feather")):
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            out.append((st.st_mtime,st.st_size,os.path.basename(fname)[:-len(".feather")]))
+        return sorted(out)
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_mb"""
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        for mtime,nbytes,key in entries:
+            if size <= self.max_bytes:
+                break
+            self.remove(key)
+            size -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        for mtime,nbytes,key in self.entries():
+            self.remove(key)
+
+    def stats(self):
+        """Hits, misses (of which stale), evictions of this process and the current size of the cache"""
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,'misses': self.misses,'stale': self.stale,'evictions': self.evictions,
+                'hit_rate': self.hits/lookups if lookups else None,
+                'entries': len(entries),'mb': sum(e[1] for e in entries)/1024**2,'max_mb': self.max_bytes/1024**2}
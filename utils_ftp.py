@@ -0,0 +1,136 @@
+import os
+import io
+import time
+import ftplib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class ChecksumError(Exception):
+    pass
+
+def file_md5(path,blocksize=2**20):
+    md5 = hashlib.md5()
+    with open(path,"rb") as f:
+        for block in iter(lambda: f.read(blocksize),b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+def parse_md5(text):
+    """Extract the digest from 'MD5(name)= digest' (NCBI) or 'digest  name' (md5sum) sidecars"""
+    text = text.strip()
+    if "=" in text:
+        return text.split("=")[-1].strip().lower()
+    return text.split()[0].lower()
+
+class FTPDownloader:
+    """Download files from one FTP directory with a pool of worker threads
+
+    Each worker keeps its own connection for the files it handles. Transfers go
+    to a .part file and are resumed from its size (REST) after a failure, then
+    checked against the <name>.md5 sidecar before being moved into place.
+    Failed attempts are retried with exponential backoff.
+    """
+    def __init__(self,host,remote_dir,local_dir,n_workers=4,retries=5,backoff=2.0,port=21,user="",passwd="",timeout=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        self.n_workers = n_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.listing = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    def connect(self):
+        ftp = getattr(self._local,"ftp",None)
+        if ftp is None:
+            ftp = ftplib.FTP(timeout=self.timeout)
+            ftp.connect(self.host,self.port)
+            ftp.login(self.user,self.passwd)
+            ftp.cwd(self.remote_dir)
+            self._local.ftp = ftp
+            with self._lock:
+                self._connections.add(ftp)
+        return ftp
+
+    def _close(self,ftp):
+        with self._lock:
+            self._connections.discard(ftp)
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+    def disconnect(self):
+        """Drop this thread's connection, the next call reconnects"""
+        ftp = getattr(self._local,"ftp",None)
+        self._local.ftp = None
+        if ftp is not None:
+            self._close(ftp)
+
+    def close(self):
+        """Close the connections of every worker"""
+        for ftp in list(self._connections):
+            self._close(ftp)
+        self._local = threading.local()
+
+    def list_files(self):
+        self.listing = [os.path.basename(f) for f in self.connect().nlst()]
+        return self.listing
+
+    def fetch_md5(self,name):
+        """Expected MD5 of name, or None if the server has no sidecar for it"""
+        if self.listing is not None and name + ".md5" not in self.listing:
+            return None
+        buf = io.BytesIO()
+        self.connect().retrbinary("RETR " + name + ".md5",buf.write)
+        return parse_md5(buf.getvalue().decode())
+
+    def _download(self,name):
+        fname = os.path.join(self.local_dir,name)
+        part = fname + ".part"
+        expected = self.fetch_md5(name)
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        with open(part,"ab") as f:
+            self.connect().retrbinary("RETR " + name,f.write,rest=offset or None)
+        if expected is not None and file_md5(part) != expected:
+            os.remove(part)
+            raise ChecksumError("%s does not match its md5 sidecar" % name)
+        os.replace(part,fname)
+        return fname
+
+    def download(self,name):
+        for attempt in range(self.retries):
+            try:
+                return self._download(name)
+            except (ChecksumError,) + ftplib.all_errors as e:
+                self.disconnect()
+                if attempt == self.retries - 1:
+                    raise
+                wait = self.backoff*2**attempt
+                print("  > %s failed (%s), retrying in %.0fs" % (name,e,wait))
+                time.sleep(wait)
+
+    def download_all(self,names):
+        """Download names concurrently, returns (downloaded paths, {name: error})"""
+        if not os.path.isdir(self.local_dir):
+            os.makedirs(self.local_dir)
+        done,failed = [],{}
+        with ThreadPoolExecutor(self.n_workers) as pool:
+            futures = {pool.submit(self.download,name): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    done.append(future.result())
+                    print("Downloaded",name)
+                except Exception as e:
+                    failed[name] = e
+                    print("Failed",name,e)
+        self.close()
+        return sorted(done),failed
@@ -4,23 +4,77 @@ import matplotlib.colors as clr
 from matplotlib.path import Path
 from matplotlib.patches import Rectangle, Ellipse,Polygon
 import numpy as np
-from matplotlib.ticker import MaxNLocator
+import pandas as pd
+import threading
+from matplotlib.ticker import MaxNLocator,NullLocator
+from matplotlib.transforms import blended_transform_factory,ScaledTranslation
+
+def mesh_index(mesh_terms):
+    """Every paper's MeSH terms as integer codes: (codes, row of each code, term names)
+
+    Computed once so that counting the terms of a selection is a bincount.
+    """
+    mesh_terms = pd.Series(mesh_terms).fillna("").astype(str)
+    counts = mesh_terms.str.count(";").values + 1
+    terms = ";".join(mesh_terms).split(";")
+    # factorize the raw "UI:term" strings, then map the (few) distinct ones to their names
+    codes,uniques = pd.factorize(np.array(terms,dtype=object))
+    name_codes,names = pd.factorize(pd.Series(uniques,dtype=object).str.split(":").str[-1].str.strip())
+    codes = name_codes[codes].astype('int32')
+    rows = np.repeat(np.arange(len(mesh_terms),dtype='int32'),counts)
+    keep = np.asarray(names)[codes] != ""
+    return codes[keep],rows[keep],np.asarray(names)
+
+def _ranges(starts, ends):
+    """np.arange(start, end) of every start/end pair, concatenated"""
+    lengths = ends-starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0,dtype='int64')
+    shift = np.repeat(starts - (np.cumsum(lengths)-lengths),lengths)
+    return np.arange(total) + shift
 
 class Highlighter(object):
+    """Lasso selection over a UMAP scatter, with year and MeSH panels of the selected papers
+
+    Points are bucketed in a grid_size x grid_size grid: a lasso takes the
+    cells entirely inside it (crossed by no edge, one center per column run tested) wholesale
+    and only tests the points of the cells its edges cross. MeSH codes and years are indexed once, and the panels are
+    bincounts of the selection updated in place (the MeSH labels are one
+    text per bar whose strings are swapped). The highlighted points (at
+    most max_highlight of them, evenly thinned) are blitted over a cached
+    background of the map. The CSV export (csv_path, None to skip) and
+    spaCy entities run in a background thread.
+    """
 
-    def __init__(self, ax_umap, ax_year, ax_mesh, dfpapers, colors='c', method='lasso', add_text=False,index_list=None,include_nlp=False):
+    def __init__(self, ax_umap, ax_year, ax_mesh, dfpapers, colors='c', method='lasso', add_text=False,index_list=None,include_nlp=False,
+                 csv_path="tmp_selected.csv",nlp_model='en_ner_bionlp13cg_md',grid_size=256,max_highlight=10000):
         self.ax_umap = ax_umap
         self.ax_year = ax_year
         self.ax_mesh = ax_mesh
         self.canvas_umap = ax_umap.figure.canvas
         self.canvas_year = ax_year.figure.canvas
         self.canvas_mesh = ax_mesh.figure.canvas
-        self.x, self.y = dfpapers['umap-x'], dfpapers['umap-y']
+        self.x = np.asarray(dfpapers['umap-x'],dtype='float64')
+        self.y = np.asarray(dfpapers['umap-y'],dtype='float64')
+        self._build_grid(grid_size)
         self.add_text = add_text
         self.df_papers = dfpapers
-        self.df_selected = None
+        self._df_selected = None
         #self.selected_text = None
         self.full_index = dfpapers.index.values
+        pubdate = dfpapers['pubdate']
+        if not pd.api.types.is_numeric_dtype(pubdate):
+            pubdate = pd.to_datetime(pubdate,errors='coerce').dt.year
+        self.years = np.asarray(pubdate,dtype='float64')
+        codes,rows,self.mesh_names = mesh_index(dfpapers['mesh_terms'])
+        # codes in grid order: the points at order[s:e] have the codes mesh_codes[mesh_offsets[s]:mesh_offsets[e]],
+        # so a run of whole cells is one slice
+        row_offsets = np.searchsorted(rows,np.arange(len(self.x)+1))
+        self.mesh_codes = codes[_ranges(row_offsets[self.order],row_offsets[self.order+1])]
+        self.mesh_offsets = np.append(0,np.cumsum(np.diff(row_offsets)[self.order]))
+        self.csv_path = csv_path
+        self.max_highlight = max_highlight
         highlight_color = colors
         highlight_size = 20
         self.object_index = None
@@ -32,13 +86,30 @@ class Highlighter(object):
         self.x1 = None
         self.y1 = None
         self.entities_dict = {}
+        self.selection_id = 0
+        self.worker = None
+        self.background = None
+        # panels drawn once, then updated in place by each selection
+        self.n_mesh = 50
+        self.mesh_bars = ax_mesh.barh(np.arange(self.n_mesh),np.zeros(self.n_mesh))
+        # one text per bar, left of the axes at the bar's y, so a selection only swaps their strings
+        ax_mesh.yaxis.set_major_locator(NullLocator())
+        ax_mesh.tick_params(axis='x',labelsize=6)
+        label_transform = (blended_transform_factory(ax_mesh.transAxes,ax_mesh.transData)
+                           + ScaledTranslation(-3/72,0,ax_mesh.figure.dpi_scale_trans))
+        self.mesh_labels = [ax_mesh.text(0,i,"",transform=label_transform,ha='right',va='center',fontsize=6)
+                            for i in range(self.n_mesh)]
+        self.year_steps = ax_year.stairs([0],[0,1],fill=True)
+        ax_year.xaxis.set_major_locator(MaxNLocator(integer=True))
+        ax_year.tick_params(axis='x',labelrotation=45,labelsize=6)
         self._highlight = ax_umap.scatter(
-           [],[], marker="o", lw=0, s=highlight_size, c=highlight_color
+           [],[], marker="o", lw=0, s=highlight_size, c=highlight_color, animated=True
         )
         self.include_nlp = include_nlp
         if include_nlp:
-            self.nlp = spacy.load('en_ner_bionlp13cg_md')
-            self.nlp.add_pipe(self.nlp.create_pipe('sentencizer'))
+            import spacy
+            self.nlp = spacy.load(nlp_model)
+            self.nlp.add_pipe('sentencizer')
         #if self.selected_text != None:
         #    self.selected_text.remove()
 
@@ -52,6 +123,7 @@ class Highlighter(object):
                 transform=self.ax_umap.transAxes,
                 color="k",
                 fontname="Helvetica",
+                animated=True,
             )
 
         self.name_to_selector = {"lasso": LassoSelector}
@@ -62,85 +134,193 @@ class Highlighter(object):
         }
 
         self.lasso = selector(self.ax_umap, onselect_dict[selector])
+        self.draw_cid = self.canvas_umap.mpl_connect('draw_event', self._on_draw)
 
     # def remove_text(self):
 
     def disconnect(self):
-        self.canvas_umap.mpl_disconnect(self.lasso)
+        self.lasso.disconnect_events()
+        self.canvas_umap.mpl_disconnect(self.draw_cid)
+
+    def _on_draw(self, event):
+        """Cache the map without the (animated) highlight after every full redraw"""
+        self.background = self.canvas_umap.copy_from_bbox(self.ax_umap.bbox)
+        self._blit_highlight(restore=False)
+
+    def _blit_highlight(self, restore=True):
+        if restore:
+            self.canvas_umap.restore_region(self.background)
+        self.ax_umap.draw_artist(self._highlight)
+        if self.add_text:
+            self.ax_umap.draw_artist(self.selected_text)
+        self.canvas_umap.blit(self.ax_umap.bbox)
+
+    def _build_grid(self, grid_size):
+        """Sort the points by grid cell, cell c holds order[offsets[c]:offsets[c+1]]"""
+        self.grid_size = grid_size
+        self.grid_x0,self.grid_x1 = self.x.min(),self.x.max()
+        self.grid_y0,self.grid_y1 = self.y.min(),self.y.max()
+        self.dx = max(self.grid_x1-self.grid_x0,1e-12)/grid_size
+        self.dy = max(self.grid_y1-self.grid_y0,1e-12)/grid_size
+        cells = self._cell(self.x,self.grid_x0,self.dx)*grid_size + self._cell(self.y,self.grid_y0,self.dy)
+        self.order = np.argsort(cells,kind='stable')
+        self.offsets = np.searchsorted(cells[self.order],np.arange(grid_size*grid_size+1))
+
+    def _cell(self, values, origin, step):
+        return np.clip(((values-origin)/step).astype(int),0,self.grid_size-1)
+
+    def _edge_cells(self, verts):
+        """(i, j) of every grid cell crossed by an edge of the closed polygon verts"""
+        a = np.column_stack([(verts[:,0]-self.grid_x0)/self.dx,(verts[:,1]-self.grid_y0)/self.dy])
+        b = np.roll(a,-1,axis=0)
+        # parameters t in [0, 1] where each edge crosses a grid line, plus its two ends
+        ts = [np.zeros(len(a)),np.ones(len(a))]
+        segs = [np.arange(len(a)),np.arange(len(a))]
+        for axis in (0,1):
+            lo,hi = np.minimum(a[:,axis],b[:,axis]),np.maximum(a[:,axis],b[:,axis])
+            counts = (np.floor(hi)-np.floor(lo)).astype(int)
+            seg = np.repeat(np.arange(len(a)),counts)
+            lines = np.repeat(np.floor(lo)+1,counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts,counts)
+            ts.append((lines-a[seg,axis])/(b[seg,axis]-a[seg,axis]))
+            segs.append(seg)
+        t,seg = np.concatenate(ts),np.concatenate(segs)
+        order = np.lexsort((t,seg))
+        t,seg = t[order],seg[order]
+        # the midpoint between consecutive crossings of an edge lies in one cell it crosses
+        same = seg[1:] == seg[:-1]
+        tm,seg = ((t[1:]+t[:-1])/2)[same],seg[1:][same]
+        points = a[seg] + tm[:,None]*(b[seg]-a[seg])
+        i = np.clip(np.floor(points[:,0]).astype(int),0,self.grid_size-1)
+        j = np.clip(np.floor(points[:,1]).astype(int),0,self.grid_size-1)
+        return i,j
+
+    def _select_runs(self, verts):
+        """(starts, ends) of the points inside the polygon verts: runs order[starts[k]:ends[k]] of the grid order"""
+        verts = np.asarray(verts,dtype='float64')
+        path = Path(verts)
+        (xmin,ymin),(xmax,ymax) = verts.min(axis=0),verts.max(axis=0)
+        if xmax < self.grid_x0 or xmin > self.grid_x1 or ymax < self.grid_y0 or ymin > self.grid_y1:
+            return np.zeros(0,dtype='int64'),np.zeros(0,dtype='int64')
+        # grid cells under the lasso's bounding box
+        i = np.arange(self._cell(xmin,self.grid_x0,self.dx),self._cell(xmax,self.grid_x0,self.dx)+1)
+        j = np.arange(self._cell(ymin,self.grid_y0,self.dy),self._cell(ymax,self.grid_y0,self.dy)+1)
+        # cells crossed by a lasso edge are partial; the others of a column run between two
+        # crossed cells are all inside or all outside, so one center per run is tested
+        ei,ej = self._edge_cells(verts)
+        ei,ej = ei-i[0],ej-j[0]
+        ok = (ei >= 0) & (ei < len(i)) & (ej >= 0) & (ej < len(j))
+        crossed = np.zeros((len(i),len(j)),dtype=bool)
+        crossed[ei[ok],ej[ok]] = True
+        run_start = ~crossed.copy()
+        run_start[:,1:] &= crossed[:,:-1]
+        ri,rj = np.nonzero(run_start)
+        run_inside = path.contains_points(np.column_stack([self.grid_x0+(i[ri]+0.5)*self.dx,self.grid_y0+(j[rj]+0.5)*self.dy]))
+        run = np.cumsum(run_start.ravel()).reshape(crossed.shape)-1
+        full = ~crossed & np.append(run_inside,False)[run]
+        cells = (i[:,None]*self.grid_size + j[None,:])
+        positions = _ranges(self.offsets[cells[~full]],self.offsets[cells[~full]+1])
+        candidates = self.order[positions]
+        inside = np.zeros(0,dtype=bool)
+        if len(candidates) > 0:
+            inside = path.contains_points(np.column_stack([self.x[candidates],self.y[candidates]]), radius=0)
+        starts = np.concatenate([self.offsets[cells[full]],positions[inside]])
+        ends = np.concatenate([self.offsets[cells[full]+1],positions[inside]+1])
+        if len(starts) == 0:
+            return starts,ends
+        # merge the runs that touch (neighbouring cells of a column, neighbouring points of a cell)
+        order = np.argsort(starts,kind='stable')
+        starts,ends = starts[order],ends[order]
+        first = np.append(True,starts[1:] != ends[:-1])
+        return starts[first],ends[np.append(first[1:],True)]
+
+    def select(self, verts):
+        """Boolean mask of the points inside the polygon verts"""
+        starts,ends = self._select_runs(verts)
+        mask = np.zeros(self.x.shape[0], dtype=bool)
+        mask[self.order[_ranges(starts,ends)]] = True
+        return mask
 
     def _draw_points(self):
-        self.object_index = self.full_index[self.mask]
+        selected = np.flatnonzero(self.mask)
+        self.object_index = self.full_index[selected]
         self.nevents = len(self.mask)
-        self.nselected = np.sum(self.mask)
+        self.nselected = len(selected)
         if self.add_text:
-            self.selected_text.remove()
-            
-        if self.add_text:
-            self.selected_text = self.ax_umap.text(
-                0.03,
-                0.97,
-                "%3.2f (%i events)"
-                % (self.nselected * 100. / self.nevents, self.nselected),
-                ha="left",
-                va="top",
-                transform=self.ax_umap.transAxes,
-                color="k",
-                fontname="Helvetica",
-            )
-        xy = np.column_stack([self.x[self.mask], self.y[self.mask]])
+            self.selected_text.set_text("%3.2f (%i events)" % (self.nselected * 100. / self.nevents, self.nselected))
+        if len(selected) > self.max_highlight:
+            selected = selected[::int(np.ceil(len(selected)/self.max_highlight))]
+        xy = np.column_stack([self.x[selected], self.y[selected]])
         self._highlight.set_offsets(xy)
-        self.canvas_umap.draw()
-
+        if self.background is None:
+            self.canvas_umap.draw()
+        else:
+            self._blit_highlight()
 
     def _onselect_lasso(self, verts):
         self.verts = np.array(verts)
-        p = Path(self.verts)
-        pix = np.array([self.x, self.y]).T
-        self.mask = p.contains_points(pix, radius=0)
+        starts,ends = self._select_runs(self.verts)
+        points = self.order[_ranges(starts,ends)]
+        self.mask = np.zeros(self.x.shape[0], dtype=bool)
+        self.mask[points] = True
         self._draw_points()
-        self.df_selected = self.df_papers[self.mask]
-        print("%s selected" % self.df_selected.shape[0])
-        if self.df_selected.shape[0] == 0:
-            self.entities_dict = {}
-
-        
-        self.ax_mesh.clear()
-        self.ax_year.clear()
-
-        mterms = []
-        for idx in self.df_selected.index:
-            yp = self.df_selected.loc[idx]['pubdate']
-            mt = self.df_selected.loc[idx]['mesh_terms']
-            t = self.df_selected.loc[idx]['title']
-            #sdoc = self.nlp(self.df_selected.loc[idx]['abstract'])
-            #sen = list(sdoc.sents)
-            mterms.extend(sorted([mti.split(":")[-1] for mti in mt.split(";")]))
-            print("(%s) %s" % (yp,t))
-            doci = self.df_selected.loc[idx]['title'] + self.df_selected.loc[idx]['abstract']
-            if self.include_nlp:
-                sdoc = nlp(doci)
-                #for si in sdoc.ents:
-                self.entities_dict[idx] = sdoc.ents
-            #print(" Mesh:",", ".join(mterms))
-#            print(" ".join(item.split()[:100]))
-        self.df_selected.to_csv("tmp_selected.csv")
-        
-        self.mesh_counts = Counter(mterms)
-        self.mesh_counts_top = self.mesh_counts.most_common(50)
-        dfcounts = pd.DataFrame.from_dict(dict(self.mesh_counts_top), orient='index')
-        dfcounts.sort_values(0,inplace=True)
-        if dfcounts.shape[0]!=0:
-            dfcounts.plot(kind='barh',ax=self.ax_mesh,fontsize=6,legend=False)
-
-        xmin = np.min(self.df_selected['pubdate'])
-        xmax = np.max(self.df_selected['pubdate'])
-        self.ax_year.hist(self.df_selected['pubdate'],bins=np.arange(xmin,xmax+1)-0.5)
-        self.ax_year.set_xlim([xmin,xmax])
-        self.ax_year.xaxis.set_major_locator(MaxNLocator(integer=True))
-        for label in self.ax_year.get_xticklabels():
-            label.set_rotation(45)
-            label.set_fontsize(6)
-            label.set_ha('right')
-
-        self.canvas_year.draw()
-        self.canvas_mesh.draw()
+        self._df_selected = None
+        print("%s selected" % self.nselected)
+        self.entities_dict = {}
+
+        # MeSH counts: bincount of the codes of the selected runs, the bars are
+        # updated in place (most common at the top)
+        codes = self.mesh_codes[_ranges(self.mesh_offsets[starts],self.mesh_offsets[ends])]
+        counts = np.bincount(codes, minlength=len(self.mesh_names))
+        top = np.argsort(-counts,kind='stable')[:self.n_mesh]
+        top = top[counts[top] > 0]
+        self.mesh_counts_top = list(zip(self.mesh_names[top],counts[top]))
+        widths = np.zeros(self.n_mesh)
+        widths[:len(top)] = counts[top]
+        for bar,width in zip(self.mesh_bars,widths[::-1]):
+            bar.set_width(width)
+        labels = list(self.mesh_names[top]) + [""]*(self.n_mesh-len(top))
+        for text,label in zip(self.mesh_labels,labels[::-1]):
+            text.set_text(label)
+        self.ax_mesh.set_xlim(0,max(widths.max(),1)*1.05)
+
+        years = self.years[points]
+        years = years[np.isfinite(years)].astype(int)
+        if len(years) != 0:
+            xmin,xmax = years.min(),years.max()
+            hist = np.bincount(years-xmin)
+            self.year_steps.set_data(hist,np.arange(xmin,xmax+2)-0.5)
+            self.ax_year.set_xlim([xmin-0.5,xmax+0.5])
+            self.ax_year.set_ylim(0,hist.max()*1.05)
+        else:
+            self.year_steps.set_data([0],[0,1])
+
+        self.canvas_year.draw_idle()
+        if self.canvas_mesh is not self.canvas_year:
+            self.canvas_mesh.draw_idle()
+
+        if self.csv_path is not None or self.include_nlp:
+            self.selection_id += 1
+            self.worker = threading.Thread(target=self._background_work,args=(self.selection_id,self.mask),daemon=True)
+            self.worker.start()
+
+    @property
+    def df_selected(self):
+        """Rows of the selected papers (taken on first use)"""
+        if self._df_selected is None:
+            self._df_selected = self.df_papers[self.mask]
+        return self._df_selected
+
+    def _background_work(self, selection_id, mask):
+        """CSV export and entity extraction of a selection, off the UI thread"""
+        df_selected = self.df_papers[mask]
+        if self.csv_path is not None:
+            df_selected.to_csv(self.csv_path)
+        if self.include_nlp:
+            texts = (df_selected['title'].fillna('') + " " + df_selected['abstract'].fillna('')).tolist()
+            entities = {}
+            for idx,sdoc in zip(df_selected.index,self.nlp.pipe(texts)):
+                if selection_id != self.selection_id:
+                    # superseded by a newer lasso
+                    return
+                entities[idx] = sdoc.ents
+            self.entities_dict = entities
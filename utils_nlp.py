@@ -1,32 +1,48 @@
-import spacy
 import pandas as pd
 import glob,os
 import utils
-import swifter
+import utils_vectors
+import utils_sim
+import utils_umap
+import utils_pubs
+import db
 import re
-import joblib
+import time
+import collections
+import multiprocessing as mp
 import numpy as np
 import config
 import json
 
-import umap
 
 def cosine_similarity(vec,df):
-    dotprocuts = df.dot(vec)
-    vec2norm = df.apply(np.linalg.norm,axis=1)
-    denom = np.linalg.norm(vec1)*vec2norm
-    cs = dotprocuts/denom
-    return cs
+    """Cosine similarity of vec with every row of df"""
+    return pd.Series(utils_sim.cosine_similarity(vec,df.values)[0],index=df.index)
 
-def calculate_embedding(dfv):
+def calculate_embedding(dfv,use_map=False,path=None):
+    """2-D UMAP coordinates of dfv, fitted on dfv itself
+
+    Rows are normalized first (utils_sim.normalize). With use_map they are
+    placed on the persisted paper map instead (utils_umap.fit), which only
+    makes sense for vectors of the model the paper store was built with.
+    """
+    vectors = utils_sim.normalize(dfv)
+    if use_map:
+        model = utils_umap.load_model(path)
+        if model is None:
+            raise RuntimeError("No UMAP model in %s, run utils_umap.fit() first" % (path if path is not None else config.umap_path))
+        if model._raw_data.shape[1] != vectors.shape[1]:
+            raise ValueError("Vectors have dim %i, the paper map was fitted on dim %i" % (vectors.shape[1],model._raw_data.shape[1]))
+        return model.transform(vectors)
+    import umap
     umapp = umap.UMAP()
-    embedding = umapp.fit_transform(dfv)
+    embedding = umapp.fit_transform(vectors)
     return embedding
 
 def normalize_fn(comment, nlp, lowercase=True, remove_stopwords=True):
     #stops = stopwords.words("english")
+    from spacy.lang.en.stop_words import STOP_WORDS as stops
     comment = str(comment)
-    stops = spacy.lang.en.stop_words.STOP_WORDS
 
     if lowercase:
         comment = comment.lower()
@@ -48,24 +64,49 @@ def get_zotero_pmids(zotero_df):
     pmdids = np.array(pmdids,dtype='int64')
     return pmdids
 
-def generate_zotero_embeddings(library_df,model='en_ner_bionlp13cg_md'):
-    nlp = spacy.load(model)
-    vecs = np.zeros((library_df.shape[0],200))
-    library_vectors = pd.DataFrame(vecs,index=library_df.index)
-    print("Combining titles and abstracts...")
-    library_df['title+abstract'] = library_df['title'].replace(np.nan, '') + " " + library_df['abstract'].replace(np.nan, '')
-    print("Removing stopwords...")
-    library_df['title+abstract'] = library_df['title+abstract'].replace(np.nan, '')
-    library_df['title+abstract+cleaned'] = library_df['title+abstract'].apply(normalize_fn,nlp=nlp)
-    counter = 0
-    print("Populating with vectors...")
-    for doc in nlp.pipe(library_df['title+abstract+cleaned'],disable=["textcat","tokenizer","ner","tagger", "parser"]):
-        library_vectors.iloc[counter] = doc.vector
-        print(" >> %5i abstracts vectorized..." % counter)
-        counter+=1
-    
-    #library_vectors.to_hdf(config.library_path+library_basename+".h5",'vectors')
-    return library_vectors
+def embed_lemmas(texts,nlp,lowercase=True,remove_stopwords=True,batch_size=256):
+    """normalize_fn and the document vector in one nlp.pipe pass
+
+    Each text's vector is the mean vector of its lemmas (stop words removed),
+    as float32 rows. Pipelines without a lemmatizer use the token text.
+    """
+    from spacy.attrs import LEMMA,ORTH,IS_SPACE
+    from spacy.lang.en.stop_words import STOP_WORDS
+    # lemmas are compared by their string hash, skipping the Token objects
+    stops = set(nlp.vocab.strings[w] for w in STOP_WORDS) if remove_stopwords else set()
+    table = np.asarray(nlp.vocab.vectors.data)
+    vecs = np.zeros((len(texts),nlp.vocab.vectors_length),dtype='float32')
+    disabled = [name for name in ['ner','parser','textcat'] if name in nlp.pipe_names]
+    texts = [str(t).lower() if lowercase else str(t) for t in texts]
+    for count,doc in enumerate(nlp.pipe(texts,disable=disabled,batch_size=batch_size)):
+        keys = [lemma or orth for lemma,orth,space in doc.to_array([LEMMA,ORTH,IS_SPACE]).tolist()
+                if not space and (lemma or orth) not in stops]
+        if keys:
+            rows = nlp.vocab.vectors.find(keys=keys)
+            vecs[count] = table[rows[rows >= 0]].sum(axis=0)/len(keys)
+    return vecs
+
+def generate_zotero_embeddings(library_df,model='en_ner_bionlp13cg_md',nlp=None,cache=None):
+    """Vectors of the library's titles + abstracts, as a DataFrame aligned with library_df
+
+    Vectors are cached by a hash of each item's title + abstract (one cache
+    file per model in library_path), so only new or edited items are embedded.
+    """
+    if cache is None:
+        cache = utils_vectors.VectorCache(os.path.join(config.library_path,"embeddings_%s.npz" % model))
+    corpus = paper_text(library_df)
+    hashes = utils_vectors.content_hash(corpus)
+    vecs,found = cache.get(hashes)
+    print("> %i library items, %i cached" % (len(hashes),found.sum()))
+    if not found.all():
+        if nlp is None:
+            print("Loading model...",model)
+            import spacy
+            nlp = spacy.load(model)
+        print("Embedding %i new or edited library items..." % (~found).sum())
+        cache.put(hashes[~found],embed_lemmas(corpus[~found].tolist(),nlp))
+        vecs,found = cache.get(hashes)
+    return pd.DataFrame(vecs,index=library_df.index)
 
 def read_zotero_json(zotero_file):
     with open(zotero_file) as json_file:  
@@ -75,31 +116,26 @@ def read_zotero_json(zotero_file):
     return zotero_df
 
 def initialize_zotero_library(fpath,rebuild_library=False):
+    """Load a Zotero JSON export from library_path, generate_zotero_embeddings() embeds it"""
     library_basename = os.path.basename(fpath).replace(".json","")
     if os.path.exists(config.library_path+library_basename+".h5") and not rebuild_library:
-        with pd.HDFStore(config.library_path+library_basename+".h5") as hdf:
-            keys = sorted(hdf.keys())
         library_df = pd.read_hdf(config.library_path+library_basename+".h5","library")
-        if "/vectors" in keys:
-            library_vectors = pd.read_hdf(config.library_path+library_basename+".h5","vectors")
-        else:
-            generate_zotero_embeddings()
     else:
         library_df = read_zotero_json(config.library_path+fpath)
         library_df.drop_duplicates(subset='title',inplace=True)
         library_df.to_hdf(config.library_path+library_basename+".h5",'library')
-        generate_zotero_embeddings()
-
-    library_pmids = get_zotero_pmids(library_df)
-    email_content = []
     return library_df
 
+# only alphanumeric words of 2 or more chars starting with a letter
+clean_pattern = re.compile(r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b')
+
 def cleaner(text_str):
     "Extract relevant text from DataFrame using a regex"
-    # Regex pattern for only alphanumeric, hyphenated text with 3 or more chars
-    pattern = re.compile(r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b')
-    clean = " ".join(pattern.findall(text_str))
-    return clean
+    return " ".join(clean_pattern.findall(text_str))
+
+def clean_texts(texts):
+    """cleaner() of every text of a Series, vectorized"""
+    return texts.fillna('').str.findall(clean_pattern).str.join(" ")
 
 def text_to_vector(text,nlp):
     doc = nlp(text)
@@ -111,60 +147,172 @@ def process_text(text,nlp):
     vec = text_to_vector(text=t,nlp=nlp)
     return vec
 
-def update_embeddings(years=['*'],model="en_core_sci_lg",disabled=['ner', 'tagger', 'parser', 'textcat', "lemmatizer"]):
-    # note this takes a long time when doing all years first
-    print("Loading model...",model)
-    filelists = []
-
-    nlp = spacy.load('en_core_sci_lg')
-    
-    for y in years:
-        filelists.extend(glob.glob(config.data_path+"by_year/papers/%s.parq"%str(y)))
-    
-    n_process = 28
-    batch_size = 2500
-    
-    for fname in sorted(filelists):
-        print("Creating vectors for:",fname)
-        year = os.path.basename(fname).split(".")[0]
-        paperi = utils.load_year(year)
-        print("> Processing # of papers...",paperi.shape[0])
-        corpus = paperi['title'] + " " + paperi['abstract']
-        #print("> Cleaning...")
-        corpus_clean = corpus.swifter.apply(cleaner)
-        #print("> Vectorizing...")
-        #vecs = corpus_clean.swifter.apply(text_to_vector,nlp=nlp)
-
-        num_papers = corpus_clean.shape[0]
-        vecs = np.zeros((num_papers,200))
-        count = 0
-
-        disabled=['ner', 'tagger', 'parser', 'textcat', "lemmatizer"]
-        for doc in nlp.pipe(list(corpus_clean), n_process=28,disable=disabled, batch_size=batch_size):
-            vecs[count,:] = pd.Series(doc.vector)
-            count += 1
-            if count % 50000 == 0:
-                print("Complete: %s | %3.1f | %8i | %8i" %(os.path.basename(fname),100*count/num_papers,count,num_papers))
-        
-        vecdf = pd.DataFrame(vecs,index=paperi.index)
-        print("Saving...")
-        utils.save_year_vectors(vecdf,int(year))
-
-def generate_paper_vectors(papers):
-
-    corpus = papers['title'] + " " + papers['abstract']
-
-    corpus_clean = corpus.swifter.apply(cleaner)
-    num_papers = corpus_clean.shape[0]
-
-    vecs = np.zeros((num_papers,200))
-    count = 0
-
-    disabled=['ner', 'tagger', 'parser', 'textcat', "lemmatizer"]
-    for doc in nlp.pipe(list(corpus_clean), n_process=28,disable=disabled, batch_size=batch_size):
-        vecs[count,:] = pd.Series(doc.vector)
-        count += 1
-        if count % 50000 == 0:
-            print("Complete: %s | %3.1f | %8i | %8i" %(os.path.basename(fname),100*count/num_papers,count,num_papers))
-
-    return vecs
\ No newline at end of file
+# embedding worker state, the model is loaded once per process
+_worker_nlp = None
+
+def _init_worker(model):
+    import spacy
+    global _worker_nlp
+    _worker_nlp = spacy.load(model)
+
+def _embed_shard(texts,batch_size):
+    return embed_corpus(texts,_worker_nlp,batch_size=batch_size,clean=False)
+
+def model_dim(model):
+    """Width of a spaCy model's vectors, read from its meta.json without loading it"""
+    import spacy
+    path = model if os.path.isdir(model) else spacy.util.get_package_path(model)
+    return spacy.util.get_model_meta(path)['vectors']['width']
+
+def vector_store(model,store=None,nlp=None):
+    """The normalized paper EmbeddingStore (config.vectors_path by default), checked against the model's name and width
+
+    A store records the model of its first update in meta['model'], vectors of another model are refused.
+    """
+    dim = nlp.vocab.vectors_length if nlp is not None else model_dim(model)
+    if store is None:
+        store = utils_vectors.EmbeddingStore(dim=dim,normalized=True)
+    if store.dim != dim:
+        raise ValueError("%s has %i-d vectors but the store in %s holds %i-d ones" % (model,dim,store.path,store.dim))
+    if 'model' not in store.meta:
+        store.meta['model'] = model
+        store.save_meta()
+    elif store.meta['model'] != model:
+        raise ValueError("The store in %s holds %s vectors, not %s ones" % (store.path,store.meta['model'],model))
+    return store
+
+def iter_shards(y1=None,y2=None,last_pmid=-1,shard_size=None):
+    """Yield (pmids, pubyears, content hashes, cleaned texts) of the papers after last_pmid, shard_size at a time"""
+    for papers in utils_pubs.iter_after(db,last_pmid,['pmid','title','abstract','pubyear'],shard_size or config.embed_shard_size,y1,y2):
+        corpus = paper_text(papers)
+        yield (papers['pmid'].values,papers['pubyear'].fillna(0).values,utils_vectors.content_hash(corpus),
+               clean_texts(corpus).tolist())
+
+def update_embeddings(y1=None,y2=None,model=None,n_workers=None,batch_size=None,shard_size=None,store=None,resume=True):
+    """Embed every paper published between y1 and y2 (all by default) into the store
+
+    Papers are streamed from papers.db in pmid order, shard_size at a time,
+    and embedded by n_workers processes (each loading the model once). After
+    every shard the last pmid written is checkpointed in the store, so an
+    interrupted run resumes where it stopped (a shard cut off half-way
+    through store.put is rewritten). Defaults come from config.embed_*.
+    """
+    model = model or config.embed_model
+    n_workers = n_workers or config.embed_workers
+    batch_size = batch_size or config.embed_batch_size
+    store = vector_store(model,store)
+    last_run = db.last_run_id()
+    checkpoint = store.meta.get('embed_checkpoint')
+    last_pmid = -1
+    if resume and checkpoint is not None and checkpoint['years'] == [y1,y2]:
+        last_pmid = checkpoint['last_pmid']
+        print("Resuming after pmid",last_pmid)
+    # the index must include a shard written before an interruption, so it is overwritten
+    store.reindex()
+
+    num_papers,start = 0,time.perf_counter()
+    def write(pmids,years,hashes,vecs):
+        nonlocal num_papers
+        store.put(pmids,years,vecs,hashes,reindex=False)
+        store.meta['embed_checkpoint'] = {'years': [y1,y2],'last_pmid': int(pmids[-1])}
+        store.save_meta()
+        num_papers += len(pmids)
+        print("> Embedded %9i papers (pmid %i) %8.0f docs/s" % (num_papers,pmids[-1],num_papers/(time.perf_counter()-start)))
+
+    shards = iter_shards(y1,y2,last_pmid,shard_size)
+    if n_workers <= 1:
+        print("Loading model...",model)
+        _init_worker(model)
+        for pmids,years,hashes,texts in shards:
+            write(pmids,years,hashes,_embed_shard(texts,batch_size))
+    else:
+        # bounded window of shards in flight, written back in pmid order
+        with mp.Pool(n_workers,initializer=_init_worker,initargs=(model,)) as pool:
+            pending = collections.deque()
+            for pmids,years,hashes,texts in shards:
+                pending.append((pmids,years,hashes,pool.apply_async(_embed_shard,(texts,batch_size))))
+                if len(pending) >= 2*n_workers:
+                    pmids,years,hashes,result = pending.popleft()
+                    write(pmids,years,hashes,result.get())
+            while pending:
+                pmids,years,hashes,result = pending.popleft()
+                write(pmids,years,hashes,result.get())
+
+    store.reindex()
+    store.meta.pop('embed_checkpoint',None)
+    if y1 is None and y2 is None:
+        # update_embeddings_incremental picks up from here
+        store.meta['last_run'] = last_run
+    store.save_meta()
+    return num_papers
+
+def paper_text(papers):
+    return papers['title'].fillna('') + " " + papers['abstract'].fillna('')
+
+def embed_corpus(corpus,nlp,n_process=1,batch_size=2500,disabled=['ner', 'tagger', 'parser', 'textcat', "lemmatizer"],clean=True):
+    """Cleaned-text document vector of each text, as a float32 array (clean=False for texts already cleaned)"""
+    vecs = np.zeros((len(corpus),nlp.vocab.vectors_length),dtype='float32')
+    disabled = [name for name in disabled if name in nlp.pipe_names]
+    if clean:
+        corpus = clean_texts(pd.Series(corpus,dtype=object)).tolist()
+    for count,doc in enumerate(nlp.pipe(corpus,n_process=n_process,disable=disabled,batch_size=batch_size)):
+        vecs[count] = doc.vector
+    return vecs
+
+def stale_pmids(store,chunksize=100000):
+    """pmids of the papers missing from the store, or whose text hash or pubyear differs from the stored one"""
+    stale = []
+    for papers in utils_pubs.iter_after(db,-1,['pmid','title','abstract','pubyear'],chunksize):
+        old_hashes,old_years,found = store.hashes(papers['pmid'])
+        changed = ~found | (old_hashes != utils_vectors.content_hash(paper_text(papers))) | (old_years != papers['pubyear'].values)
+        stale.extend(papers['pmid'].values[changed].tolist())
+    return stale
+
+def update_embeddings_incremental(model=None,nlp=None,store=None,n_process=1,batch_size=2500,index=None):
+    """Embed only the papers whose title or abstract changed since the last call
+
+    The candidates are the pmids logged by the ingest runs after the one
+    recorded in the store (db.changed_since), or every paper whose hash or
+    pubyear differs from the store's when some of those runs ingested files
+    without logging their changes (db.unlogged_files). A paper is re-embedded when it
+    is not in the store or the hash of its title + abstract differs from the
+    stored one; papers that only moved to another pubyear keep their vector.
+    The re-embedded papers are also added to index (an utils_ann.IVFIndex) if given.
+    model defaults to config.embed_model, as in update_embeddings; nlp is that model already loaded.
+    """
+    model = model or config.embed_model
+    store = vector_store(model,store,nlp)
+    pmids,last_run = db.changed_since(store.meta.get('last_run',0))
+    unlogged = db.unlogged_files(store.meta.get('last_run',0),last_run)
+    if unlogged:
+        print("%i ingested files did not log their changes (config.log_changes), comparing every paper's hash..." % len(unlogged))
+        pmids = stale_pmids(store)
+    print("Papers changed by ingest:",len(pmids))
+    papers = utils_pubs.load_pmids(db,pmids,['pmid','title','abstract','pubyear'])
+    corpus = paper_text(papers)
+    hashes = utils_vectors.content_hash(corpus)
+    old_hashes,old_years,found = store.hashes(papers['pmid'])
+    changed = ~found | (old_hashes != hashes)
+    moved = ~changed & (old_years != papers['pubyear'].values)
+    print("> Re-embedding %i papers (%i with unchanged text skipped)" % (changed.sum(),(~changed).sum()))
+
+    vecs = np.zeros((len(papers),store.dim),dtype='float32')
+    if changed.any():
+        if nlp is None:
+            print("Loading model...",model)
+            import spacy
+            nlp = spacy.load(model)
+        vecs[changed] = embed_corpus(corpus[changed].tolist(),nlp,n_process,batch_size)
+    if moved.any():
+        vecs[moved] = store.get(papers['pmid'][moved])[0]
+    update = changed | moved
+    store.put(papers['pmid'][update],papers['pubyear'][update],vecs[update],hashes[update])
+    if index is not None and changed.any():
+        index.add(papers['pmid'][changed],vecs[changed])
+    store.meta['last_run'] = last_run
+    store.save_meta()
+    return int(changed.sum()),int((~changed).sum())
+
+def generate_paper_vectors(papers,nlp,n_process=1,batch_size=2500):
+    """Document vectors of the papers' titles + abstracts"""
+    return embed_corpus(paper_text(papers).tolist(),nlp,n_process,batch_size)
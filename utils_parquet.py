@@ -0,0 +1,126 @@
+import os,glob
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import peewee as pw
+
+import config
+import utils_pubs
+
+# one file per publication year, sorted by pubdate so row group statistics
+# let month/date filters skip most of a file
+row_group_size = 100000
+# bumped when the file layout changes (2: nlm_unique_id as text), older mirrors are rebuilt
+schema_version = 2
+
+def year_path(year):
+    return config.parquet_path + "%s.parq" % str(year)
+
+def mirror_years():
+    """Years that currently have a Parquet file"""
+    return sorted(int(os.path.basename(f).split(".")[0]) for f in glob.glob(year_path("[0-9]*")))
+
+# IntegerFields that hold text for some papers (NLM IDs such as '2985213R'), stored as strings
+text_fields = ['nlm_unique_id']
+
+def mirror_state():
+    """The schema version and the db.year_generations of each year when it was exported"""
+    fname = config.parquet_path + "mirror.json"
+    if not os.path.exists(fname):
+        return {'schema_version': None,'generations': {}}
+    with open(fname) as f:
+        return json.load(f)
+
+def save_mirror_state(state):
+    fname = config.parquet_path + "mirror.json"
+    with open(fname + ".tmp","w") as f:
+        json.dump(state,f)
+    os.replace(fname + ".tmp",fname)
+
+def stale_years(db):
+    """Years whose Parquet file is missing, or older than their papers in papers.db
+
+    Worked out from the year generations stored in papers.db and in the
+    mirror, so years written by a run that failed before its export are
+    picked up by the next one.
+    """
+    generations = db.year_generations() or {}
+    years = set(y for y, in db.PaperDB.select(db.PaperDB.pubyear).distinct().tuples() if y is not None) | set(generations)
+    # files of years that no longer have papers are removed by export_year
+    years |= set(mirror_years())
+    state = mirror_state()
+    if state['schema_version'] != schema_version:
+        return sorted(years)
+    return sorted(y for y in years if state['generations'].get(str(y)) != generations.get(y,0))
+
+def paper_schema(db):
+    types = {pw.IntegerField: pa.int64(), pw.BooleanField: pa.bool_(), pw.DateField: pa.timestamp('ms')}
+    return pa.schema([(f,pa.string() if f in text_fields else types.get(type(db.PaperDB._meta.fields[f]),pa.string()))
+                      for f in db.fields])
+
+def _to_table(df,schema):
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            # pmc holds '' when missing
+            df[field.name] = pd.to_numeric(df[field.name],errors='coerce')
+        elif field.name in text_fields:
+            values = df[field.name]
+            df[field.name] = values.astype(str).where(values.notna())
+        elif pa.types.is_string(field.type):
+            df[field.name] = df[field.name].astype(str)
+    return pa.Table.from_pandas(df[schema.names],schema=schema,preserve_index=False)
+
+def export_year(db,year):
+    """Rewrite the Parquet file of one year from papers.db, returns the number of papers"""
+    fname = year_path(year)
+    schema = paper_schema(db)
+    q = utils_pubs.query_year(db,year,db.fields).order_by(db.PaperDB.pubdate)
+    num_papers = 0
+    writer = None
+    for df in utils_pubs.iter_papers(q,row_group_size):
+        if writer is None:
+            writer = pq.ParquetWriter(fname + ".tmp",schema,compression='zstd')
+        writer.write_table(_to_table(df,schema),row_group_size=row_group_size)
+        num_papers += df.shape[0]
+    if writer is not None:
+        writer.close()
+        os.replace(fname + ".tmp",fname)
+    elif os.path.exists(fname):
+        os.remove(fname)
+    return num_papers
+
+def export_years(db,years=None):
+    """Rewrite the Parquet files of the given years (all years by default), recording their generations"""
+    if not os.path.isdir(config.parquet_path):
+        os.makedirs(config.parquet_path)
+    if years is None:
+        q = db.PaperDB.select(db.PaperDB.pubyear).distinct()
+        years = [y for y, in q.tuples()]
+    state = mirror_state()
+    if state['schema_version'] != schema_version:
+        state = {'schema_version': schema_version,'generations': {}}
+    for year in sorted(years):
+        # read before the export, a concurrent write can only make the year look stale
+        generation = (db.year_generations([year]) or {}).get(year,0)
+        num_papers = export_year(db,year)
+        state['generations'][str(year)] = generation
+        save_mirror_state(state)
+        print("  > Exported %5i: %8i papers" % (year,num_papers))
+
+def update_mirror(db):
+    """Export the stale_years, returns them"""
+    years = stale_years(db)
+    export_years(db,years)
+    return years
+
+def load_year(year,columns=None,filters=None):
+    """Load one year from the Parquet mirror, e.g. filters=[('pubmonth','==',2)]"""
+    return pd.read_parquet(year_path(year),columns=columns,filters=filters)
+
+def load_between_years(y1,y2,columns=None,filters=None):
+    paths = [year_path(y) for y in mirror_years() if y1 <= y <= y2]
+    if len(paths) == 0:
+        return pd.DataFrame(columns=columns)
+    dataset = pq.ParquetDataset(paths,filters=filters)
+    return dataset.read(columns=columns).to_pandas()
@@ -1,61 +1,257 @@
 import pandas as pd
+import numpy as np
 import datetime
 
+import config
+import utils_sim
+import utils_cache
+
 today = datetime.date.today()
 
-def load_today(db):
-    q = db.PaperDB.select().where(db.PaperDB.pubdate==today)
-    df = pd.DataFrame(list(q.dicts()))
-    return df
+def select_papers(db,columns=None):
+    """PaperDB query selecting only the given columns (all of them by default)"""
+    if columns is None:
+        return db.PaperDB.select()
+    return db.PaperDB.select(*[getattr(db.PaperDB,c) for c in columns])
 
-def load_this_week(db):
-    delta = (today+datetime.timedelta(days=1)) - datetime.timedelta(days=8)
-    q = db.PaperDB.select().where(db.PaperDB.pubdate.between(delta,today))
-    df = pd.DataFrame(list(q.dicts()))
-    return df
+def iter_papers(q,chunksize=100000):
+    """Yield a query's results as DataFrames of at most chunksize rows
 
-def load_this_month(db):
-    delta = (today+datetime.timedelta(days=1)) - datetime.timedelta(days=31)
-    q = db.PaperDB.select().where(db.PaperDB.pubdate.between(delta,today))
-    df = pd.DataFrame(list(q.dicts()))
+    Rows are fetched straight from the SQLite cursor into each frame, skipping
+    the per-row dicts that q.dicts() builds.
+    """
+    cursor = q.model._meta.database.execute(q)
+    columns = [c[0] for c in cursor.description]
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        yield _fix_types(pd.DataFrame.from_records(rows,columns=columns))
+
+def _fix_types(df):
+    if 'pubdate' in df:
+        df['pubdate'] = pd.to_datetime(df['pubdate'],format='%Y-%m-%d',errors='coerce')
+    if 'delete' in df:
+        df['delete'] = df['delete'].astype(bool)
+    if 'nlm_unique_id' in df and df['nlm_unique_id'].dtype == object:
+        # an integer for most journals but text such as '2985213R' for some, one type per column
+        ids = df['nlm_unique_id']
+        df['nlm_unique_id'] = ids.astype(str).where(ids.notna())
     return df
 
-def load_year(db,year):
-    q = db.PaperDB.select().where(db.PaperDB.pubyear == year) 
-    papers = pd.DataFrame(list(q.dicts()))
-    return papers
+def load_papers(q):
+    chunks = list(iter_papers(q))
+    if len(chunks) == 0:
+        return pd.DataFrame()
+    return pd.concat(chunks,ignore_index=True)
 
-def load_between_years(db,y1,y2):
-    q = db.PaperDB.select().where(db.PaperDB.pubyear.between(y1,y2))
-    df = list(q.dicts())
-    return df
+_cache = None
+
+def query_cache():
+    """The utils_cache.QueryCache in front of the year/date loaders, None unless config.query_cache"""
+    global _cache
+    if not config.query_cache:
+        return None
+    if _cache is None or _cache.path != config.query_cache_path:
+        _cache = utils_cache.QueryCache()
+    return _cache
 
-def load_all(db):
-    q = db.PaperDB.select()
-    df = pd.DataFrame(list(q.dicts()))
+def cached_load(db,name,params,columns,years,q):
+    """load_papers(q) through the query cache, years being the pubyears q can return
+
+    The key is the loader's name and params, the database file and the
+    selected columns. Generations are read before the query runs, so a
+    concurrent ingest can only make the stored entry look stale, never fresh.
+    """
+    cache = query_cache()
+    generations = db.year_generations(years) if cache is not None else None
+    if generations is None:
+        return load_papers(q)
+    if columns is None:
+        columns = db.PaperDB._meta.sorted_field_names
+    columns = tuple(str(c) for c in columns)
+    key = cache.key(name,db.db_path(),params,columns)
+    df = cache.get(key,generations)
+    if df is None:
+        df = load_papers(q)
+        cache.put(key,df,generations,(name,params,columns))
     return df
 
+def _since(days):
+    return (today+datetime.timedelta(days=1)) - datetime.timedelta(days=days)
+
+def _years_since(days):
+    return list(range(_since(days).year,today.year+1))
+
+def query_today(db,columns=None):
+    return select_papers(db,columns).where(db.PaperDB.pubdate==today)
+
+def query_this_week(db,columns=None):
+    return select_papers(db,columns).where(db.PaperDB.pubdate.between(_since(8),today))
+
+def query_this_month(db,columns=None):
+    return select_papers(db,columns).where(db.PaperDB.pubdate.between(_since(31),today))
+
+def query_year(db,year,columns=None):
+    return select_papers(db,columns).where(db.PaperDB.pubyear == year)
+
+def query_between_years(db,y1,y2,columns=None):
+    return select_papers(db,columns).where(db.PaperDB.pubyear.between(y1,y2))
+
+def load_today(db,columns=None):
+    return cached_load(db,'today',(today,),columns,[today.year],query_today(db,columns))
+
+def load_this_week(db,columns=None):
+    return cached_load(db,'this_week',(today,),columns,_years_since(8),query_this_week(db,columns))
+
+def load_this_month(db,columns=None):
+    return cached_load(db,'this_month',(today,),columns,_years_since(31),query_this_month(db,columns))
+
+def load_year(db,year,columns=None):
+    return cached_load(db,'year',(int(year),),columns,[year],query_year(db,year,columns))
+
+def load_between_years(db,y1,y2,columns=None):
+    return cached_load(db,'between_years',(int(y1),int(y2)),columns,list(range(y1,y2+1)),query_between_years(db,y1,y2,columns))
+
+def load_all(db,columns=None):
+    return load_papers(select_papers(db,columns))
+
+def iter_year(db,year,columns=None,chunksize=100000):
+    return iter_papers(query_year(db,year,columns),chunksize)
+
+def iter_between_years(db,y1,y2,columns=None,chunksize=100000):
+    return iter_papers(query_between_years(db,y1,y2,columns),chunksize)
+
+def iter_all(db,columns=None,chunksize=100000):
+    return iter_papers(select_papers(db,columns),chunksize)
+
+def iter_after(db,last_pmid=-1,columns=None,chunksize=100000,y1=None,y2=None):
+    """Yield the papers with pmid > last_pmid in pmid order, as DataFrames of chunksize rows
+
+    Each chunk is its own keyset query (no cursor stays open between chunks),
+    so a long job can checkpoint the last pmid it finished and resume from it.
+    columns must include pmid.
+    """
+    while True:
+        q = _in_years(db,select_papers(db,columns).where(db.PaperDB.pmid > last_pmid),y1,y2)
+        df = load_papers(q.order_by(db.PaperDB.pmid).limit(chunksize))
+        if df.shape[0] == 0:
+            return
+        yield df
+        last_pmid = int(df['pmid'].iloc[-1])
+
+def iter_pmids(db,pmids,columns=None):
+    """Yield the papers of a list of pmids, in chunks of the bound-parameter limit"""
+    pmids = [int(p) for p in pmids]
+    for idx in range(0,len(pmids),db.max_variables):
+        q = select_papers(db,columns).where(db.PaperDB.pmid.in_(pmids[idx:idx+db.max_variables]))
+        yield from iter_papers(q)
+
+def load_pmids(db,pmids,columns=None):
+    chunks = list(iter_pmids(db,pmids,columns))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks,ignore_index=True)
+
+def _in_years(db,q,y1=None,y2=None):
+    if y1 is not None:
+        q = q.where(db.PaperDB.pubyear >= y1)
+    if y2 is not None:
+        q = q.where(db.PaperDB.pubyear <= y2)
+    return q
+
+def query_mesh(db,ui,y1=None,y2=None,columns=None):
+    """Papers indexed with MeSH descriptor ui (e.g. 'D003920', or a list), optionally within pubyears y1-y2
+
+    Needs the normalized tables (config.normalized).
+    """
+    uis = [ui] if isinstance(ui,str) else list(ui)
+    sub = (db.PaperMesh.select(db.PaperMesh.pmid)
+                       .join(db.Mesh)
+                       .where(db.Mesh.ui.in_(uis)))
+    return _in_years(db,select_papers(db,columns).where(db.PaperDB.pmid.in_(sub)),y1,y2)
+
+def query_affiliation(db,string_contains,first_and_last_affiliation=True,y1=None,y2=None,columns=None):
+    """Papers whose first/last (or any) affiliation contains string_contains
+
+    The substring match runs over the distinct affiliations only, the papers
+    are then found through the affiliation index.
+    """
+    sub = (db.PaperAffiliation.select(db.PaperAffiliation.pmid)
+                              .join(db.Affiliation)
+                              .where(db.Affiliation.name.contains(string_contains)))
+    if first_and_last_affiliation:
+        sub = sub.where((db.PaperAffiliation.position == 0) | (db.PaperAffiliation.last == True))
+    return _in_years(db,select_papers(db,columns).where(db.PaperDB.pmid.in_(sub)),y1,y2)
+
+def query_author(db,lastname,forename=None,positions=None,y1=None,y2=None,columns=None):
+    """Papers by an author, optionally only at the given positions (0 is the first author)"""
+    sub = (db.PaperAuthor.select(db.PaperAuthor.pmid)
+                         .join(db.Author)
+                         .where(db.Author.lastname == lastname))
+    if forename is not None:
+        sub = sub.where(db.Author.forename == forename)
+    if positions is not None:
+        sub = sub.where(db.PaperAuthor.position.in_(positions))
+    return _in_years(db,select_papers(db,columns).where(db.PaperDB.pmid.in_(sub)),y1,y2)
+
+def load_mesh(db,ui,y1=None,y2=None,columns=None):
+    return load_papers(query_mesh(db,ui,y1,y2,columns))
+
+def load_affiliation(db,string_contains,first_and_last_affiliation=True,y1=None,y2=None,columns=None):
+    return load_papers(query_affiliation(db,string_contains,first_and_last_affiliation,y1,y2,columns))
+
+def load_author(db,lastname,forename=None,positions=None,y1=None,y2=None,columns=None):
+    return load_papers(query_author(db,lastname,forename,positions,y1,y2,columns))
+
+def search(db,query,columns=['pmid','title','journal','pubdate'],limit=20,offset=0,snippet='abstract',snippet_tokens=24):
+    """Full-text search of papers ranked by bm25 (best first), needs db.create_fts()
+
+    query uses the FTS5 syntax, e.g. 'crispr AND mouse', '"gene therapy"',
+    'title:cancer' or 'mesh_terms:neoplasms'. Returns a page of limit papers
+    starting at offset with their rank and a snippet of the snippet column
+    (matches in [brackets]).
+    """
+    weights = ",".join(str(w) for w in db.fts_weights)
+    sql = ("SELECT %s, bm25(paperdb_fts,%s) AS rank, snippet(paperdb_fts,%i,'[',']','...',%i) AS snippet "
+           "FROM paperdb_fts JOIN paperdb p ON p.id = paperdb_fts.rowid "
+           "WHERE paperdb_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?"
+           % (",".join('p."%s"' % c for c in columns),weights,db.fts_fields.index(snippet),snippet_tokens))
+    cursor = db.PaperDB._meta.database.execute_sql(sql,(query,limit,offset))
+    return _fix_types(pd.DataFrame.from_records(cursor.fetchall(),columns=list(columns)+['rank','snippet']))
+
+def search_count(db,query):
+    """Number of papers matching a full-text query"""
+    cursor = db.PaperDB._meta.database.execute_sql('SELECT count(*) FROM paperdb_fts WHERE paperdb_fts MATCH ?',(query,))
+    return cursor.fetchone()[0]
+
 def check_first_last_affiliation(row,string_contains):
     if string_contains in row[0] or string_contains in row[-1]:
         return True
     else:
         return False
 
-def filter_paper_contains(pm,string_contains,first_and_last_affiliation=True):
+def filter_paper_contains(papers,vectors,library_vectors,string_contains,first_and_last_affiliation=True,journals=None):
+    """Papers with string_contains in their (first or last) affiliation, ranked by similarity to a library
+
+    vectors are the papers' embeddings (rows aligned with papers), journals an
+    optional list of journal names to keep. Adds a similarity column (cosine
+    to the library centroid) and sorts by it.
+    """
     print("Getting affiliates from %s..." % string_contains)
 
+    affiliations = papers['affiliations'].fillna("")
     if first_and_last_affiliation:
-        m_papers = pm.papers_period['affiliations'].str.split(";").apply(check_first_last_affiliation,args=(string_contains,))
+        parts = affiliations.str.split(";")
+        m_papers = parts.str[0].str.contains(string_contains,regex=False) | parts.str[-1].str.contains(string_contains,regex=False)
     else:
-        m_papers = pm.papers_period['affiliations'].str.contains(string_contains)
-
-    m_journal = pm.papers_period['journal_lower'].apply(lambda x: any([k.lower() == x for k in jrl.filter_journals]))
-    m_combined = (m_papers & m_journal)
-    if m_combined.any():
-        papers = pm.papers_period[m_combined]
-        vectors = pm.vectors_period.loc[papers.index]
-        dfout = pm.calculate_similarities(papers,vectors)
-    else:
-        dfout = pd.DataFrame()
-    return dfout
+        m_papers = affiliations.str.contains(string_contains,regex=False)
+
+    if journals is not None:
+        m_papers &= papers['journal'].str.lower().isin([k.lower() for k in journals])
+    if not m_papers.any():
+        return pd.DataFrame()
+    dfout = papers[m_papers.values].copy()
+    dfout['similarity'] = utils_sim.cosine_similarity(utils_sim.centroid(library_vectors),np.asarray(vectors)[m_papers.values])[0]
+    return dfout.sort_values('similarity',ascending=False)
 
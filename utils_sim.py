@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+# rows scored per matmul; the score block is n_queries x chunk_size float32
+chunk_size = 200000
+
+def normalize(vectors):
+    """Unit-length float32 rows (zero rows stay zero)"""
+    vectors = np.atleast_2d(np.asarray(vectors,dtype='float32'))
+    norms = np.linalg.norm(vectors,axis=1,keepdims=True)
+    return vectors/np.where(norms > 0,norms,1)
+
+def centroid(vectors):
+    """Normalized mean direction of a set of vectors, e.g. a Zotero library"""
+    return normalize(normalize(vectors).mean(axis=0))
+
+def cosine_similarity(queries,vectors):
+    """Dense (n_queries, n_vectors) cosine similarities"""
+    return normalize(queries) @ normalize(vectors).T
+
+def _merge_top_k(best_scores,best_idx,scores,offset,k):
+    """Fold a block of scores into the running per-query top-k"""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores,k-1,axis=1)[:,:k]
+        scores = np.take_along_axis(scores,part,axis=1)
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]),scores.shape)
+    scores = np.concatenate([best_scores,scores],axis=1)
+    idx = np.concatenate([best_idx,part + offset],axis=1)
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores,k-1,axis=1)[:,:k]
+        scores = np.take_along_axis(scores,part,axis=1)
+        idx = np.take_along_axis(idx,part,axis=1)
+    return scores,idx
+
+def top_k(queries,vectors,k=10,normalized=False,valid=None,chunk_size=chunk_size):
+    """Best k rows of vectors for each query, as (scores, rows) sorted by decreasing similarity
+
+    vectors may be a memmap; it is scored chunk_size rows at a time, so memory
+    stays bounded whatever its length. normalized=True skips normalizing the
+    rows (pre-normalized stores); rows with valid False are never returned.
+    """
+    queries = normalize(queries)
+    n_queries = queries.shape[0]
+    best_scores = np.full((n_queries,0),-np.inf,dtype='float32')
+    best_idx = np.zeros((n_queries,0),dtype='int64')
+    for start in range(0,len(vectors),chunk_size):
+        chunk = np.asarray(vectors[start:start+chunk_size],dtype='float32')
+        if not normalized:
+            chunk = normalize(chunk)
+        scores = queries @ chunk.T
+        if valid is not None:
+            scores[:,~np.asarray(valid[start:start+chunk_size])] = -np.inf
+        best_scores,best_idx = _merge_top_k(best_scores,best_idx,scores,start,k)
+    order = np.argsort(-best_scores,axis=1)
+    return np.take_along_axis(best_scores,order,axis=1),np.take_along_axis(best_idx,order,axis=1)
+
+def search_store(store,queries,k=10,years=None,exclude=None,chunk_size=chunk_size):
+    """Top-k papers of an EmbeddingStore for each query
+
+    Returns a DataFrame of query, rank, pmid, pubyear and score. years limits
+    the search to some shards; exclude is a list of pmids never returned
+    (e.g. the library itself).
+    """
+    queries = normalize(queries)
+    normalized = store.meta.get('normalized',False)
+    best_scores = np.full((queries.shape[0],0),-np.inf,dtype='float32')
+    best_pmids = np.zeros((queries.shape[0],0),dtype='int64')
+    best_years = np.zeros((queries.shape[0],0),dtype='int16')
+    exclude = np.unique(np.asarray(exclude if exclude is not None else [],dtype='int64'))
+    for year in (store.years() if years is None else years):
+        pmids,vectors = store.year(year)
+        valid = (pmids >= 0) & ~np.isin(pmids,exclude)
+        if not valid.any():
+            continue
+        scores,rows = top_k(queries,vectors,k,normalized,valid,chunk_size)
+        keep = np.isfinite(scores)
+        scores = np.concatenate([best_scores,np.where(keep,scores,-np.inf)],axis=1)
+        cand_pmids = np.concatenate([best_pmids,np.where(keep,pmids[rows],-1)],axis=1)
+        cand_years = np.concatenate([best_years,np.full(rows.shape,year,dtype='int16')],axis=1)
+        order = np.argsort(-scores,axis=1)[:,:k]
+        best_scores = np.take_along_axis(scores,order,axis=1)
+        best_pmids = np.take_along_axis(cand_pmids,order,axis=1)
+        best_years = np.take_along_axis(cand_years,order,axis=1)
+    n_queries,n = best_scores.shape
+    df = pd.DataFrame({'query': np.repeat(np.arange(n_queries),n),
+                       'rank': np.tile(np.arange(n),n_queries),
+                       'pmid': best_pmids.ravel(),
+                       'pubyear': best_years.ravel(),
+                       'score': best_scores.ravel()})
+    return df[np.isfinite(df['score'])].reset_index(drop=True)
+
+def recommend(store,library_vectors,k=100,mode='centroid',years=None,exclude=None,index=None,nprobe=None):
+    """Papers closest to a library of vectors
+
+    mode='centroid' ranks against the library's mean direction, mode='each'
+    returns the top k per library entry (column query is its row number).
+    With an utils_ann.IVFIndex the search is approximate (and ignores years).
+    """
+    queries = centroid(library_vectors) if mode == 'centroid' else library_vectors
+    if index is not None:
+        return index.search_df(queries,k,nprobe,exclude)
+    return search_store(store,queries,k,years,exclude)
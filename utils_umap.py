@@ -0,0 +1,101 @@
+import os
+import time
+import shutil
+import joblib
+import numpy as np
+import pandas as pd
+
+import config
+import utils_vectors
+
+def model_path(path=None):
+    return os.path.join(path if path is not None else config.umap_path,"model.joblib")
+
+def coordinates(path=None):
+    """The 2-D map coordinates, an EmbeddingStore keyed by PMID (dim 2)"""
+    return utils_vectors.EmbeddingStore(os.path.join(path if path is not None else config.umap_path,"coords"),dim=2)
+
+def stratified_sample(store,sample_size,seed=0):
+    """(pmids, years) of about sample_size papers, each year in proportion to its size"""
+    rng = np.random.default_rng(seed)
+    years = store.years()
+    pmids = [store.year_pmids(year) for year in years]
+    pmids = [p[p >= 0] for p in pmids]
+    total = sum(len(p) for p in pmids)
+    sample_pmids,sample_years = [],[]
+    for year,p in zip(years,pmids):
+        n = min(len(p),max(1,int(round(sample_size*len(p)/total)))) if len(p) else 0
+        sample_pmids.append(rng.choice(p,n,replace=False))
+        sample_years.append(np.full(n,year,dtype='int16'))
+    return np.concatenate(sample_pmids),np.concatenate(sample_years)
+
+def fit(store,sample_size=None,seed=0,path=None,**umap_params):
+    """Fit UMAP on a stratified sample of the store and persist it with the sample's coordinates
+
+    The other papers are placed by update(). Coordinates of an earlier fit
+    are dropped, they belong to another projection. umap_params go to umap.UMAP.
+    """
+    sample_size = sample_size or config.umap_sample_size
+    pmids,years = stratified_sample(store,sample_size,seed)
+    vectors = store.get(pmids)[0]
+    import umap
+    print("Fitting UMAP on %i of %i papers..." % (len(pmids),len(store)))
+    model = umap.UMAP(random_state=seed,**umap_params)
+    embedding = model.fit_transform(np.asarray(vectors,dtype='float32'))
+    if not os.path.isdir(os.path.dirname(model_path(path))):
+        os.makedirs(os.path.dirname(model_path(path)))
+    # cleared before the new model is saved, so the coordinates never mix two models
+    shutil.rmtree(coordinates(path).path,ignore_errors=True)
+    joblib.dump(model,model_path(path))
+    coords = coordinates(path)
+    coords.put(pmids,years,embedding,store.hashes(pmids)[0])
+    return model
+
+def load_model(path=None):
+    """The persisted UMAP model, None if fit() was never run"""
+    if not os.path.exists(model_path(path)):
+        return None
+    return joblib.load(model_path(path))
+
+def update(store,model=None,path=None,batch_size=50000,years=None):
+    """Place every paper of the store that is new or whose vector changed since it was placed
+
+    A paper is (re)placed when it has no coordinates or the content hash
+    stored with its coordinates differs from its vector's. Papers are
+    transformed batch_size at a time. Returns the number of papers placed.
+    """
+    model = model or load_model(path)
+    if model is None:
+        raise RuntimeError("No UMAP model in %s, run utils_umap.fit() first" % (path if path is not None else config.umap_path))
+    coords = coordinates(path)
+    todo_pmids,todo_years,todo_hashes = [np.zeros(0,dtype='int64')],[np.zeros(0,dtype='int16')],[np.zeros(0,dtype='uint64')]
+    for year in (store.years() if years is None else years):
+        pmids = store.year_pmids(year)
+        keep = pmids >= 0
+        pmids,hashes = pmids[keep],store.year_hashes(year)[keep]
+        old_hashes,old_years,found = coords.hashes(pmids)
+        todo = ~found | (old_hashes != hashes) | (old_years != year)
+        todo_pmids.append(pmids[todo])
+        todo_years.append(np.full(todo.sum(),year,dtype='int16'))
+        todo_hashes.append(hashes[todo])
+    pmids,years,hashes = np.concatenate(todo_pmids),np.concatenate(todo_years),np.concatenate(todo_hashes)
+    print("Placing %i papers on the map..." % len(pmids))
+    start = time.perf_counter()
+    # batches span years, transform has a fixed cost per call
+    for idx in range(0,len(pmids),batch_size):
+        batch = slice(idx,idx+batch_size)
+        embedding = model.transform(np.asarray(store.get(pmids[batch])[0],dtype='float32'))
+        coords.put(pmids[batch],years[batch],embedding,hashes[batch],reindex=False)
+        done = min(idx+batch_size,len(pmids))
+        print("> %i/%i placed (%.0f papers/s)" % (done,len(pmids),done/(time.perf_counter()-start)))
+    coords.reindex()
+    return len(pmids)
+
+def add_coordinates(papers,path=None):
+    """papers with umap-x/umap-y columns from the stored map (NaN for papers not placed yet)"""
+    xy,found = coordinates(path).get(papers['pmid'])
+    xy = xy.astype('float64')
+    xy[~found] = np.nan
+    papers = papers.copy()
+    papers['umap-x'],papers['umap-y'] = xy[:,0],xy[:,1]
+    return papers
@@ -0,0 +1,273 @@
+import os,glob
+import json
+import hashlib
+import numpy as np
+
+import config
+
+def content_hash(texts):
+    """Stable 64-bit hash of each text, stored with its vector to skip unchanged papers"""
+    return np.array([int.from_bytes(hashlib.blake2b(str(t).encode(),digest_size=8).digest(),'little')
+                     for t in texts],dtype='uint64')
+
+class EmbeddingStore:
+    """On-disk paper vectors keyed by PMID
+
+    Vectors live in one raw memory-mapped matrix per publication year
+    (<year>.vec, rows in insertion order) next to the PMID of every row
+    (<year>.pmid.npy) and a content hash of the text it was computed from
+    (<year>.hash.npy, 0 if unknown). A global index of the sorted PMIDs with their year and
+    row (index_*.npy, also memory-mapped) resolves PMID -> row with a binary
+    search. Rows of papers that moved to another year are marked with PMID -1
+    until compact() rewrites the shard. A normalized store scales every
+    vector to unit length on put, so cosine similarity is a plain dot product.
+    """
+    def __init__(self,path=None,dim=200,dtype='float32',normalized=False):
+        self.path = path if path is not None else config.vectors_path
+        meta_path = os.path.join(self.path,"meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.meta = {'dim': dim,'dtype': dtype,'normalized': normalized}
+            self.save_meta()
+        self.dim = self.meta['dim']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self._load_index()
+
+    def save_meta(self):
+        """Persist self.meta (also used for bookkeeping such as the last embedded ingest run)"""
+        with open(os.path.join(self.path,"meta.json"),"w") as f:
+            json.dump(self.meta,f)
+
+    def _file(self,name):
+        return os.path.join(self.path,name)
+
+    def _save(self,name,values):
+        """np.save through a temporary file, so an interrupted write leaves the old file"""
+        with open(self._file(name + ".tmp"),"wb") as f:
+            np.save(f,values)
+        os.replace(self._file(name + ".tmp"),self._file(name))
+
+    def _load_index(self):
+        if os.path.exists(self._file("index_pmid.npy")):
+            self.index_pmid = np.load(self._file("index_pmid.npy"),mmap_mode='r')
+            self.index_year = np.load(self._file("index_year.npy"),mmap_mode='r')
+            self.index_row = np.load(self._file("index_row.npy"),mmap_mode='r')
+        else:
+            self.index_pmid = np.zeros(0,dtype='int64')
+            self.index_year = np.zeros(0,dtype='int16')
+            self.index_row = np.zeros(0,dtype='int32')
+
+    def reindex(self):
+        """Rebuild the global index from the per-year PMID files"""
+        pmids,years,rows = [np.zeros(0,dtype='int64')],[np.zeros(0,dtype='int16')],[np.zeros(0,dtype='int32')]
+        for year in self.years():
+            p = self.year_pmids(year)
+            keep = np.flatnonzero(p >= 0)
+            pmids.append(p[keep])
+            years.append(np.full(len(keep),year,dtype='int16'))
+            rows.append(keep.astype('int32'))
+        pmids = np.concatenate(pmids)
+        order = np.argsort(pmids,kind='stable')
+        for name,values in (("pmid",pmids),("year",np.concatenate(years)),("row",np.concatenate(rows))):
+            np.save(self._file("index_%s.tmp.npy" % name),values[order])
+        # drop the old maps before replacing the files they point to
+        self.index_pmid = self.index_year = self.index_row = None
+        for name in ("pmid","year","row"):
+            os.replace(self._file("index_%s.tmp.npy" % name),self._file("index_%s.npy" % name))
+        self._load_index()
+
+    def years(self):
+        return sorted(int(os.path.basename(f).split(".")[0]) for f in glob.glob(self._file("[0-9]*.pmid.npy")))
+
+    def year_pmids(self,year):
+        """PMID of every row of a year's shard (-1 for removed rows)"""
+        fname = self._file("%i.pmid.npy" % year)
+        if not os.path.exists(fname):
+            return np.zeros(0,dtype='int64')
+        return np.load(fname)
+
+    def year_hashes(self,year):
+        fname = self._file("%i.hash.npy" % year)
+        n = len(self.year_pmids(year))
+        hashes = np.load(fname)[:n] if os.path.exists(fname) else np.zeros(0,dtype='uint64')
+        # shards written without hashes
+        return np.concatenate([hashes,np.zeros(n-len(hashes),dtype='uint64')])
+
+    def year_vectors(self,year,mode='r'):
+        """The year's vectors as a memmap (no copy), rows aligned with year_pmids"""
+        n = len(self.year_pmids(year))
+        if n == 0:
+            return np.zeros((0,self.dim),dtype=self.dtype)
+        return np.memmap(self._file("%i.vec" % year),dtype=self.dtype,mode=mode,shape=(n,self.dim))
+
+    def year(self,year):
+        """(pmids, vectors) of a year, vectors memory-mapped"""
+        return self.year_pmids(year),self.year_vectors(year)
+
+    def __len__(self):
+        return len(self.index_pmid)
+
+    def __contains__(self,pmid):
+        return self.lookup([pmid])[2][0]
+
+    def lookup(self,pmids):
+        """(years, rows, found) of pmids, O(log n) per PMID"""
+        pmids = np.asarray(pmids,dtype='int64')
+        if len(self.index_pmid) == 0:
+            return np.zeros(len(pmids),dtype='int16'),np.zeros(len(pmids),dtype='int32'),np.zeros(len(pmids),dtype=bool)
+        pos = np.minimum(np.searchsorted(self.index_pmid,pmids),len(self.index_pmid)-1)
+        found = np.asarray(self.index_pmid[pos]) == pmids
+        return np.asarray(self.index_year[pos]),np.asarray(self.index_row[pos]),found
+
+    def get(self,pmids):
+        """(vectors, found) of pmids, missing papers get zero vectors"""
+        years,rows,found = self.lookup(pmids)
+        out = np.zeros((len(years),self.dim),dtype=self.dtype)
+        for year in np.unique(years[found]):
+            sel = found & (years == year)
+            out[sel] = self.year_vectors(int(year))[rows[sel]]
+        return out,found
+
+    def hashes(self,pmids):
+        """(content hashes, years, found) of pmids"""
+        years,rows,found = self.lookup(pmids)
+        out = np.zeros(len(years),dtype='uint64')
+        for year in np.unique(years[found]):
+            sel = found & (years == year)
+            out[sel] = self.year_hashes(int(year))[rows[sel]]
+        return out,years,found
+
+    def put(self,pmids,years,vectors,hashes=None,reindex=True):
+        """Add or overwrite the vectors of pmids published in years (scalar or per PMID)
+
+        Papers already stored under the same year are overwritten in place, new
+        ones are appended to their year's shard. Returns (# added, # overwritten).
+        <year>.pmid.npy is written last and decides which rows exist, so an
+        interrupted put leaves at most unreferenced rows, dropped by the next append.
+        With reindex=False the index is left for an explicit reindex(), which
+        saves re-sorting it after every year of a bulk load (pmids must then
+        not repeat across calls).
+        """
+        pmids = np.asarray(pmids,dtype='int64')
+        years = np.broadcast_to(np.asarray(years,dtype='int16'),pmids.shape)
+        vectors = np.asarray(vectors,dtype='float32').reshape(len(pmids),self.dim)
+        if self.meta.get('normalized'):
+            norms = np.linalg.norm(vectors,axis=1,keepdims=True)
+            vectors = vectors/np.where(norms > 0,norms,1)
+        vectors = vectors.astype(self.dtype)
+        hashes = np.zeros(len(pmids),dtype='uint64') if hashes is None else np.asarray(hashes,dtype='uint64')
+        # the last occurrence of a repeated pmid wins
+        pmids,idx = np.unique(pmids[::-1],return_index=True)
+        idx = len(years)-1-idx
+        years,vectors,hashes = years[idx],vectors[idx],hashes[idx]
+
+        old_years,old_rows,found = self.lookup(pmids)
+        same = found & (old_years == years)
+        for year in np.unique(years):
+            sel_over = same & (years == year)
+            if sel_over.any():
+                mm = self.year_vectors(int(year),mode='r+')
+                mm[old_rows[sel_over]] = vectors[sel_over]
+                mm.flush()
+                del mm
+                year_hashes = self.year_hashes(int(year))
+                year_hashes[old_rows[sel_over]] = hashes[sel_over]
+                self._save("%i.hash.npy" % year,year_hashes)
+            sel_new = ~same & (years == year)
+            if sel_new.any():
+                year_pmids = self.year_pmids(int(year))
+                with open(self._file("%i.vec" % year),"ab") as f:
+                    # drop rows left behind by an interrupted put
+                    f.truncate(len(year_pmids)*self.dim*self.dtype.itemsize)
+                    f.write(np.ascontiguousarray(vectors[sel_new]).tobytes())
+                self._save("%i.hash.npy" % year,np.concatenate([self.year_hashes(int(year)),hashes[sel_new]]))
+                self._save("%i.pmid.npy" % year,np.concatenate([year_pmids,pmids[sel_new]]))
+        for year in np.unique(old_years[found & ~same]):
+            # revised papers that moved to another year, dropped once their new rows exist
+            sel = found & ~same & (old_years == year)
+            year_pmids = self.year_pmids(int(year))
+            year_pmids[old_rows[sel]] = -1
+            self._save("%i.pmid.npy" % year,year_pmids)
+        if reindex:
+            self.reindex()
+        return int((~same).sum()),int(same.sum())
+
+    def remove(self,pmids):
+        """Drop pmids from the index (their rows are reclaimed by compact)"""
+        years,rows,found = self.lookup(pmids)
+        for year in np.unique(years[found]):
+            sel = found & (years == year)
+            year_pmids = self.year_pmids(int(year))
+            year_pmids[rows[sel]] = -1
+            self._save("%i.pmid.npy" % year,year_pmids)
+        self.reindex()
+
+    def compact(self,years=None):
+        """Rewrite shards without their removed rows"""
+        for year in (self.years() if years is None else years):
+            year_pmids = self.year_pmids(year)
+            keep = year_pmids >= 0
+            if keep.all():
+                continue
+            vectors = np.array(self.year_vectors(year)[keep])
+            with open(self._file("%i.vec.tmp" % year),"wb") as f:
+                f.write(vectors.tobytes())
+            for name,values in (("hash",self.year_hashes(year)[keep]),("pmid",year_pmids[keep])):
+                with open(self._file("%i.%s.npy.tmp" % (year,name)),"wb") as f:
+                    np.save(f,values)
+            # everything is written before the first file is swapped in
+            for name in ("vec","hash.npy","pmid.npy"):
+                os.replace(self._file("%i.%s.tmp" % (year,name)),self._file("%i.%s" % (year,name)))
+        self.reindex()
+
+class VectorCache:
+    """Content-addressed vectors: one vector per content_hash, in a single .npz file
+
+    Used for small collections such as a Zotero library, where an item's
+    vector only needs recomputing when its text changes. The hashes are kept
+    sorted so get() is a binary search.
+    """
+    def __init__(self,path,dim=200):
+        self.path = path
+        if os.path.exists(path):
+            with np.load(path) as f:
+                self.hashes,self.vectors = f['hashes'],f['vectors']
+        else:
+            self.hashes = np.zeros(0,dtype='uint64')
+            self.vectors = np.zeros((0,dim),dtype='float32')
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def get(self,hashes):
+        """(vectors, found) of hashes, missing ones get zero vectors"""
+        hashes = np.asarray(hashes,dtype='uint64')
+        out = np.zeros((len(hashes),self.vectors.shape[1]),dtype='float32')
+        if len(self.hashes) == 0:
+            return out,np.zeros(len(hashes),dtype=bool)
+        pos = np.minimum(np.searchsorted(self.hashes,hashes),len(self.hashes)-1)
+        found = self.hashes[pos] == hashes
+        out[found] = self.vectors[pos[found]]
+        return out,found
+
+    def put(self,hashes,vectors):
+        """Add vectors (replacing those with the same hash) and write the file"""
+        vectors = np.asarray(vectors,dtype='float32').reshape(len(hashes),-1)
+        if len(self.hashes) == 0:
+            # the first vectors set the dimension
+            self.vectors = np.zeros((0,vectors.shape[1]),dtype='float32')
+        hashes = np.concatenate([np.asarray(hashes,dtype='uint64'),self.hashes])
+        vectors = np.concatenate([vectors,self.vectors])
+        # the new vector wins for a repeated hash
+        self.hashes,idx = np.unique(hashes,return_index=True)
+        self.vectors = vectors[idx]
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + ".tmp","wb") as f:
+            np.savez(f,hashes=self.hashes,vectors=self.vectors)
+        os.replace(self.path + ".tmp",self.path)